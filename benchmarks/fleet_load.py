@@ -0,0 +1,333 @@
+"""Simulates a fleet of ESP8266 devices checking in with redlight_greenlight.
+
+The service is started in a child process, with in-process stand-ins for
+Google and ThingsBoard that answer after a configurable latency. Then --clients
+simulated devices poll /update with realistic ESP8266 headers, post hotspot
+reports to /wifi_location and occasionally download /firmware, for --duration
+seconds. Reported: throughput and p50/p95/p99 latency per route, and the
+server's peak RSS:
+
+    python benchmarks/fleet_load.py [--clients 50] [--duration 10] [--production]
+"""
+
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Where the simulated fleet lives; every device reports a position near here
+FLEET_CENTER = (45.5152, -122.6784)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=50, help="simulated devices, each with its own connection")
+    parser.add_argument('--duration', type=float, default=10, help="seconds to run the load for")
+    parser.add_argument('--interval', type=float, default=0, help="seconds each device waits between requests")
+    parser.add_argument('--wifi-ratio', type=float, default=0.15, help="fraction of requests that are /wifi_location posts")
+    parser.add_argument('--firmware-ratio', type=float, default=0.02, help="fraction of requests that are /firmware downloads")
+    parser.add_argument('--outdated', type=float, default=0.1, help="fraction of devices that start on an older firmware")
+    parser.add_argument('--moving', type=float, default=0.05, help="chance that a device sees new access points in a report")
+    parser.add_argument('--versions', type=int, default=5, help="firmware versions in the images folder")
+    parser.add_argument('--image-size', type=int, default=400 * 1024, help="bytes per firmware image")
+    parser.add_argument('--google-latency', type=float, default=0.15, help="seconds the Google stand-in takes to answer")
+    parser.add_argument('--thingsboard-latency', type=float, default=0.05, help="seconds the ThingsBoard stand-in takes to answer")
+    parser.add_argument('--production', action='store_true', help="serve with gunicorn rather than the Werkzeug server")
+    parser.add_argument('--workers', type=int, default=4, help="gunicorn workers, with --production")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', metavar='PATH', help="also write the results to PATH, for comparing runs")
+    parser.add_argument('--serve', metavar='WORKDIR', help=argparse.SUPPRESS)     # internal: run the server
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+# ---------------------------------------------------------------------------
+# Server side: runs in the child process
+
+class GoogleStandIn:
+    """Answers geolocation requests like Google, after `latency` seconds."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def geolocate(self, wifi_access_points):
+        time.sleep(self.latency)
+        # A stable answer per set of access points, within a few hundred meters of the fleet center
+        digest = hashlib.sha1(" ".join(sorted(ap["macAddress"] for ap in wifi_access_points)).encode()).digest()
+        return {"location": {"lat": FLEET_CENTER[0] + (digest[0] - 128) / 50000,
+                             "lng": FLEET_CENTER[1] + (digest[1] - 128) / 50000},
+                "accuracy": 20 + digest[2] % 60}
+
+
+class ThingsBoardStandIn:
+    """The parts of TbApi that redlight_greenlight uses, each taking `latency` seconds."""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def send_telemetry(self, device_token, data):
+        time.sleep(self.latency)
+
+    def get_device_by_name(self, name):
+        time.sleep(self.latency)
+        return {"name": name, "id": name}
+
+    def get_device_token(self, device):
+        time.sleep(self.latency)
+        return "token-" + device["name"]
+
+    def get(self, params, msg):
+        time.sleep(self.latency)
+        return {"data": [], "hasNext": False}
+
+
+def serve(args):
+    sys.path.insert(0, REPO_ROOT)
+    from redlight_greenlight import redlight_greenlight as rlgl
+
+    workdir = args.serve
+    rlgl.CFG.update(
+        firmware_images_folder=os.path.join(workdir, "firmware"),
+        geolocation_cache_path=os.path.join(workdir, "geolocation.sqlite"),
+        ap_database_path=os.path.join(workdir, "access_points.sqlite"),
+        device_token_background_refresh=False,
+        server_host="127.0.0.1",
+        server_port=args.port,
+        server_workers=args.workers,
+        server_access_log=None,
+    )
+    google = GoogleStandIn(args.google_latency)
+    thingsboard = ThingsBoardStandIn(args.thingsboard_latency)
+    rlgl.get_geolocate = lambda: google.geolocate
+    rlgl.get_tbapi = lambda: thingsboard
+
+    if args.production:
+        from redlight_greenlight.server import serve as serve_production
+        serve_production(rlgl.app, rlgl.CFG, post_fork=rlgl.post_fork)
+    else:
+        from werkzeug.serving import make_server
+        make_server("127.0.0.1", args.port, rlgl.app, threaded=True).serve_forever()
+
+
+# ---------------------------------------------------------------------------
+# Client side
+
+class Device:
+    def __init__(self, n, rng, version, images):
+        self.mac = "5C:CF:7F:{:02X}:{:02X}:{:02X}".format(n >> 16 & 0xFF, n >> 8 & 0xFF, n & 0xFF)
+        self.token = "token-Birdhouse {:03d}".format(n)
+        self.position = (FLEET_CENTER[0] + rng.uniform(-0.01, 0.01), FLEET_CENTER[1] + rng.uniform(-0.01, 0.01))
+        self.hotspots = random_hotspots(rng)
+        self.install(version, images)
+
+    def install(self, version, images):
+        self.version = version
+        self.sketch_md5 = hashlib.md5(images[version]).hexdigest()
+        self.sketch_size = len(images[version])
+
+    def update_headers(self):
+        return {
+            "User-Agent": "ESP8266-http-Update",
+            "x-ESP8266-STA-MAC": self.mac,
+            "x-ESP8266-AP-MAC": self.mac,
+            "x-ESP8266-free-space": "2818048",
+            "x-ESP8266-sketch-size": str(self.sketch_size),
+            "x-ESP8266-sketch-md5": self.sketch_md5,
+            "x-ESP8266-chip-size": "4194304",
+            "x-ESP8266-sdk-version": "2.2.1(cfd48f3)",
+            "x-ESP8266-mode": "sketch",
+            "x-ESP8266-version": self.version,
+        }
+
+    def wifi_report(self, rng):
+        hotspots = [dict(ap, signalStrength=ap["signalStrength"] + rng.randint(-3, 3)) for ap in self.hotspots]
+        return {"device_token": self.token, "latitude": self.position[0], "longitude": self.position[1],
+                "visibleHotspots": hotspots}
+
+
+def random_hotspots(rng, count=8):
+    return [{"macAddress": ":".join("{:02X}".format(rng.randrange(256)) for _ in range(6)),
+             "signalStrength": rng.randint(-90, -40), "age": 0, "channel": rng.choice([1, 6, 11]),
+             "signalToNoiseRatio": 0} for _ in range(count)]
+
+
+def build_fleet_folder(workdir, args, rng):
+    """Writes --versions firmware images; returns {version: image bytes}, oldest first."""
+    folder = os.path.join(workdir, "firmware")
+    os.makedirs(folder)
+    images = {}
+    for minor in range(args.versions):
+        version = "1.{}".format(minor)
+        images[version] = rng.getrandbits(8 * args.image_size).to_bytes(args.image_size, "little")
+        with open(os.path.join(folder, version + ".bin"), "wb") as f:
+            f.write(images[version])
+    return images
+
+
+def run_device(device, port, args, images, deadline, seed, samples):
+    rng = random.Random(seed)
+    latest = list(images)[-1]
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+
+    while time.monotonic() < deadline:
+        roll = rng.random()
+        if roll < args.firmware_ratio:
+            route, method, path, body, headers = "/firmware", "GET", "/firmware", None, {}
+        elif roll < args.firmware_ratio + args.wifi_ratio:
+            if rng.random() < args.moving:
+                device.hotspots = random_hotspots(rng)
+            route, method, path = "/wifi_location", "POST", "/wifi_location"
+            body = json.dumps(device.wifi_report(rng))
+            headers = {"Content-Type": "application/json"}
+        else:
+            route, method, path, body, headers = "/update", "GET", "/update", None, device.update_headers()
+
+        start = time.perf_counter()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            resp = conn.getresponse()
+            nbytes = len(resp.read())
+            status = resp.status
+        except (OSError, http.client.HTTPException):
+            status, nbytes = "error", 0
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+        samples.append((route, status, time.perf_counter() - start, nbytes))
+
+        # A device that received an image reboots into it
+        if route == "/update" and status == 200:
+            device.install(latest, images)
+
+        if args.interval:
+            time.sleep(args.interval)
+    conn.close()
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(port, proc, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            sys.exit("server exited with code {}".format(proc.returncode))
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    sys.exit("server didn't start listening within {} seconds".format(timeout))
+
+
+def peak_child_rss_mib():
+    # ru_maxrss of the largest child process we've waited for: kilobytes on Linux, bytes on macOS
+    try:
+        import resource
+    except ImportError:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(samples, elapsed):
+    by_route = {}
+    for route, status, seconds, nbytes in samples:
+        by_route.setdefault(route, []).append((status, seconds, nbytes))
+    by_route["total"] = [(status, seconds, nbytes) for _, status, seconds, nbytes in samples]
+
+    summary = {}
+    for route, rows in by_route.items():
+        latencies = sorted(seconds for _, seconds, _ in rows)
+        statuses = {}
+        for status, _, _ in rows:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        summary[route] = dict(
+            requests=len(rows),
+            per_second=len(rows) / elapsed,
+            p50_ms=percentile(latencies, 0.50) * 1000,
+            p95_ms=percentile(latencies, 0.95) * 1000,
+            p99_ms=percentile(latencies, 0.99) * 1000,
+            megabytes=sum(nbytes for _, _, nbytes in rows) / 1e6,
+            statuses=statuses,
+        )
+    return summary
+
+
+def main():
+    args = parse_args()
+    if args.serve:
+        return serve(args)
+
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory(prefix="rlgl-fleet-") as workdir:
+        images = build_fleet_folder(workdir, args, rng)
+        versions = list(images)
+        devices = [Device(n, rng, versions[0] if rng.random() < args.outdated else versions[-1], images)
+                   for n in range(args.clients)]
+
+        port = free_port()
+        server_args = [sys.executable, os.path.abspath(__file__), "--serve", workdir, "--port", str(port),
+                       "--workers", str(args.workers),
+                       "--google-latency", str(args.google_latency),
+                       "--thingsboard-latency", str(args.thingsboard_latency)]
+        if args.production:
+            server_args.append("--production")
+        proc = subprocess.Popen(server_args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_for_server(port, proc)
+            print("{} devices against {} for {:.0f} s (Google {:.0f} ms, ThingsBoard {:.0f} ms)...".format(
+                args.clients, "gunicorn x {}".format(args.workers) if args.production else "werkzeug",
+                args.duration, args.google_latency * 1000, args.thingsboard_latency * 1000))
+
+            samples = []    # list.append is atomic, so the device threads share one list
+            start = time.monotonic()
+            deadline = start + args.duration
+            threads = [threading.Thread(target=run_device, args=(device, port, args, images, deadline, rng.random(), samples))
+                       for device in devices]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.monotonic() - start
+        finally:
+            proc.terminate()
+            proc.wait()
+
+    summary = summarize(samples, elapsed)
+    rss = peak_child_rss_mib()
+
+    print("\n{:15} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9}  statuses".format("route", "requests", "req/s", "p50 ms", "p95 ms", "p99 ms", "MB"))
+    for route in sorted(summary, key=lambda route: (route == "total", route)):
+        row = summary[route]
+        print("{:15} {:9d} {:9.1f} {:9.1f} {:9.1f} {:9.1f} {:9.1f}  {}".format(
+            route, row['requests'], row['per_second'], row['p50_ms'], row['p95_ms'], row['p99_ms'], row['megabytes'],
+            " ".join("{}:{}".format(status, count) for status, count in sorted(row['statuses'].items()))))
+    if rss is not None:
+        print("\npeak server RSS: {:.1f} MiB (largest server process)".format(rss))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(dict(args={key: value for key, value in vars(args).items() if key not in ('serve', 'port', 'json')},
+                           routes=summary, peak_rss_mib=rss), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""Measures how long it takes to import redlight_greenlight in a fresh interpreter.
+
+Every worker spawn, test run and CLI start pays this cost. Each run uses a new
+subprocess so nothing is cached between them:
+
+    python benchmarks/import_time.py [--runs 10] [--top 15]
+"""
+
+import argparse
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+
+MODULE = "redlight_greenlight.redlight_greenlight"
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_once():
+    # -X importtime writes one line per imported module to stderr: "import time: self | cumulative | name"
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')])))
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + MODULE],
+                          env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    # Nested imports are indented by two more spaces than their importer and are listed before it
+    modules = []
+    for line in proc.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \|( *)(\S+)", line)
+        if match:
+            modules.append((match.group(3), int(match.group(1)) / 1000, len(match.group(2))))
+    return modules
+
+
+def direct_imports(modules, name):
+    """Returns (cumulative ms, module) for each module imported directly by `name`."""
+    position = next(i for i, (module, _, _) in enumerate(modules) if module == name)
+    depth = modules[position][2]
+    children = []
+    for module, cumulative, module_depth in reversed(modules[:position]):
+        if module_depth <= depth:
+            break
+        if module_depth == depth + 2:
+            children.append((cumulative, module))
+    return sorted(children, reverse=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=15, help="number of slowest top-level imports to list")
+    args = parser.parse_args()
+
+    runs = [import_once() for _ in range(args.runs)]
+    totals = [next(cumulative for module, cumulative, _ in run if module == MODULE) for run in runs]
+    print("import {}: median {:.1f} ms, min {:.1f} ms, max {:.1f} ms over {} runs".format(
+        MODULE, statistics.median(totals), min(totals), max(totals), args.runs))
+
+    print("\nslowest direct imports in the last run (cumulative ms):")
+    for cumulative, module in direct_imports(runs[-1], MODULE)[:args.top]:
+        print("  {:8.1f}  {}".format(cumulative, module))
+
+
+if __name__ == "__main__":
+    main()
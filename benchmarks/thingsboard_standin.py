@@ -0,0 +1,515 @@
+"""A local stand-in for the ThingsBoard REST API, for benchmarking the scripts
+in management/ without touching production.
+
+It implements the subset of endpoints TbApi uses (login, devices and their
+credentials, customers, dashboards, attributes and telemetry), keeping all
+state in memory. Every response can be delayed and a fraction of them can
+fail, and each endpoint's calls are counted, so the round trips a script makes
+can be measured and compared:
+
+    python benchmarks/thingsboard_standin.py --port 8080 --devices 50 --latency 0.05
+    # point motherShipUrl at http://localhost:8080, run a script, then:
+    curl localhost:8080/_standin/stats
+
+/_standin/stats returns the call counts by endpoint; POST /_standin/reset
+clears them, and POST /_standin/config changes latency, jitter and
+failure_rate while the server runs.
+"""
+
+import argparse
+import random
+import threading
+import time
+import uuid
+
+from flask import Flask, jsonify, request
+
+
+NULL_UUID = "13814000-1dd2-11b2-8080-808080808080"     # what ThingsBoard uses for "no customer"
+
+
+class Store:
+    """ThingsBoard's entities, in memory."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.devices = {}           # id -> device
+        self.tokens = {}            # device id -> access token
+        self.customers = {}         # id -> customer
+        self.dashboards = {}        # id -> dashboard, including its configuration
+        self.attributes = {}        # (entity type, id, scope) -> {key: (value, lastUpdateTs)}
+        self.telemetry = {}         # device id -> {key: [(ts, value), ...]}
+
+    def device_by_token(self, token):
+        for device_id, device_token in self.tokens.items():
+            if device_token == token:
+                return self.devices[device_id]
+        return None
+
+    def set_attributes(self, entity_type, entity_id, scope, values):
+        now = now_ms()
+        with self.lock:
+            attributes = self.attributes.setdefault((entity_type, entity_id, scope), {})
+            for key, value in values.items():
+                attributes[key] = (value, now)
+
+    def add_telemetry(self, device_id, payload):
+        # Devices send {"key": value, ...}, {"ts": ..., "values": {...}}, or a list of either
+        entries = payload if isinstance(payload, list) else [payload]
+        with self.lock:
+            series = self.telemetry.setdefault(device_id, {})
+            for entry in entries:
+                ts, values = (entry["ts"], entry["values"]) if "values" in entry else (now_ms(), entry)
+                for key, value in values.items():
+                    series.setdefault(key, []).append((ts, value))
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+def entity_ref(entity_type, id_):
+    return {"entityType": entity_type, "id": id_}
+
+
+def new_device(name, device_type="default", label=None):
+    return {"id": entity_ref("DEVICE", str(uuid.uuid4())), "createdTime": now_ms(), "tenantId": entity_ref("TENANT", NULL_UUID),
+            "customerId": entity_ref("CUSTOMER", NULL_UUID), "name": name, "type": device_type, "label": label,
+            "additionalInfo": None}
+
+
+def page_of(items, key):
+    """Filters and pages a list the way ThingsBoard does, for both the old
+    `limit` and the newer `pageSize`/`page` listing parameters."""
+    text_search = request.args.get("textSearch")
+    if text_search:
+        items = [item for item in items if item[key].lower().startswith(text_search.lower())]
+    items = sorted(items, key=lambda item: item[key])
+
+    if "pageSize" in request.args:
+        page_size = int(request.args["pageSize"])
+        page = int(request.args.get("page", 0))
+        data = items[page * page_size:(page + 1) * page_size]
+        total_pages = (len(items) + page_size - 1) // page_size
+        return jsonify(data=data, totalPages=total_pages, totalElements=len(items), hasNext=page + 1 < total_pages)
+
+    limit = int(request.args.get("limit", 100))
+    return jsonify(data=items[:limit], nextPageLink=None, hasNext=len(items) > limit)
+
+
+def not_found(what):
+    return jsonify(status=404, message="{} not found".format(what), errorCode=32), 404
+
+
+def attribute_list(attributes, keys=None):
+    return [{"key": key, "value": value, "lastUpdateTs": ts} for key, (value, ts) in sorted(attributes.items())
+            if keys is None or key in keys]
+
+
+def requested_keys():
+    keys = request.args.get("keys")
+    return keys.split(",") if keys else None
+
+
+def create_app(latency=0.0, jitter=0.0, failure_rate=0.0, devices=0, seed=None):
+    app = Flask(__name__)
+    store = app.store = Store()
+    settings = app.standin_settings = dict(latency=latency, jitter=jitter, failure_rate=failure_rate)
+    calls = {}
+    calls_lock = threading.Lock()
+    rng = random.Random(seed)
+
+    @app.before_request
+    def simulate_upstream():
+        if request.path.startswith("/_standin/"):
+            return None
+
+        endpoint = "{} {}".format(request.method, request.url_rule.rule if request.url_rule is not None else request.path)
+        with calls_lock:
+            calls[endpoint] = calls.get(endpoint, 0) + 1
+
+        delay = settings["latency"] + rng.uniform(0, settings["jitter"])
+        if delay > 0:
+            time.sleep(delay)
+        if rng.random() < settings["failure_rate"]:
+            return jsonify(status=500, message="Injected failure", errorCode=2), 500
+
+        if not request.path.startswith(("/api/auth/login", "/api/v1/")) and "X-Authorization" not in request.headers:
+            return jsonify(status=401, message="Authentication failed", errorCode=10), 401
+        return None
+
+    # --- stand-in control ---
+
+    @app.route("/_standin/stats", methods=["GET"])
+    def standin_stats():
+        with calls_lock:
+            counts = dict(calls)
+        return jsonify(calls=counts, total=sum(counts.values()), settings=settings)
+
+    @app.route("/_standin/reset", methods=["POST"])
+    def standin_reset():
+        with calls_lock:
+            calls.clear()
+        return jsonify(ok=True)
+
+    @app.route("/_standin/config", methods=["POST"])
+    def standin_config():
+        for key, value in (request.get_json(silent=True) or {}).items():
+            if key in settings:
+                settings[key] = float(value)
+        return jsonify(settings)
+
+    # --- auth ---
+
+    @app.route("/api/auth/login", methods=["POST"])
+    def login():
+        return jsonify(token="standin." + uuid.uuid4().hex, refreshToken="standin." + uuid.uuid4().hex)
+
+    @app.route("/api/auth/token", methods=["POST"])
+    def refresh_token():
+        return login()
+
+    # --- devices ---
+
+    @app.route("/api/tenant/devices", methods=["GET"])
+    def tenant_devices():
+        with store.lock:
+            devices = list(store.devices.values())
+        if "deviceName" in request.args:
+            device = next((d for d in devices if d["name"] == request.args["deviceName"]), None)
+            return jsonify(device) if device else not_found("Device")
+        if "type" in request.args:
+            devices = [d for d in devices if d["type"] == request.args["type"]]
+        return page_of(devices, "name")
+
+    @app.route("/api/device", methods=["POST"])
+    def save_device():
+        body = request.get_json(force=True)
+        with store.lock:
+            if body.get("id"):
+                device = store.devices.get(body["id"]["id"])
+                if device is None:
+                    return not_found("Device")
+                device.update({key: value for key, value in body.items() if key not in ("id", "createdTime")})
+            else:
+                device = new_device(body["name"], body.get("type", "default"), body.get("label"))
+                device["additionalInfo"] = body.get("additionalInfo")
+                store.devices[device["id"]["id"]] = device
+                store.tokens[device["id"]["id"]] = request.args.get("accessToken") or uuid.uuid4().hex[:20]
+        return jsonify(device)
+
+    @app.route("/api/device/<device_id>", methods=["GET"])
+    def get_device(device_id):
+        with store.lock:
+            device = store.devices.get(device_id)
+        return jsonify(device) if device else not_found("Device")
+
+    @app.route("/api/device/<device_id>", methods=["DELETE"])
+    def delete_device(device_id):
+        with store.lock:
+            if store.devices.pop(device_id, None) is None:
+                return not_found("Device")
+            store.tokens.pop(device_id, None)
+            store.telemetry.pop(device_id, None)
+            for key in [key for key in store.attributes if key[:2] == ("DEVICE", device_id)]:
+                del store.attributes[key]
+        return "", 200
+
+    @app.route("/api/device/<device_id>/credentials", methods=["GET"])
+    def device_credentials(device_id):
+        with store.lock:
+            token = store.tokens.get(device_id)
+        if token is None:
+            return not_found("Device credentials")
+        return jsonify(id=entity_ref("DEVICE_CREDENTIALS", device_id), deviceId=entity_ref("DEVICE", device_id),
+                       credentialsType="ACCESS_TOKEN", credentialsId=token, credentialsValue=None)
+
+    @app.route("/api/customer/<customer_id>/devices", methods=["GET"])
+    def customer_devices(customer_id):
+        with store.lock:
+            devices = [d for d in store.devices.values() if d["customerId"]["id"] == customer_id]
+        return page_of(devices, "name")
+
+    @app.route("/api/customer/<customer_id>/device/<device_id>", methods=["POST"])
+    def assign_device(customer_id, device_id):
+        with store.lock:
+            device = store.devices.get(device_id)
+            if device is None:
+                return not_found("Device")
+            if customer_id == "public":
+                customer_id = public_customer()["id"]["id"]
+            device["customerId"] = entity_ref("CUSTOMER", customer_id)
+        return jsonify(device)
+
+    @app.route("/api/customer/device/<device_id>", methods=["DELETE"])
+    def unassign_device(device_id):
+        with store.lock:
+            device = store.devices.get(device_id)
+            if device is None:
+                return not_found("Device")
+            device["customerId"] = entity_ref("CUSTOMER", NULL_UUID)
+        return jsonify(device)
+
+    # --- customers ---
+
+    def public_customer():
+        for customer in store.customers.values():
+            if customer.get("additionalInfo") and customer["additionalInfo"].get("isPublic"):
+                return customer
+        customer = new_customer({"title": "Public", "additionalInfo": {"isPublic": True}})
+        store.customers[customer["id"]["id"]] = customer
+        return customer
+
+    def new_customer(body):
+        customer = {"id": entity_ref("CUSTOMER", str(uuid.uuid4())), "createdTime": now_ms(), "tenantId": entity_ref("TENANT", NULL_UUID)}
+        customer.update({key: body.get(key) for key in ("title", "address", "address2", "city", "state", "zip", "country",
+                                                         "email", "phone", "additionalInfo")})
+        customer["name"] = customer["title"]
+        return customer
+
+    @app.route("/api/customers", methods=["GET"])
+    def customers():
+        with store.lock:
+            return page_of(list(store.customers.values()), "title")
+
+    @app.route("/api/tenant/customers", methods=["GET"])
+    def customer_by_title():
+        title = request.args.get("customerTitle")
+        with store.lock:
+            customer = next((c for c in store.customers.values() if c["title"] == title), None)
+        return jsonify(customer) if customer else not_found("Customer")
+
+    @app.route("/api/customer/<customer_id>", methods=["GET"])
+    def get_customer(customer_id):
+        with store.lock:
+            customer = public_customer() if customer_id == "public" else store.customers.get(customer_id)
+        return jsonify(customer) if customer else not_found("Customer")
+
+    @app.route("/api/customer", methods=["POST"])
+    def save_customer():
+        body = request.get_json(force=True)
+        with store.lock:
+            if body.get("id"):
+                customer = store.customers.get(body["id"]["id"])
+                if customer is None:
+                    return not_found("Customer")
+                customer.update({key: value for key, value in body.items() if key not in ("id", "createdTime")})
+                customer["name"] = customer["title"]
+            else:
+                customer = new_customer(body)
+                store.customers[customer["id"]["id"]] = customer
+        return jsonify(customer)
+
+    @app.route("/api/customer/<customer_id>", methods=["DELETE"])
+    def delete_customer(customer_id):
+        with store.lock:
+            if store.customers.pop(customer_id, None) is None:
+                return not_found("Customer")
+        return "", 200
+
+    # --- dashboards ---
+
+    def dashboard_info(dashboard):
+        return {key: value for key, value in dashboard.items() if key != "configuration"}
+
+    @app.route("/api/tenant/dashboards", methods=["GET"])
+    def tenant_dashboards():
+        with store.lock:
+            return page_of([dashboard_info(d) for d in store.dashboards.values()], "title")
+
+    @app.route("/api/customer/<customer_id>/dashboards", methods=["GET"])
+    def customer_dashboards(customer_id):
+        with store.lock:
+            dashboards = [dashboard_info(d) for d in store.dashboards.values()
+                          if any(c["customerId"]["id"] == customer_id for c in d["assignedCustomers"] or [])]
+        return page_of(dashboards, "title")
+
+    @app.route("/api/dashboard/<dashboard_id>", methods=["GET"])
+    def get_dashboard(dashboard_id):
+        with store.lock:
+            dashboard = store.dashboards.get(dashboard_id)
+        return jsonify(dashboard) if dashboard else not_found("Dashboard")
+
+    @app.route("/api/dashboard/info/<dashboard_id>", methods=["GET"])
+    def get_dashboard_info(dashboard_id):
+        with store.lock:
+            dashboard = store.dashboards.get(dashboard_id)
+        return jsonify(dashboard_info(dashboard)) if dashboard else not_found("Dashboard")
+
+    @app.route("/api/dashboard", methods=["POST"])
+    def save_dashboard():
+        body = request.get_json(force=True)
+        with store.lock:
+            if body.get("id"):
+                dashboard = store.dashboards.get(body["id"]["id"])
+                if dashboard is None:
+                    return not_found("Dashboard")
+                dashboard.update({key: value for key, value in body.items() if key not in ("id", "createdTime")})
+            else:
+                dashboard = {"id": entity_ref("DASHBOARD", str(uuid.uuid4())), "createdTime": now_ms(),
+                             "tenantId": entity_ref("TENANT", NULL_UUID), "assignedCustomers": None, "configuration": None}
+                dashboard.update({key: value for key, value in body.items() if key not in ("id", "createdTime")})
+                store.dashboards[dashboard["id"]["id"]] = dashboard
+            dashboard["name"] = dashboard.get("title")
+        return jsonify(dashboard)
+
+    @app.route("/api/dashboard/<dashboard_id>", methods=["DELETE"])
+    def delete_dashboard(dashboard_id):
+        with store.lock:
+            if store.dashboards.pop(dashboard_id, None) is None:
+                return not_found("Dashboard")
+        return "", 200
+
+    @app.route("/api/customer/<customer_id>/dashboard/<dashboard_id>", methods=["POST", "DELETE"])
+    def assign_dashboard(customer_id, dashboard_id):
+        with store.lock:
+            dashboard = store.dashboards.get(dashboard_id)
+            customer = public_customer() if customer_id == "public" else store.customers.get(customer_id)
+            if dashboard is None or customer is None:
+                return not_found("Dashboard" if dashboard is None else "Customer")
+            assigned = [c for c in dashboard["assignedCustomers"] or [] if c["customerId"]["id"] != customer["id"]["id"]]
+            if request.method == "POST":
+                assigned.append({"customerId": customer["id"], "title": customer["title"],
+                                 "public": bool((customer.get("additionalInfo") or {}).get("isPublic"))})
+            dashboard["assignedCustomers"] = assigned or None
+        return jsonify(dashboard_info(dashboard))
+
+    # --- attributes ---
+
+    @app.route("/api/plugins/telemetry/<entity_type>/<entity_id>/values/attributes/<scope>", methods=["GET"])
+    def get_attributes(entity_type, entity_id, scope):
+        with store.lock:
+            attributes = dict(store.attributes.get((entity_type, entity_id, scope), {}))
+        return jsonify(attribute_list(attributes, requested_keys()))
+
+    @app.route("/api/plugins/telemetry/<entity_type>/<entity_id>/values/attributes", methods=["GET"])
+    def get_all_attributes(entity_type, entity_id):
+        result = []
+        with store.lock:
+            for scope in ("CLIENT_SCOPE", "SHARED_SCOPE", "SERVER_SCOPE"):
+                result += attribute_list(store.attributes.get((entity_type, entity_id, scope), {}), requested_keys())
+        return jsonify(result)
+
+    @app.route("/api/plugins/telemetry/<entity_type>/<entity_id>/keys/attributes/<scope>", methods=["GET"])
+    def attribute_keys(entity_type, entity_id, scope):
+        with store.lock:
+            return jsonify(sorted(store.attributes.get((entity_type, entity_id, scope), {})))
+
+    @app.route("/api/plugins/telemetry/<entity_type>/<entity_id>/<scope>", methods=["POST"])
+    @app.route("/api/plugins/telemetry/<entity_type>/<entity_id>/attributes/<scope>", methods=["POST"])
+    def set_attributes(entity_type, entity_id, scope):
+        store.set_attributes(entity_type, entity_id, scope, request.get_json(force=True))
+        return "", 200
+
+    @app.route("/api/plugins/telemetry/<entity_type>/<entity_id>/<scope>", methods=["DELETE"])
+    def delete_attributes(entity_type, entity_id, scope):
+        with store.lock:
+            attributes = store.attributes.get((entity_type, entity_id, scope), {})
+            for key in requested_keys() or []:
+                attributes.pop(key, None)
+        return "", 200
+
+    # --- telemetry ---
+
+    @app.route("/api/v1/<token>/telemetry", methods=["POST"])
+    def device_telemetry(token):
+        with store.lock:
+            device = store.device_by_token(token)
+        if device is None:
+            return "", 401
+        store.add_telemetry(device["id"]["id"], request.get_json(force=True))
+        return "", 200
+
+    @app.route("/api/v1/<token>/attributes", methods=["POST"])
+    def device_attributes(token):
+        with store.lock:
+            device = store.device_by_token(token)
+        if device is None:
+            return "", 401
+        store.set_attributes("DEVICE", device["id"]["id"], "CLIENT_SCOPE", request.get_json(force=True))
+        return "", 200
+
+    @app.route("/api/plugins/telemetry/<entity_type>/<entity_id>/keys/timeseries", methods=["GET"])
+    def telemetry_keys(entity_type, entity_id):
+        with store.lock:
+            return jsonify(sorted(store.telemetry.get(entity_id, {})))
+
+    @app.route("/api/plugins/telemetry/<entity_type>/<entity_id>/values/timeseries", methods=["GET"])
+    def get_telemetry(entity_type, entity_id):
+        with store.lock:
+            series = {key: list(values) for key, values in store.telemetry.get(entity_id, {}).items()}
+        keys = requested_keys() or list(series)
+        limit = int(request.args.get("limit", 100))
+        result = {}
+        for key in keys:
+            values = series.get(key, [])
+            if "startTs" in request.args:
+                start, end = int(request.args["startTs"]), int(request.args.get("endTs", now_ms()))
+                values = [(ts, value) for ts, value in values if start <= ts <= end]
+                values = sorted(values, reverse=True)[:limit]
+            else:
+                values = sorted(values)[-1:]       # latest value only
+            if values:
+                result[key] = [{"ts": ts, "value": str(value)} for ts, value in values]
+        return jsonify(result)
+
+    @app.route("/api/plugins/telemetry/<entity_type>/<entity_id>/timeseries/delete", methods=["DELETE"])
+    def delete_telemetry(entity_type, entity_id):
+        delete_all = request.args.get("deleteAllDataForKeys") == "true"
+        start, end = int(request.args.get("startTs", 0)), int(request.args.get("endTs", now_ms()))
+        with store.lock:
+            series = store.telemetry.get(entity_id, {})
+            for key in requested_keys() or []:
+                if delete_all:
+                    series.pop(key, None)
+                elif key in series:
+                    series[key] = [(ts, value) for ts, value in series[key] if not start <= ts <= end]
+        return "", 200
+
+    seed_fleet(store, devices, rng)
+    return app
+
+
+def seed_fleet(store, count, rng):
+    # Devices named like the real fleet, each with a customer, a dashboard and the usual server attributes
+    for n in range(1, count + 1):
+        name = "Birdhouse {:03d}".format(n)
+        device = new_device(name, "Birdhouse")
+        device_id = device["id"]["id"]
+        store.devices[device_id] = device
+        store.tokens[device_id] = uuid.UUID(int=rng.getrandbits(128)).hex[:20]
+
+        customer = {"id": entity_ref("CUSTOMER", str(uuid.uuid4())), "createdTime": now_ms(), "title": name, "name": name,
+                    "address": "{} SE Main St".format(n), "address2": None, "city": "Portland", "state": "OR",
+                    "zip": "97214", "country": "USA", "email": None, "phone": None, "additionalInfo": None}
+        store.customers[customer["id"]["id"]] = customer
+        device["customerId"] = customer["id"]
+
+        dashboard = {"id": entity_ref("DASHBOARD", str(uuid.uuid4())), "createdTime": now_ms(), "title": name, "name": name,
+                     "configuration": {"widgets": {}, "entityAliases": {}},
+                     "assignedCustomers": [{"customerId": customer["id"], "title": name, "public": False}]}
+        store.dashboards[dashboard["id"]["id"]] = dashboard
+
+        store.set_attributes("DEVICE", device_id, "SERVER_SCOPE", {
+            "latitude": 45.5 + rng.uniform(-0.05, 0.05), "longitude": -122.65 + rng.uniform(-0.05, 0.05),
+            "DeviceStatus": "Deployed", "address": customer["address"], "city": "Portland", "state": "OR",
+        })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--devices', type=int, default=0, help="create this many Birdhouse devices, with customers and dashboards")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every response")
+    parser.add_argument('--jitter', type=float, default=0.0, help="up to this many more seconds, chosen at random")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="fraction of requests that fail with a 500")
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    app = create_app(latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate, devices=args.devices, seed=args.seed)
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == "__main__":
+    main()
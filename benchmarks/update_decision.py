@@ -0,0 +1,61 @@
+"""Times the /update firmware decision without HTTP, Flask or disk reads.
+
+Measures VersionIndex.newest_after() on its own (pure in-memory work), then
+FirmwareIndex.latest() over a temporary folder of images, which adds the
+stat() calls that check whether the folder has changed:
+
+    python benchmarks/update_decision.py [--versions 200] [--lookups 100000] [--pinned]
+"""
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from redlight_greenlight.firmware_index import FirmwareIndex      # noqa: E402
+from redlight_greenlight.firmware_versions import VersionIndex    # noqa: E402
+
+
+def timed(fn, currents):
+    started = time.perf_counter()
+    for current in currents:
+        fn(current)
+    return (time.perf_counter() - started) / len(currents)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--versions', type=int, default=200, help="firmware images in the folder")
+    parser.add_argument('--lookups', type=int, default=100000)
+    parser.add_argument('--pinned', action='store_true', help="pin the folder to its oldest version")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    versions = [(0, minor) for minor in range(1, args.versions + 1)]
+    currents = [rng.choice(versions) for _ in range(args.lookups)]
+    settings = dict(pinned="0.1") if args.pinned else {}
+
+    releases = VersionIndex([version + ("/fw/0.{}.bin".format(version[1]),) for version in versions], settings)
+    print("VersionIndex.newest_after:  {:8.0f} ns/lookup".format(timed(releases.newest_after, currents) * 1e9))
+
+    with tempfile.TemporaryDirectory() as folder:
+        for _, minor in versions:
+            with open(os.path.join(folder, "firmware_0.{}.bin".format(minor)), "wb") as image:
+                image.write(b"x")
+        if args.pinned:
+            with open(os.path.join(folder, "firmware.toml"), "w") as toml_file:
+                toml_file.write('pinned = "0.1"\n')
+        index = FirmwareIndex(folder)
+        index.latest(folder)
+        time.sleep(2.1)     # let the folder age out of the racy window, so lookups don't rescan it
+        print("FirmwareIndex.latest:       {:8.0f} ns/lookup ({} scans)".format(
+            timed(lambda current: index.latest(folder, *current), currents) * 1e9, index.scans))
+
+
+if __name__ == "__main__":
+    main()
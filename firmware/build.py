@@ -17,6 +17,7 @@ Options:
  """
 
 import re, os, sys
+import hashlib
 from docopt import docopt       # pip install docopt
 import subprocess
 
@@ -128,15 +129,24 @@ def binary_too_big(output):
 
 def upload(source_file, source_file_with_version, build_target, remote_dir, devices):
 
+    # The image is uploaded once into the server's content-addressed store (see redlight_greenlight/firmware_store.py);
+    # firmware folders only get a symlink to it
+    digest = sha256_of_file(build_target)
+    store_dir = remote_dir + "/.store"
+    stored_image = digest + ".bin"
+
+    print("Uploading " + build_target + " to " + store_dir + "/" + stored_image)
+    for output_line in execute('"' + winscp_program_location + '" "' + winscp_profile + '" /command "call mkdir -p ' + store_dir + '" "cd ' + store_dir + '" "put ' + build_target + ' ' + stored_image + '" "exit"'):
+        print(output_line, end="")
+
     if devices == "all":
-        print("Uploading " + build_target + " for all devices to " + remote_dir)
-        for output_line in execute('"' + winscp_program_location + '" "' + winscp_profile + '" /command "cd ' + remote_dir + '" "put ' + build_target + '" "exit"'):
+        print("Linking " + stored_image + " for all devices in " + remote_dir)
+        link_command = 'call ln -sfn .store/' + stored_image + ' ' + remote_dir + '/' + source_file_with_version
+        for output_line in execute('"' + winscp_program_location + '" "' + winscp_profile + '" /command "' + link_command + '" "exit"'):
             print(output_line, end="")
         return
         
-    print("Uploading " + build_target + " for devices: " + devices)
-
-    first = True
+    print("Linking " + stored_image + " for devices: " + devices)
 
     device_list = devices.replace(" ", "").split(",")
 
@@ -166,25 +176,23 @@ def upload(source_file, source_file_with_version, build_target, remote_dir, devi
             print("Couldn't find MAC address for device " + device_name)
             exit()
 
-        print("Uploading " + build_target + " for device " + device_name + " (MAC addr " + mac_address + ")")
+        print("Linking " + build_target + " for device " + device_name + " (MAC addr " + mac_address + ")")
 
         sanitized_device_name = device_name.replace(" ", "_")   # Strip spaces; makes life easier
         device_specific_remote_dir = remote_dir + "/" + sanitized_device_name + "_" + mac_address
         mkdir_command = 'call mkdir -p ' + device_specific_remote_dir
+        link_command = 'call ln -sfn ../.store/' + stored_image + ' ' + device_specific_remote_dir + '/' + source_file_with_version
 
-        if first:       # Upload a new file
-            remote_source_dir = device_specific_remote_dir
-
-            for output_line in execute('"' + winscp_program_location + '" "' + winscp_profile + '" /command "' + mkdir_command + '" "cd ' + device_specific_remote_dir + '" "put ' + build_target + '" "exit"'):
-                print(output_line, end="")
-
-            first = False
+        for output_line in execute('"' + winscp_program_location + '" "' + winscp_profile + '" /command "' + mkdir_command + '" "' + link_command + '" "exit"'):
+            print(output_line, end="")
 
-        else:           # Copy file we just uploaded, to reduce bandwidth and go faster
-            cp_command    = 'call cp ' + remote_source_dir + '/' + source_file_with_version + ' ' + device_specific_remote_dir + '/'
 
-            for output_line in execute('"' + winscp_program_location + '" "' + winscp_profile + '" /command "' + mkdir_command + '" "' + cp_command + '" "exit"'):
-                print(output_line, end="")
+def sha256_of_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
 
 
 def extract_version(source_file):
@@ -14,6 +14,7 @@ import re
 import sys
 import esptool
 import time
+import requests                             # pip install requests
 
 
 # These are IDs that are associated with NodeMCU boards
@@ -571,6 +572,33 @@ def get_base_url(args=None, config={}):
     return (args and args['--baseurl']) or config.base_url if 'base_url' in dir(config) else "www.sensorbot.org"
 
 
+def validate_device_tokens(validation_url, devices, tries=3, timeout=10, retry_delay=1):
+    """
+    Checks a batch of device tokens with a single request to redlight_greenlight's /validate_token endpoint.
+    devices is a list of (birdhouse_number, token) pairs; birdhouse names are accepted as well as numbers.
+    Returns a list with "true", "false", or "bad_device" for each device, in the same order.
+    Network errors and server errors are retried, waiting retry_delay seconds, then twice that, and so on.
+    """
+    payload = [{"name": make_device_name(number), "token": token} for number, token in devices]
+
+    while True:
+        tries -= 1
+        try:
+            resp = requests.post(validation_url, json=payload, timeout=timeout)
+            if resp.status_code == 200:
+                return resp.json()["results"]
+            error = f"server returned code {resp.status_code}"
+            if resp.status_code < 500:      # our request is wrong; asking again won't help
+                tries = 0
+        except requests.exceptions.RequestException as ex:
+            error = str(ex)
+
+        if tries <= 0:
+            raise Exception(f"Error validating device tokens; {error}")
+        time.sleep(retry_delay)
+        retry_delay *= 2
+
+
 DEVICE_STATUSES = ["Testing", "Deployed", "Offline", "Unknown"]
 
 def is_valid_status(status):
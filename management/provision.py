@@ -156,7 +156,7 @@ if thingsboard_only and settings.device_token is not None:
 base_url           = birdhouse_utils.get_base_url(args)
 mothership_url     = birdhouse_utils.make_mothership_url(args, config)
 firmware_url       = "http://" + base_url + ":8989/firmware"
-key_validation_url = "http://" + base_url + ":8989/validatekey"
+token_validation_url = "http://" + base_url + ":8989/validate_token"
 
 
 led_styles = [("Multicolor LED with 4 legs (typical Birdhouse)", "4PIN"), ("ESP8266 built-in LED (typical Bottlebot)", "BUILTIN_ONLY"), ("Separate R, Y, G LEDs", "RYG"),
@@ -326,36 +326,20 @@ def validate_device_token(birdhouse_number, token):
     if birdhouse_number is None or token is None:
         return False
 
-    device_name = birdhouse_utils.make_device_name(birdhouse_number)
-
     # Return whether the device token is valid
-    url = key_validation_url + "?name=" + device_name + "&key=" + token
-
-    tries = 3
-
-    while tries > 0:
-        resp = requests.get(url)
-
-        # Server should always return 200 regardless of whether the token is valid or not.
-        if resp.status_code == 200:
-            break
-
-        print(resp)
-
-        tries -= 1
-
-    if tries == 0:
-        print("\nError validating device token; server returned code " + str(resp.status_code))
+    try:
+        [validity] = birdhouse_utils.validate_device_tokens(token_validation_url, [(birdhouse_number, token)])
+    except Exception as ex:
+        print("\n" + str(ex))
         print("Aborting!")
         exit()
 
-    if resp.text == 'bad_device':
+    if validity == 'bad_device':
         print("\nThe device number you specified is unknown or invalid.")
         print("Aborting!")
         exit()
 
-
-    return resp.text == 'true'
+    return validity == 'true'
 
 
 def create_server_objects(tbapi, birdhouse_number):
@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import deque
+
+
+THROUGHPUT_WINDOW = 60  # seconds
+
+
+class AdmissionController:
+    """Caps the number of firmware transfers in flight, globally and per folder.
+
+    A caller that can't be admitted immediately may wait up to `max_wait`
+    seconds in a bounded queue of `max_waiting` callers; past that, acquire()
+    returns False and the caller should tell the device to retry later."""
+
+    def __init__(self, max_total, max_per_folder, max_wait=0, max_waiting=0):
+        self.max_total = max_total
+        self.max_per_folder = max_per_folder
+        self.max_wait = max_wait
+        self.max_waiting = max_waiting
+
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._per_folder = {}
+        self._waiting = 0
+        self._completed = deque()   # (finish time, bytes) within THROUGHPUT_WINDOW
+
+        self.admitted = 0
+        self.rejected = 0
+        self.bytes_sent = 0
+
+    def acquire(self, folder):
+        with self._cond:
+            if not self._has_room(folder):
+                if self._waiting >= self.max_waiting or self.max_wait <= 0:
+                    self.rejected += 1
+                    return False
+
+                self._waiting += 1
+                try:
+                    admitted = self._cond.wait_for(lambda: self._has_room(folder), timeout=self.max_wait)
+                finally:
+                    self._waiting -= 1
+
+                if not admitted:
+                    self.rejected += 1
+                    return False
+
+            self._in_flight += 1
+            self._per_folder[folder] = self._per_folder.get(folder, 0) + 1
+            self.admitted += 1
+            return True
+
+    def release(self, folder, nbytes=0):
+        now = time.monotonic()
+        with self._cond:
+            self._in_flight -= 1
+            remaining = self._per_folder[folder] - 1
+            if remaining:
+                self._per_folder[folder] = remaining
+            else:
+                del self._per_folder[folder]
+
+            self.bytes_sent += nbytes
+            self._completed.append((now, nbytes))
+            self._expire(now)
+            self._cond.notify_all()
+
+    def stats(self):
+        now = time.monotonic()
+        with self._cond:
+            self._expire(now)
+            return dict(
+                in_flight=self._in_flight,
+                queue_depth=self._waiting,
+                per_folder=dict(self._per_folder),
+                admitted=self.admitted,
+                rejected=self.rejected,
+                bytes_sent=self.bytes_sent,
+                transfers_per_minute=len(self._completed) * 60 / THROUGHPUT_WINDOW,
+                bytes_per_second=sum(nbytes for _, nbytes in self._completed) / THROUGHPUT_WINDOW,
+            )
+
+    def _has_room(self, folder):
+        return self._in_flight < self.max_total and self._per_folder.get(folder, 0) < self.max_per_folder
+
+    def _expire(self, now):
+        while self._completed and self._completed[0][0] < now - THROUGHPUT_WINDOW:
+            self._completed.popleft()
@@ -0,0 +1,108 @@
+import math
+import os
+import sqlite3
+import threading
+
+from redlight_greenlight.geolocation_cache import normalize_mac
+
+
+METERS_PER_DEGREE = 111320
+
+# Estimates are never reported as more precise than this
+MIN_ACCURACY = 25
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS access_points (
+    mac TEXT PRIMARY KEY,
+    lat_sum REAL NOT NULL,
+    lng_sum REAL NOT NULL,
+    weight_sum REAL NOT NULL,
+    observations INTEGER NOT NULL
+)
+"""
+
+UPSERT = """
+INSERT INTO access_points VALUES (?, ?, ?, ?, 1)
+ON CONFLICT(mac) DO UPDATE SET
+    lat_sum = lat_sum + excluded.lat_sum,
+    lng_sum = lng_sum + excluded.lng_sum,
+    weight_sum = weight_sum + excluded.weight_sum,
+    observations = observations + 1
+"""
+
+
+def rssi_weight(signal_strength):
+    # Received power in linear units (relative): a 20 dB stronger signal counts ten times as much
+    return 10 ** (signal_strength / 20)
+
+
+class AccessPointDatabase:
+    """Learns where Wi-Fi access points are from devices whose location we know,
+    and estimates the location of new hotspot reports from them.
+
+    Each access point's position is the RSSI-weighted centroid of the known
+    positions of the devices that reported it. A report is located by the
+    RSSI-weighted centroid of the access points it sees, if at least `min_aps`
+    of them are known."""
+
+    def __init__(self, path, min_aps=3):
+        self.path = path
+        self.min_aps = min_aps
+        self.estimates = 0
+        self.unknown = 0
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(SCHEMA)
+
+    def observe(self, hotspots, coord):
+        """Records that a device at coord (lat, lng) sees these hotspots."""
+        rows = []
+        for hotspot in hotspots:
+            if hotspot.get("macAddress"):
+                weight = rssi_weight(hotspot.get("signalStrength", -100))
+                rows.append((normalize_mac(hotspot["macAddress"]), coord[0] * weight, coord[1] * weight, weight))
+        with self._lock:
+            with self._db:
+                self._db.executemany(UPSERT, rows)
+
+    def estimate(self, hotspots):
+        """Returns ((lat, lng), accuracy in meters) for a hotspot report, or None
+        if too few of its access points are known."""
+        strengths = {normalize_mac(h["macAddress"]): h.get("signalStrength", -100) for h in hotspots if h.get("macAddress")}
+        if len(strengths) < self.min_aps:
+            self.unknown += 1
+            return None
+
+        with self._lock:
+            known = self._db.execute("SELECT mac, lat_sum / weight_sum, lng_sum / weight_sum FROM access_points WHERE mac IN ({})"
+                                     .format(",".join("?" * len(strengths))), list(strengths)).fetchall()
+        if len(known) < self.min_aps:
+            self.unknown += 1
+            return None
+
+        import numpy as np
+
+        positions = np.array([(lat, lng) for _, lat, lng in known])
+        weights = rssi_weight(np.array([strengths[mac] for mac, _, _ in known], dtype=float))
+        lat, lng = np.average(positions, axis=0, weights=weights)
+
+        # Accuracy: weighted RMS distance of the access points from the estimate (equirectangular approximation)
+        offsets = (positions - (lat, lng)) * METERS_PER_DEGREE
+        offsets[:, 1] *= math.cos(math.radians(lat))
+        spread = math.sqrt(np.average((offsets ** 2).sum(axis=1), weights=weights))
+
+        self.estimates += 1
+        return (float(lat), float(lng)), max(MIN_ACCURACY, spread)
+
+    def stats(self):
+        with self._lock:
+            access_points = self._db.execute("SELECT COUNT(*) FROM access_points").fetchone()[0]
+        return dict(access_points=access_points, estimates=self.estimates, unknown=self.unknown)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,138 @@
+import threading
+import time
+
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class UpstreamUnavailable(Exception):
+    """Raised instead of calling an upstream whose circuit is open, or that
+    already has as many calls in flight as it is allowed."""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Stops calling an upstream that keeps failing or answering slowly.
+
+    A call that raises, or that takes longer than `latency_budget` seconds,
+    counts as a failure.  After `failure_threshold` failures in a row the
+    circuit opens and calls are refused for `reset_timeout` seconds; then a
+    single probe call is let through (half-open), which closes the circuit if
+    it succeeds in time and reopens it otherwise.  At most `max_concurrent`
+    calls may be in flight at once, so a slow upstream can't tie up every
+    worker thread before the circuit has a chance to open.
+
+    If given, on_call(seconds, ok) is called after every call that was let
+    through, e.g. to record upstream latency."""
+
+    def __init__(self, name, failure_threshold=5, latency_budget=2.0, reset_timeout=30, max_concurrent=None, on_call=None):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.latency_budget = latency_budget
+        self.reset_timeout = reset_timeout
+        self.max_concurrent = max_concurrent
+        self.on_call = on_call
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+        self._in_flight = 0
+
+        self.calls = 0
+        self.failed = 0
+        self.slow = 0
+        self.rejected = 0
+        self.times_opened = 0
+
+    def call(self, fn, *args, **kwargs):
+        probe = self._admit()
+        start = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self._finish(probe, ok=False)
+            if self.on_call is not None:
+                self.on_call(time.monotonic() - start, False)
+            raise
+        elapsed = time.monotonic() - start
+        if elapsed > self.latency_budget:
+            with self._lock:
+                self.slow += 1
+        self._finish(probe, ok=elapsed <= self.latency_budget)
+        if self.on_call is not None:
+            self.on_call(elapsed, True)
+        return result
+
+    def _admit(self):
+        with self._lock:
+            probe = False
+            if self._state == OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    self.rejected += 1
+                    raise UpstreamUnavailable("{} is unavailable".format(self.name), self.retry_after())
+                self._state = HALF_OPEN
+
+            if self._state == HALF_OPEN:
+                if self._probing:
+                    self.rejected += 1
+                    raise UpstreamUnavailable("{} is unavailable".format(self.name), self.retry_after())
+                self._probing = probe = True
+
+            if self.max_concurrent is not None and self._in_flight >= self.max_concurrent:
+                if probe:
+                    self._probing = False
+                self.rejected += 1
+                raise UpstreamUnavailable("{} is busy".format(self.name), 1)
+
+            self._in_flight += 1
+            self.calls += 1
+            return probe
+
+    def _finish(self, probe, ok):
+        with self._lock:
+            self._in_flight -= 1
+            if probe:
+                self._probing = False
+            if ok:
+                self._failures = 0
+                if probe:
+                    self._state = CLOSED
+                return
+
+            self.failed += 1
+            self._failures += 1
+            if probe or (self._state == CLOSED and self._failures >= self.failure_threshold):
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+                self.times_opened += 1
+
+    def retry_after(self):
+        """Seconds until the circuit will next let a call through."""
+        if self._opened_at is None:
+            return 0
+        return max(0, int(self.reset_timeout - (time.monotonic() - self._opened_at) + 0.999))
+
+    @property
+    def state(self):
+        return self._state
+
+    def stats(self):
+        with self._lock:
+            return dict(
+                state=self._state,
+                consecutive_failures=self._failures,
+                in_flight=self._in_flight,
+                calls=self.calls,
+                failed=self.failed,
+                slow=self.slow,
+                rejected=self.rejected,
+                times_opened=self.times_opened,
+                retry_after=self.retry_after() if self._state != CLOSED else 0,
+            )
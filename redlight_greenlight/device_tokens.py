@@ -0,0 +1,175 @@
+import hmac
+import logging
+import threading
+import time
+from collections import namedtuple
+
+from redlight_greenlight.single_flight import SingleFlight
+from redlight_greenlight.ttl_cache import TTLCache
+
+
+log = logging.getLogger(__name__)
+
+Entry = namedtuple('Entry', 'device_id token fetched')
+
+
+class DeviceTokenIndex:
+    """Maps device names to their access tokens, so that checking a token is a
+    dictionary lookup rather than two ThingsBoard calls.
+
+    The index is loaded from the paginated device listing `list_devices(page,
+    page_size) -> (devices, has_next)` and reloaded every `ttl` seconds on a
+    background thread, started by the first lookup (or by start()).  Tokens of
+    devices already in the index are kept across reloads; a token that fails to
+    match is fetched again at most once every `negative_ttl` seconds, in case it
+    was regenerated.  Names the index doesn't know are looked up with
+    `get_device(name)` (the device may have just been provisioned), and names
+    that don't exist upstream are remembered for `negative_ttl` seconds.
+    Concurrent upstream lookups of the same name are collapsed into one."""
+
+    def __init__(self, list_devices, get_device, get_token, ttl=300, negative_ttl=60, page_size=100, background=True):
+        self.list_devices = list_devices
+        self.get_device = get_device
+        self.get_token = get_token
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.page_size = page_size
+        self.background = background
+
+        self._entries = {}
+        self._unknown = TTLCache(negative_ttl)
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self.flights = SingleFlight()
+
+        self.hits = 0
+        self.upstream_lookups = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+        self.last_refresh = None
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="device-tokens", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception as ex:
+                self.refresh_errors += 1
+                log.error("Error refreshing device tokens: %s", ex)
+            self._stop.wait(self.ttl)
+
+    def refresh(self):
+        """Reloads the index from the device listing. Devices that have gone
+        away upstream drop out of the index."""
+        entries = {}
+        page = 0
+        while True:
+            devices, has_next = self.list_devices(page, self.page_size)
+            for device in devices:
+                name = device["name"]
+                known = self._entries.get(name)
+                if known is not None and known.device_id == device.get("id"):
+                    entries[name] = known
+                else:
+                    entries[name] = Entry(device.get("id"), self.get_token(device), time.monotonic())
+            if not has_next:
+                break
+            page += 1
+
+        with self._lock:
+            self._entries = entries
+        for name in entries:
+            self._unknown.discard(name)
+        self.refreshes += 1
+        self.last_refresh = time.time()
+
+    def validate(self, name, token):
+        """Returns True if `token` is the access token of the device called
+        `name`, False if it isn't, and None if there is no such device."""
+        if self.background:
+            self.start()
+
+        entry = self._entries.get(name)
+        if entry is None:
+            if self._unknown.get(name):
+                return None
+            entry = self._fetch(name)
+            if entry is None:
+                return None
+        else:
+            self.hits += 1
+
+        if tokens_match(entry.token, token):
+            return True
+
+        # The device's token may have been regenerated since we fetched it; if we can't ask, trust the index
+        if time.monotonic() - entry.fetched >= self.negative_ttl:
+            try:
+                entry = self._fetch(name)
+            except Exception:
+                return False
+            return entry is not None and tokens_match(entry.token, token)
+        return False
+
+    def validate_many(self, pairs, workers=8):
+        """validate() for a list of (name, token) pairs. Names missing from the
+        index are looked up upstream concurrently, on up to `workers` threads."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        results = [None] * len(pairs)
+        misses = []
+        for i, (name, token) in enumerate(pairs):
+            if name in self._entries:
+                results[i] = self.validate(name, token)
+            else:
+                misses.append(i)
+
+        if misses:
+            with ThreadPoolExecutor(max_workers=min(len(misses), workers)) as executor:
+                for i, valid in zip(misses, executor.map(lambda i: self.validate(*pairs[i]), misses)):
+                    results[i] = valid
+        return results
+
+    def _fetch(self, name):
+        # Concurrent lookups of the same name wait for a single pair of upstream calls
+        return self.flights.do(name, self._fetch_upstream, name)
+
+    def _fetch_upstream(self, name):
+        self.upstream_lookups += 1
+        device = self.get_device(name)
+        if device is None:
+            self._unknown.put(name, True)
+            with self._lock:
+                self._entries.pop(name, None)
+            return None
+
+        entry = Entry(device.get("id") if isinstance(device, dict) else None, self.get_token(device), time.monotonic())
+        with self._lock:
+            self._entries[name] = entry
+        return entry
+
+    def stats(self):
+        return dict(
+            devices=len(self._entries),
+            unknown=len(self._unknown),
+            hits=self.hits,
+            upstream_lookups=self.upstream_lookups,
+            refreshes=self.refreshes,
+            refresh_errors=self.refresh_errors,
+            last_refresh=self.last_refresh,
+        )
+
+
+def tokens_match(expected, token):
+    # Constant-time, so response timing doesn't reveal how much of a guessed token is right
+    return expected is not None and hmac.compare_digest(expected.encode(), token.encode())
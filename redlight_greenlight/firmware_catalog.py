@@ -0,0 +1,136 @@
+import gzip
+import hashlib          # for md5
+import io
+import os
+import shutil
+import tempfile
+import threading
+from collections import namedtuple
+
+
+CHUNK_SIZE = 1024 * 1024
+
+Firmware = namedtuple('Firmware', 'path size mtime md5 data')
+
+
+class FirmwareCatalog:
+    """In-memory cache of firmware images and their MD5 digests.
+
+    Entries are keyed on (path, mtime, size): a lookup only costs a stat() as
+    long as the file on disk is unchanged, and the image is re-read and
+    re-hashed as soon as it is replaced. Callers that stream the file from
+    disk can pass with_data=False so that only the digest is kept."""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path, with_data=True):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            self.invalidate(path)
+            raise
+
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is not None and entry.mtime == st.st_mtime_ns and entry.size == st.st_size \
+                    and (entry.data is not None or not with_data):
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        entry = self._load(path, with_data)
+        with self._lock:
+            self._entries[path] = entry
+        return entry
+
+    def compressed(self, path, with_data=True):
+        """Returns the entry for path's gzip-compressed sibling (path + ".gz"),
+        writing it first if it is missing or was not made from the image now at
+        path. Links are resolved first, so an image shared through the firmware
+        store only gets one compressed copy."""
+        path = os.path.realpath(path)
+        gz_path = path + ".gz"
+        try:
+            fresh = compressed_from(gz_path, os.stat(path))
+        except FileNotFoundError:
+            fresh = False
+
+        if not fresh:
+            write_gzip(path, gz_path)
+        return self.get(gz_path, with_data)
+
+    def invalidate(self, path=None):
+        with self._lock:
+            if path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(path, None)
+
+    def stats(self):
+        with self._lock:
+            return dict(hits=self.hits, misses=self.misses, entries=len(self._entries),
+                        bytes=sum(len(entry.data) for entry in self._entries.values() if entry.data is not None))
+
+    @staticmethod
+    def _load(path, with_data):
+        # Take mtime and size from the open file so they describe the bytes we actually read
+        md5 = hashlib.md5()
+        chunks = []
+        size = 0
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                md5.update(chunk)
+                size += len(chunk)
+                if with_data:
+                    chunks.append(chunk)
+        data = b"".join(chunks) if with_data else None
+        return Firmware(path, size, st.st_mtime_ns, md5.hexdigest(), data)
+
+
+def compressed_from(gz_path, st):
+    """True if gz_path was written by write_gzip() from the image that st
+    describes: the compressed copy carries the image's exact mtime, and the
+    gzip trailer records its size (modulo 2**32)."""
+    with open(gz_path, 'rb') as gz:
+        if os.fstat(gz.fileno()).st_mtime_ns != st.st_mtime_ns:
+            return False
+        gz.seek(-4, os.SEEK_END)
+        return int.from_bytes(gz.read(4), 'little') == st.st_size & 0xffffffff
+
+
+def write_gzip(path, gz_path):
+    # Written to a temp file and renamed so readers never see a partial image. The gzip header's
+    # timestamp is zeroed so the output (and its MD5) only depends on the image's contents, and
+    # the file itself gets the image's mtime so compressed_from() can tell which image it came from.
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(gz_path), prefix=".", suffix=".gz.tmp")
+    try:
+        with open(path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            st = os.fstat(src.fileno())
+            with gzip.GzipFile(filename="", mode='wb', compresslevel=9, fileobj=dst, mtime=0) as gz:
+                shutil.copyfileobj(src, gz, CHUNK_SIZE)
+        os.utime(tmp_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp_path, gz_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+class FirmwareFile(io.FileIO):
+    """Unbuffered firmware file that calls on_close once it has been closed.
+
+    Being a real file, it can still be handed to sendfile() by the WSGI server;
+    the callback tells the caller when the server has finished with it."""
+
+    def __init__(self, path, on_close):
+        super().__init__(path, 'rb')
+        self._on_close = on_close
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            self._on_close()
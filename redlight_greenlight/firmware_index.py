@@ -0,0 +1,179 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+
+import toml
+
+from redlight_greenlight.firmware_versions import VersionIndex, parse_version
+
+
+log = logging.getLogger(__name__)
+
+FIRMWARE_FILENAME = re.compile(r"(\d+\.\d+)\.bin$")
+
+# Optional per-folder settings, e.g. `gzip = true` to always serve the compressed image, or the
+# pinned and blocked versions described in firmware_versions.VersionIndex
+FOLDER_SETTINGS = "firmware.toml"
+
+# Device folders are named SOME_READABLE_PREFIX + underscore + MAC_ADDRESS
+DEVICE_FOLDER_MAC = re.compile(r"_([0-9A-F]{2}(?::[0-9A-F]{2}){5})")
+
+# A directory modified this close to when we scanned it may change again without its mtime
+# moving (timestamps are coarse on many filesystems), so it is rescanned until it settles
+RACY_WINDOW_NS = 2 * 10**9
+
+
+_Snapshot = namedtuple('_Snapshot', 'stamp racy contents')
+
+Folder = namedtuple('Folder', 'versions settings releases')
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+
+
+def _root_stamp(root):
+    mtime = _mtime(root)
+    return None if mtime is None else (mtime,)
+
+
+def _folder_stamp(folder):
+    # The settings file can be edited in place without touching the folder's mtime, so it is checked too
+    mtime = _mtime(folder)
+    return None if mtime is None else (mtime, _mtime(os.path.join(folder, FOLDER_SETTINGS)))
+
+
+def _is_stale(snapshot, stamp):
+    return snapshot is None or snapshot.racy or snapshot.stamp != stamp
+
+
+def _take_snapshot(path, scan, stamp):
+    started = time.time_ns()
+    mtimes = stamp(path)
+    if mtimes is None:
+        return _Snapshot(None, False, None)
+    newest = max(mtime for mtime in mtimes if mtime is not None)
+    return _Snapshot(mtimes, newest >= started - RACY_WINDOW_NS, scan(path))
+
+
+def _scan_root(root):
+    devices = {}
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                for mac in DEVICE_FOLDER_MAC.findall(entry.name):
+                    devices.setdefault(mac, []).append(entry.path)
+    return devices
+
+
+def _read_settings(folder):
+    try:
+        return toml.load(os.path.join(folder, FOLDER_SETTINGS))
+    except FileNotFoundError:
+        return {}
+    except (toml.TomlDecodeError, OSError) as ex:
+        log.error("Ignoring unreadable %s in %s: %s", FOLDER_SETTINGS, folder, ex)
+        return {}
+
+
+def _scan_folder(folder):
+    versions = []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            candidate = FIRMWARE_FILENAME.search(entry.name)
+            if candidate:
+                versions.append(parse_version(candidate.group(1)) + (entry.path,))
+    versions.sort()
+    settings = _read_settings(folder)
+    return Folder(versions, settings, VersionIndex(versions, settings, folder))
+
+
+class FirmwareIndex:
+    """Persistent index of the firmware images folder.
+
+    Maps each MAC address to its device folder(s) and each folder to a sorted
+    list of (major, minor, path) and the VersionIndex that picks which of them
+    to serve. Directories are only rescanned when their
+    mtime changes, so a lookup normally costs one stat() of the root folder and
+    one of the device folder instead of a full directory walk. `generation` is
+    bumped whenever a rescan finds different contents, and on_new_image, if
+    given, is called with the path of each image the index hasn't seen before."""
+
+    def __init__(self, root, on_new_image=None):
+        self.root = str(root)
+        self.on_new_image = on_new_image
+        self.generation = 0
+        self.scans = 0
+        self._lock = threading.Lock()
+        self._root = None
+        self._folders = {}
+
+    def device_folders(self, mac_address):
+        """Returns every subfolder dedicated to the device with this MAC address."""
+        with self._lock:
+            self._refresh_root()
+            devices = self._root.contents or {}
+            return list(devices.get(mac_address.upper(), []))
+
+    def versions(self, folder):
+        """Returns the sorted (major, minor, path) list for folder, or None if it is not a folder."""
+        contents = self._folder(folder)
+        return contents and contents.versions
+
+    def releases(self, folder):
+        """Returns the VersionIndex for folder, or None if it is not a folder."""
+        contents = self._folder(folder)
+        return contents and contents.releases
+
+    def settings(self, folder):
+        """Returns the settings from folder's firmware.toml, or an empty dict."""
+        contents = self._folder(folder)
+        return contents.settings if contents else {}
+
+    def _folder(self, folder):
+        folder = str(folder)
+        new_images = ()
+        with self._lock:
+            snapshot = self._folders.get(folder)
+            if _is_stale(snapshot, _folder_stamp(folder)):
+                previous = snapshot
+                snapshot = self._take(folder, _scan_folder, _folder_stamp, snapshot)
+                self._folders[folder] = snapshot
+                if snapshot.contents:
+                    seen = {path for _, _, path in previous.contents.versions} if previous and previous.contents else set()
+                    new_images = [path for _, _, path in snapshot.contents.versions if path not in seen]
+
+        # Called outside the lock, as the callback may do real work (e.g. compress the image)
+        if self.on_new_image:
+            for path in new_images:
+                self.on_new_image(path)
+        return snapshot.contents
+
+    def latest(self, folder, current_major=0, current_minor=0):
+        """Returns the path of the image in folder that a device running
+        current_major.current_minor should be sent, or None; normally the newest
+        image, if it is newer (see VersionIndex.newest_after)."""
+        releases = self.releases(folder)
+        return releases.newest_after((current_major, current_minor)) if releases else None
+
+    def _refresh_root(self):
+        if not _is_stale(self._root, _root_stamp(self.root)):
+            return
+        self._root = self._take(self.root, _scan_root, _root_stamp, self._root)
+
+        # Forget folders that no longer exist so the index doesn't grow without bound
+        known = {folder for folders in (self._root.contents or {}).values() for folder in folders}
+        self._folders = {folder: snapshot for folder, snapshot in self._folders.items() if folder == self.root or folder in known}
+
+    def _take(self, path, scan, stamp, previous):
+        snapshot = _take_snapshot(path, scan, stamp)
+        self.scans += 1
+        if previous is None or previous.contents != snapshot.contents:
+            self.generation += 1
+        return snapshot
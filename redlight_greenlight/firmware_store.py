@@ -0,0 +1,108 @@
+"""Content-addressed storage for firmware images.
+
+Each distinct image is stored once as <store>/<sha256>.bin; device folders hold
+relative symlinks to it instead of their own copies. Run as a script to move
+the images in an existing firmware folder tree into the store:
+
+    python -m redlight_greenlight.firmware_store /sensorbot/firmware_images
+"""
+
+import argparse
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+
+
+DIGEST = re.compile(r"[0-9a-f]{64}")
+CHUNK_SIZE = 1024 * 1024
+
+
+def sha256_of(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FirmwareStore:
+    def __init__(self, folder):
+        self.folder = os.path.realpath(str(folder))
+
+    def path_for(self, digest):
+        """Returns where the image with this SHA-256 lives, or None if digest isn't a well-formed hash."""
+        if not DIGEST.fullmatch(digest):
+            return None
+        return os.path.join(self.folder, digest + ".bin")
+
+    def digest_of(self, path):
+        """Returns the SHA-256 of path if it is (or links to) an image in the store, without reading it."""
+        real_path = os.path.realpath(path)
+        if os.path.dirname(real_path) != self.folder:
+            return None
+        digest, ext = os.path.splitext(os.path.basename(real_path))
+        return digest if ext == ".bin" and DIGEST.fullmatch(digest) else None
+
+    def add(self, src_path):
+        """Copies src_path into the store unless an identical image is already there; returns its digest."""
+        digest = sha256_of(src_path)
+        dest_path = self.path_for(digest)
+        if not os.path.exists(dest_path):
+            os.makedirs(self.folder, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.folder, prefix=".", suffix=".tmp")
+            try:
+                with open(src_path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+                os.chmod(tmp_path, 0o444)
+                os.replace(tmp_path, dest_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        return digest
+
+    def link(self, digest, link_path):
+        """Points link_path at the stored image, replacing whatever is there."""
+        target = os.path.relpath(self.path_for(digest), os.path.dirname(os.path.abspath(link_path)))
+        tmp_path = link_path + ".tmp"
+        if os.path.lexists(tmp_path):
+            os.unlink(tmp_path)
+        os.symlink(target, tmp_path)
+        os.replace(tmp_path, link_path)
+
+    def import_file(self, path):
+        """Moves the image at path into the store and leaves a link in its place."""
+        digest = self.digest_of(path)
+        if digest:
+            return digest
+        digest = self.add(path)
+        self.link(digest, path)
+        return digest
+
+
+def import_tree(images_folder, store):
+    # Compressed siblings (.bin.gz) are left alone; they are regenerated next to the stored image on demand
+    imported = 0
+    for dirpath, dirnames, filenames in os.walk(images_folder):
+        dirnames[:] = [d for d in dirnames if os.path.join(os.path.realpath(dirpath), d) != store.folder]
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            if filename.endswith(".bin") and not os.path.islink(path):
+                print("{} -> {}".format(path, store.import_file(path)))
+                imported += 1
+    return imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Move firmware images into the content-addressed store.")
+    parser.add_argument('images_folder', help="the firmware_images_folder served by redlight_greenlight")
+    parser.add_argument('--store', help="store location (default: <images_folder>/.store)")
+    args = parser.parse_args()
+
+    store = FirmwareStore(args.store or os.path.join(args.images_folder, ".store"))
+    print("Imported {} images".format(import_tree(args.images_folder, store)))
+
+
+if __name__ == "__main__":
+    main()
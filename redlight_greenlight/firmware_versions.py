@@ -0,0 +1,97 @@
+import bisect
+import logging
+import re
+
+
+log = logging.getLogger(__name__)
+
+# Versions are MAJOR.MINOR, and each part is compared as an integer. So 0.120 is
+# newer than 0.12, and 0.012 is the same version as 0.12.
+VERSION = re.compile(r"(\d+)\.(\d+)")
+
+
+def parse_version(text):
+    """Returns (major, minor) for the first MAJOR.MINOR in text, or None.  The
+    same rules apply to the version a device reports, to image file names and to
+    the versions in firmware.toml."""
+    if not isinstance(text, str):
+        return None
+    match = VERSION.search(text)
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def format_version(version):
+    return "{}.{}".format(*version)
+
+
+class VersionIndex:
+    """The images in one firmware folder, sorted by version, plus the folder's
+    release settings from firmware.toml:
+
+        pinned = "0.120"             # serve exactly this version, even if it is older than what a device runs
+        blocked = ["0.121", "0.122"] # never serve these
+
+    Versions must be quoted, since TOML would read 0.120 as the number 0.12.
+    A device running a blocked version is offered the newest version that
+    isn't blocked, even if that version is older.  If the pinned version has
+    no image, nothing is served, so devices stay on the version they run."""
+
+    def __init__(self, versions, settings=None, folder=""):
+        settings = settings or {}
+        self.blocked = frozenset(self._setting_versions(settings.get('blocked', []), 'blocked', folder))
+        pinned = self._setting_versions([settings['pinned']], 'pinned', folder) if 'pinned' in settings else []
+        self.pinned = pinned[0] if pinned else None
+
+        self.keys = []      # sorted (major, minor), one per version
+        self.paths = []
+        for major, minor, path in sorted(versions):
+            key = (major, minor)
+            if self.keys and self.keys[-1] == key:
+                log.warning("Ignoring %s: same version as %s", path, self.paths[-1])
+                continue
+            if key not in self.blocked:
+                self.keys.append(key)
+                self.paths.append(path)
+
+        self.pinned_path = self.path(self.pinned) if self.pinned is not None else None
+        if self.pinned is not None and self.pinned_path is None:
+            log.error("Pinned version %s has no image in %s; not serving updates from it", format_version(self.pinned), folder)
+
+    @staticmethod
+    def _setting_versions(values, name, folder):
+        if isinstance(values, str):
+            values = [values]
+        versions = []
+        for value in values:
+            version = parse_version(value)
+            if version is None:
+                log.error("Ignoring %s version %r in %s; write versions as quoted strings", name, value, folder)
+            else:
+                versions.append(version)
+        return versions
+
+    def path(self, version):
+        """Returns the path of the image for exactly this (major, minor), or None."""
+        i = bisect.bisect_left(self.keys, version)
+        return self.paths[i] if i < len(self.keys) and self.keys[i] == version else None
+
+    def newest(self):
+        return self.paths[-1] if self.paths else None
+
+    def newest_after(self, current):
+        """Returns the path of the image a device running `current` (major, minor)
+        should be sent, or None if it should keep what it runs."""
+        if self.pinned is not None:
+            return None if current == self.pinned else self.pinned_path
+        if current in self.blocked:
+            return self.newest()
+        if bisect.bisect_right(self.keys, current) < len(self.keys):
+            return self.paths[-1]
+        return None
+
+    def __eq__(self, other):
+        return isinstance(other, VersionIndex) and (self.keys, self.paths, self.pinned, self.blocked) == \
+            (other.keys, other.paths, other.pinned, other.blocked)
+
+    def __len__(self):
+        return len(self.keys)
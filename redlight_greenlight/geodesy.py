@@ -0,0 +1,70 @@
+# WGS-84 ellipsoid, as used by GPS and by geopy
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = WGS84_A * (1 - WGS84_F)
+
+EARTH_RADIUS = 6371008.8    # mean radius, for the haversine fallback
+
+MAX_ITERATIONS = 200
+TOLERANCE = 1e-12
+
+
+def distances(origins, destinations):
+    """Returns the geodesic distance in meters between each pair of
+    (lat, lng) points in `origins` and `destinations`, computed for all pairs
+    at once with Vincenty's inverse formula.
+
+    Pairs for which the iteration doesn't converge (nearly antipodal points)
+    fall back to the haversine distance."""
+    import numpy as np
+
+    origins = np.radians(np.asarray(origins, dtype=float).reshape(-1, 2))
+    destinations = np.radians(np.asarray(destinations, dtype=float).reshape(-1, 2))
+    lat1, lng1 = origins[:, 0], origins[:, 1]
+    lat2, lng2 = destinations[:, 0], destinations[:, 1]
+
+    f = WGS84_F
+    L = lng2 - lng1
+    U1 = np.arctan((1 - f) * np.tan(lat1))
+    U2 = np.arctan((1 - f) * np.tan(lat2))
+    sinU1, cosU1 = np.sin(U1), np.cos(U1)
+    sinU2, cosU2 = np.sin(U2), np.cos(U2)
+
+    lam = L.copy()
+    converged = np.zeros(len(L), dtype=bool)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(MAX_ITERATIONS):
+            sin_lam, cos_lam = np.sin(lam), np.cos(lam)
+            sin_sigma = np.hypot(cosU2 * sin_lam, cosU1 * sinU2 - sinU1 * cosU2 * cos_lam)
+            cos_sigma = sinU1 * sinU2 + cosU1 * cosU2 * cos_lam
+            sigma = np.arctan2(sin_sigma, cos_sigma)
+            sin_alpha = np.where(sin_sigma == 0, 0.0, cosU1 * cosU2 * sin_lam / sin_sigma)
+            cos2_alpha = 1 - sin_alpha ** 2
+            # cos2_alpha is 0 only for points on the equator
+            cos_2sigma_m = np.where(cos2_alpha == 0, 0.0, cos_sigma - 2 * sinU1 * sinU2 / cos2_alpha)
+            C = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+            lam_prev = lam
+            lam = L + (1 - C) * f * sin_alpha * (sigma + C * sin_sigma * (cos_2sigma_m + C * cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)))
+            converged = np.abs(lam - lam_prev) < TOLERANCE
+            if converged.all():
+                break
+
+        u2 = cos2_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+        A = 1 + u2 / 16384 * (4096 + u2 * (-768 + u2 * (320 - 175 * u2)))
+        B = u2 / 1024 * (256 + u2 * (-128 + u2 * (74 - 47 * u2)))
+        delta_sigma = B * sin_sigma * (cos_2sigma_m + B / 4 * (cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+                                                               - B / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)))
+        meters = WGS84_B * A * (sigma - delta_sigma)
+
+    fallback = ~converged | ~np.isfinite(meters)
+    if fallback.any():
+        meters[fallback] = haversine(lat1[fallback], lng1[fallback], lat2[fallback], lng2[fallback])
+    return meters
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    # Great-circle distance in meters on a spherical earth; arguments in radians
+    import numpy as np
+
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
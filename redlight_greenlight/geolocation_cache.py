@@ -0,0 +1,99 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+
+# How many of the strongest access points identify a location. Weak, distant APs come and go
+# between reports, so they are left out of the fingerprint.
+FINGERPRINT_APS = 6
+
+# Reading an entry only refreshes its LRU timestamp if it is older than this, to avoid a write per hit
+TOUCH_INTERVAL = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS geolocations (
+    fingerprint TEXT PRIMARY KEY,
+    lat REAL NOT NULL,
+    lng REAL NOT NULL,
+    accuracy REAL NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL
+)
+"""
+
+
+def normalize_mac(mac):
+    return mac.strip().upper().replace("-", ":")
+
+
+def hotspot_fingerprint(hotspots, strongest=FINGERPRINT_APS):
+    """Returns a canonical key for a hotspot report: a digest of the MAC
+    addresses of its strongest access points, in sorted order. Returns None if
+    the report has no usable access points."""
+    ranked = sorted((h for h in hotspots if h.get("macAddress")), key=lambda h: h.get("signalStrength", -100), reverse=True)
+    macs = sorted({normalize_mac(h["macAddress"]) for h in ranked[:strongest]})
+    if not macs:
+        return None
+    return hashlib.sha1(",".join(macs).encode()).hexdigest()
+
+
+class GeolocationCache:
+    """Disk-backed cache of geolocation results keyed by hotspot fingerprint.
+
+    Entries expire `ttl` seconds after they were stored, and the least recently
+    used ones are evicted once there are more than `max_entries`. The database
+    can be shared by several worker processes."""
+
+    def __init__(self, path, ttl=7 * 24 * 3600, max_entries=100000):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(SCHEMA)
+
+    def get(self, fingerprint):
+        """Returns ((lat, lng), accuracy) for fingerprint, or None."""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT lat, lng, accuracy, last_used FROM geolocations WHERE fingerprint = ? AND created > ?",
+                                   (fingerprint, now - self.ttl)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if row[3] < now - TOUCH_INTERVAL:
+                self._db.execute("UPDATE geolocations SET last_used = ? WHERE fingerprint = ?", (now, fingerprint))
+        return (row[0], row[1]), row[2]
+
+    def put(self, fingerprint, coord, accuracy):
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO geolocations VALUES (?, ?, ?, ?, ?, ?)",
+                             (fingerprint, coord[0], coord[1], accuracy, now, now))
+            # Only called after a (much slower) Google lookup, so evicting on every put is cheap enough
+            self._evict(now)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return dict(hits=self.hits, misses=self.misses, hit_ratio=self.hits / lookups if lookups else None)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _evict(self, now):
+        self._db.execute("DELETE FROM geolocations WHERE created <= ?", (now - self.ttl,))
+        excess = self._db.execute("SELECT COUNT(*) FROM geolocations").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self._db.execute("DELETE FROM geolocations WHERE fingerprint IN "
+                             "(SELECT fingerprint FROM geolocations ORDER BY last_used LIMIT ?)", (excess,))
@@ -0,0 +1,69 @@
+import threading
+from collections import OrderedDict, namedtuple
+
+from redlight_greenlight.geolocation_cache import normalize_mac
+
+
+Tracked = namedtuple('Tracked', 'weights total known_coord gmaps_coord gmaps_acc result')
+
+
+def signal_weights(hotspots):
+    # Map dBm (roughly -100 weak .. -30 strong) onto a positive weight, so strong APs count for more
+    weights = {}
+    for hotspot in hotspots:
+        if hotspot.get("macAddress"):
+            weights[normalize_mac(hotspot["macAddress"])] = max(1, 100 + hotspot.get("signalStrength", -99))
+    return weights
+
+
+def similarity(previous, previous_total, current):
+    """Weighted Jaccard similarity of two {mac: weight} maps: 1.0 for identical
+    reports, 0.0 when no access point is shared. Access points that appear,
+    disappear or change strength all lower the score."""
+    shared_min = shared_max = 0
+    for mac, weight in current.items():
+        before = previous.get(mac, 0)
+        shared_min += min(before, weight)
+        shared_max += max(before, weight)
+    # APs only in the previous report add their full weight to the union
+    union = shared_max + previous_total - sum(previous[mac] for mac in current if mac in previous)
+    return shared_min / union if union else 1.0
+
+
+class HotspotTracker:
+    """Remembers, per device, the hotspots it reported the last time it was
+    geolocated and the result of that lookup. A new report whose similarity to
+    the remembered one is at least `threshold` means the device hasn't moved,
+    so the remembered result can be reused."""
+
+    def __init__(self, threshold=0.8, max_devices=10000):
+        self.threshold = threshold
+        self.max_devices = max_devices
+        self.unchanged = 0
+        self.changed = 0
+        self._devices = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, device, hotspots):
+        """Returns the Tracked entry for device if hotspots match what it reported before, otherwise None."""
+        weights = signal_weights(hotspots)
+        with self._lock:
+            tracked = self._devices.get(device)
+            if tracked is None or not weights or similarity(tracked.weights, tracked.total, weights) < self.threshold:
+                self.changed += 1
+                return None
+            self._devices.move_to_end(device)
+            self.unchanged += 1
+            return tracked
+
+    def remember(self, device, hotspots, known_coord, gmaps_coord, gmaps_acc, result):
+        # The reference set is only replaced after a real lookup, so slow drift still adds up to a "moved"
+        weights = signal_weights(hotspots)
+        with self._lock:
+            self._devices[device] = Tracked(weights, sum(weights.values()), known_coord, gmaps_coord, gmaps_acc, result)
+            self._devices.move_to_end(device)
+            while len(self._devices) > self.max_devices:
+                self._devices.popitem(last=False)
+
+    def stats(self):
+        return dict(devices=len(self._devices), unchanged=self.unchanged, changed=self.changed)
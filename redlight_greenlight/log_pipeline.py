@@ -0,0 +1,221 @@
+"""Structured, non-blocking logging for redlight_greenlight.
+
+Request threads only put records on a bounded in-memory queue; a background
+thread formats them and does the writing, so a slow disk or terminal never
+holds up a request.  If the queue is full, records are dropped and counted
+rather than waited for.  The server calls start() when it starts and after
+each fork, so the log file is open before the first request; otherwise the
+first record starts the writer.  Settings come from the TOML config:
+
+    log_level = "INFO"
+    log_format = "text"            # or "json": one object per line
+    log_file = "/var/log/rlgl/rlgl-{pid}.log"    # omit to log to stdout
+    log_rotation = "size"          # or "external", for logrotate (reopens the file when it is moved)
+    log_max_bytes = 10485760       # with size rotation
+    log_backups = 5
+    log_queue_size = 10000
+    log_sample_rate = 1.0          # fraction of chatty messages kept...
+    log_sample_rates = { "/update" = 0.01 }     # ...or per route
+
+`{pid}` in log_file gives each gunicorn worker its own file; size rotation of
+one file shared by several processes is not safe.
+
+Log with the standard logging module; keyword fields go in `extra`, and chatty
+per-request messages are marked with sampled():
+
+    log.info("Birdhouse already running %s", path, extra=sampled(mac=mac))
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+
+
+LOGGER = "redlight_greenlight"
+
+_STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "sampled"}
+
+
+def sampled(**fields):
+    """`extra` for chatty messages: fields, plus a flag that makes the message
+    subject to per-route sampling."""
+    return dict(fields, sampled=True)
+
+
+def record_fields(record):
+    return {key: value for key, value in vars(record).items() if key not in _STANDARD_ATTRS}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = dict(ts=time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + ".{:03d}Z".format(int(record.msecs)),
+                     level=record.levelname, logger=record.name, message=record.getMessage())
+        entry.update(record_fields(record))
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        fields = record_fields(record)
+        if fields:
+            line += " " + " ".join("{}={}".format(key, value) for key, value in sorted(fields.items()))
+        return line
+
+
+class RequestContext(logging.Filter):
+    # Tags records logged while handling a request with its route
+    def filter(self, record):
+        if not hasattr(record, "route"):
+            from flask import has_request_context, request
+            if has_request_context():
+                record.route = request.url_rule.rule if request.url_rule is not None else request.path
+        return True
+
+
+class RouteSampler(logging.Filter):
+    """Keeps a random `rate` of the records marked by sampled(), per route.
+    Kept records carry the rate they were sampled at."""
+
+    def __init__(self, rate=1.0, route_rates=None):
+        super().__init__()
+        self.rate = rate
+        self.route_rates = route_rates or {}
+        self.dropped = 0
+
+    def filter(self, record):
+        if not getattr(record, "sampled", False):
+            return True
+        rate = self.route_rates.get(getattr(record, "route", None), self.rate)
+        if rate >= 1:
+            return True
+        if random.random() < rate:
+            record.sample_rate = rate
+            return True
+        self.dropped += 1
+        return False
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, pipeline):
+        super().__init__(None)
+        self.pipeline = pipeline
+
+    def prepare(self, record):
+        # The stdlib formats the message here, on the logging thread, so the record can be pickled for
+        # another process; ours stays in this process, so formatting is left to the writer thread
+        return record
+
+    def enqueue(self, record):
+        self.pipeline.enqueue(record)
+
+
+class _QueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self):
+        # Stopping waits for room in a full queue rather than failing
+        self.queue.put(self._sentinel)
+
+
+class LogPipeline:
+    """Hands records to a background thread that writes them to the handlers
+    made by `make_handlers()`.  The thread and handlers are created by
+    start(), or by the first record if start() hasn't been called, so a
+    pipeline set up before a fork starts afresh in the child once
+    after_fork() has been called.  Records are tagged with their route and
+    sampled in the logging thread, before they are queued; the message is
+    only formatted by the writer, so don't change objects passed as
+    arguments after logging them."""
+
+    def __init__(self, make_handlers, max_queued=10000, sampler=None):
+        self.make_handlers = make_handlers
+        self.max_queued = max_queued
+        self.sampler = sampler or RouteSampler()
+        self.handler = _QueueHandler(self)
+        self.handler.addFilter(RequestContext())
+        self.handler.addFilter(self.sampler)
+
+        self._lock = threading.Lock()
+        self._queue = None
+        self._listener = None
+        self.dropped = 0
+
+    def enqueue(self, record):
+        if self._listener is None:
+            self.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        with self._lock:
+            if self._listener is None:
+                self._queue = queue.Queue(self.max_queued)
+                listener = _QueueListener(self._queue, *self.make_handlers(), respect_handler_level=True)
+                listener.start()
+                self._listener = listener
+
+    def stop(self):
+        """Writes out whatever is queued and closes the handlers."""
+        with self._lock:
+            listener, self._listener = self._listener, None
+        if listener is not None:
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+
+    def after_fork(self):
+        # The writer thread didn't survive the fork, and the queue's locks may have been held when it happened
+        self._lock = threading.Lock()
+        self._queue = None
+        self._listener = None
+
+    def stats(self):
+        return dict(queued=self._queue.qsize() if self._queue is not None else 0, dropped=self.dropped,
+                    sampled_out=self.sampler.dropped)
+
+
+def build_handlers(cfg):
+    formatter = JsonFormatter() if cfg.get('log_format', 'text') == 'json' else TextFormatter()
+    log_file = cfg.get('log_file')
+    if not log_file:
+        import sys
+        handler = logging.StreamHandler(sys.stdout)
+    else:
+        log_file = log_file.format(pid=os.getpid())
+        os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+        if cfg.get('log_rotation', 'size') == 'external':
+            handler = logging.handlers.WatchedFileHandler(log_file)
+        else:
+            handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=cfg.get('log_max_bytes', 10 * 1024 * 1024),
+                                                           backupCount=cfg.get('log_backups', 5))
+    handler.setFormatter(formatter)
+    return [handler]
+
+
+def configure(cfg):
+    """Routes everything logged under the redlight_greenlight logger through a
+    new LogPipeline, replacing any previous one. Returns the pipeline."""
+    logger = logging.getLogger(LOGGER)
+    for handler in list(logger.handlers):
+        if isinstance(handler, _QueueHandler):
+            logger.removeHandler(handler)
+            handler.pipeline.stop()
+
+    pipeline = LogPipeline(lambda: build_handlers(cfg), max_queued=cfg.get('log_queue_size', 10000),
+                           sampler=RouteSampler(cfg.get('log_sample_rate', 1.0), cfg.get('log_sample_rates', {})))
+
+    logger.addHandler(pipeline.handler)
+    logger.setLevel(cfg.get('log_level', 'INFO'))
+    logger.propagate = False
+    atexit.register(pipeline.stop)
+    return pipeline
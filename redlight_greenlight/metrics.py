@@ -0,0 +1,238 @@
+import json
+import os
+import sys
+import threading
+import time
+
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class _Shard:
+    # One thread's share of the counters; only its own thread ever writes to it
+    def __init__(self, thread=None):
+        self.thread = thread
+        self.counters = {}      # (name, labels) -> value
+        self.histograms = {}    # (name, labels) -> [bucket counts..., +Inf count, sum]
+
+    def add(self, other):
+        # Copy first: the owning thread of `other` may add a key while we iterate
+        for key, value in list(other.counters.items()):
+            self.counters[key] = self.counters.get(key, 0) + value
+        for key, counts in list(other.histograms.items()):
+            total = self.histograms.setdefault(key, [0] * len(counts))
+            for i, count in enumerate(list(counts)):
+                total[i] += count
+
+
+class Metrics:
+    """Counters and latency histograms, exported in the Prometheus text format.
+
+    Every thread records into its own shard, so recording takes no lock and
+    threads never contend; render() adds the shards up, folding the shards of
+    threads that have exited into one.  Labels are passed as a tuple of
+    (name, value) pairs.
+
+    Several processes can share one set of metrics through `directory`. Each
+    process writes its totals there with publish(), and render() adds up
+    what every process last published.  Counters of processes that have
+    exited are kept, so totals never go backwards.  Gauges count only for
+    processes that are still running."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS, directory=None, publish_interval=5):
+        self.buckets = buckets
+        self.directory = directory
+        self.publish_interval = publish_interval
+        self._published = 0
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _Shard()          # everything recorded by threads that have since exited
+        self._lock = threading.Lock()    # only taken to register a new thread's shard, and by render()
+        self._help = {}
+        self._ratios = []
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def ratio(self, name, hits, misses, text):
+        """Renders `name` as hits / (hits + misses) for each set of labels,
+        computed from the totals, so it is right across processes too."""
+        self.describe(name, 'gauge', text)
+        self._ratios.append((name, hits, misses))
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = _Shard(threading.current_thread())
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def inc(self, name, labels=(), amount=1):
+        counters = self._shard().counters
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + amount
+
+    def observe(self, name, labels, seconds):
+        histograms = self._shard().histograms
+        key = (name, labels)
+        counts = histograms.get(key)
+        if counts is None:
+            counts = histograms[key] = [0] * (len(self.buckets) + 2)
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[len(self.buckets)] += 1
+        counts[-1] += seconds
+
+    def totals(self):
+        """Returns the counters and histograms summed over every thread."""
+        total = _Shard()
+        with self._lock:
+            live = []
+            for shard in self._shards:
+                if shard.thread.is_alive():
+                    live.append(shard)
+                else:
+                    self._retired.add(shard)
+            self._shards = live
+            total.add(self._retired)
+            for shard in live:
+                total.add(shard)
+        return total.counters, total.histograms
+
+    def publish(self, collected=()):
+        """Writes this process's totals and `collected` samples to `directory`."""
+        counters, histograms = self.totals()
+        state = dict(counters=[[name, labels, value] for (name, labels), value in counters.items()],
+                     histograms=[[name, labels, counts] for (name, labels), counts in histograms.items()],
+                     collected=[[name, labels, value] for name, labels, value in collected if value is not None])
+        path = os.path.join(self.directory, "{}.json".format(os.getpid()))
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(path + ".tmp", path)     # readers never see a half-written file
+        self._published = time.monotonic()
+
+    def publish_due(self):
+        return self.directory is not None and time.monotonic() - self._published >= self.publish_interval
+
+    def after_fork(self):
+        self._published = 0
+
+    def _kind(self, name):
+        return self._help.get(name, ('counter' if name.endswith('_total') else 'gauge', None))[0]
+
+    def _merged(self):
+        counters, histograms, collected = {}, {}, {}
+        for entry in os.scandir(self.directory):
+            pid, ext = os.path.splitext(entry.name)
+            if ext != ".json" or not pid.isdigit():
+                continue
+            try:
+                with open(entry.path) as f:
+                    state = json.load(f)
+            except (OSError, ValueError):    # removed, or from an older format
+                continue
+            running = _running(int(pid))
+            for name, labels, value in state['counters']:
+                if not running and self._kind(name) == 'gauge':     # e.g. requests in flight when it died
+                    continue
+                key = (name, _labels(labels))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, counts in state['histograms']:
+                total = histograms.setdefault((name, _labels(labels)), [0] * len(counts))
+                for i, count in enumerate(counts):
+                    total[i] += count
+            for name, labels, value in state['collected']:
+                if running or self._kind(name) == 'counter':
+                    key = (name, _labels(labels))
+                    collected[key] = collected.get(key, 0) + value
+        return counters, histograms, [(name, labels, value) for (name, labels), value in sorted(collected.items())]
+
+    def render(self, collected=()):
+        """Returns the Prometheus text exposition of everything recorded, plus
+        `collected`: (name, labels, value) samples read at scrape time, which
+        are gauges unless describe()d otherwise.  With a `directory`, this
+        process publishes first and the result covers every process."""
+        if self.directory is not None:
+            self.publish(collected)
+            counters, histograms, collected = self._merged()
+        else:
+            counters, histograms = self.totals()
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name in described:
+                return
+            described.add(name)
+            kind, text = self._help.get(name, (kind, None))
+            if text:
+                lines.append("# HELP {} {}".format(name, text))
+            lines.append("# TYPE {} {}".format(name, kind))
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, "counter")
+            lines.append(sample(name, labels, value))
+
+        for (name, labels), counts in sorted(histograms.items()):
+            header(name, "histogram")
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(sample(name + "_bucket", labels + (("le", repr(float(bound))),), cumulative))
+            cumulative += counts[len(self.buckets)]
+            lines.append(sample(name + "_bucket", labels + (("le", "+Inf"),), cumulative))
+            lines.append(sample(name + "_sum", labels, counts[-1]))
+            lines.append(sample(name + "_count", labels, cumulative))
+
+        values = {}
+        for name, labels, value in collected:
+            if value is None:
+                continue
+            values[(name, labels)] = value
+            header(name, "gauge")
+            lines.append(sample(name, labels, value))
+
+        for name, hits, misses in self._ratios:
+            for (metric, labels), hit_count in sorted({**counters, **values}.items()):
+                if metric != hits:
+                    continue
+                lookups = hit_count + values.get((misses, labels), counters.get((misses, labels), 0))
+                if lookups:
+                    header(name, "gauge")
+                    lines.append(sample(name, labels, hit_count / lookups))
+
+        return "\n".join(lines) + "\n"
+
+
+def _labels(pairs):
+    # JSON turns the (name, value) tuples into lists
+    return tuple((key, value) for key, value in pairs)
+
+
+def _running(pid):
+    if pid == os.getpid():
+        return True
+    if sys.platform == "win32":     # os.kill() would terminate the process; directories are for gunicorn, which needs POSIX
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def sample(name, labels, value):
+    if labels:
+        name += "{" + ",".join('{}="{}"'.format(key, escape(str(val))) for key, val in labels) + "}"
+    return "{} {}".format(name, value)
+
+
+def escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
@@ -1,16 +1,34 @@
 #!/usr/bin/env python
 
-from flask import Flask, request, Response
-from collections import namedtuple
-import googlemaps
-import geopy.distance
-import re
+from flask import Blueprint, Flask, g, request, Response
+from werkzeug.wsgi import wrap_file
 import os
-import hashlib          # for md5
+import argparse
+import logging
+import math
+import threading
 import toml
 import sys
+import time
+from collections import namedtuple
 
-from thingsboard_api_tools import TbApi # sudo pip install git+git://github.com/eykamp/thingsboard_api_tools.git --upgrade
+from redlight_greenlight.admission import AdmissionController
+from redlight_greenlight.ap_database import AccessPointDatabase
+from redlight_greenlight.circuit_breaker import CircuitBreaker, UpstreamUnavailable
+from redlight_greenlight.device_tokens import DeviceTokenIndex
+from redlight_greenlight.firmware_catalog import FirmwareCatalog, FirmwareFile
+from redlight_greenlight.firmware_index import FirmwareIndex
+from redlight_greenlight.firmware_store import FirmwareStore
+from redlight_greenlight.firmware_versions import parse_version
+from redlight_greenlight.geolocation_cache import GeolocationCache, hotspot_fingerprint
+from redlight_greenlight.hotspot_tracker import HotspotTracker
+from redlight_greenlight import log_pipeline
+from redlight_greenlight.log_pipeline import sampled
+from redlight_greenlight.metrics import Metrics
+from redlight_greenlight.request_profiler import RequestProfiler
+from redlight_greenlight.single_flight import SingleFlight
+from redlight_greenlight.ttl_cache import TTLCache
+from redlight_greenlight.worker_pool import WorkerPool
 
 
 def build_config_path(basename="birdhouse.cfg"):
@@ -33,6 +51,15 @@ firmware_images_folder = "fixme"
 """)
 
 
+def build_cache_path(basename):
+    if 'XDG_CACHE_HOME' in os.environ:
+        return os.path.join(os.environ['XDG_CACHE_HOME'], 'birdhouse', basename)
+    elif 'HOME' in os.environ:
+        return os.path.join(os.environ['HOME'], '.cache', 'birdhouse', basename)
+    elif 'USERPROFILE' in os.environ:  # Windows
+        return os.path.join(os.environ['USERPROFILE'], '.cache', 'birdhouse', basename)
+
+
 def load_config(configpath):
     try:
         CFG = toml.load(configpath)
@@ -45,146 +72,674 @@ def load_config(configpath):
 
 
 CFG = load_config(build_config_path())
-tbapi = TbApi(CFG['motherShipUrl'], CFG['username'], CFG['password'])
-app = Flask(__name__)
 
-
-def get_immediate_subdirectories(a_dir):
-    return [name for name in os.listdir(a_dir) if os.path.isdir(os.path.join(a_dir, name))]
+# Request threads only queue log records; a background thread writes them (see log_pipeline)
+logs = log_pipeline.configure(CFG)
+log = logging.getLogger(__name__)
+
+# Upstream clients are created on first use (see get_tbapi) so that importing this module, starting a
+# worker or running the tests doesn't log in to ThingsBoard or import the Google and geopy libraries
+tbapi = None
+gmaps_client = None
+geolocation_cache = None
+ap_database = None
+location_workers = None
+device_tokens = None
+clients_lock = threading.Lock()
+post_fork_hooks = []
+
+routes = Blueprint('redlight_greenlight', __name__)
+firmware_catalog = FirmwareCatalog()
+firmware_index = None
+firmware_store = None
+already_latest_cache = TTLCache(CFG.get('update_latest_cache_ttl', 60))
+hotspot_tracker = HotspotTracker(threshold=CFG.get('hotspot_similarity_threshold', 0.8))
+geolocate_flights = SingleFlight()
+
+metrics = Metrics()
+metrics.describe('rlgl_http_requests_in_flight', 'gauge', "Requests currently being handled")
+metrics.describe('rlgl_http_request_duration_seconds', 'histogram', "Time to handle a request, by route, method and status")
+metrics.describe('rlgl_upstream_duration_seconds', 'histogram', "Time taken by calls to Google and ThingsBoard")
+metrics.describe('rlgl_firmware_bytes_sent_total', 'counter', "Bytes of firmware sent to devices")
+metrics.describe('rlgl_ota_rejected_total', 'counter', "Firmware downloads turned away by admission control")
+metrics.describe('rlgl_cache_hits_total', 'counter', "Cache hits, by cache")
+metrics.describe('rlgl_cache_misses_total', 'counter', "Cache misses, by cache")
+metrics.ratio('rlgl_cache_hit_ratio', 'rlgl_cache_hits_total', 'rlgl_cache_misses_total', "Fraction of lookups answered by the cache, by cache")
+metrics.describe('rlgl_log_records_dropped_total', 'counter', "Log records dropped because the log queue was full")
+
+
+def upstream_latency(upstream):
+    def record(seconds, ok):
+        metrics.observe('rlgl_upstream_duration_seconds', (("upstream", upstream), ("outcome", "ok" if ok else "error")), seconds)
+    return record
+
+# Calls to a slow or failing upstream are refused quickly rather than tying up workers needed for /update.
+# Each upstream may only occupy half of a worker's threads (server_threads), so a hung upstream always
+# leaves threads free; a *_max_concurrent at or above server_threads would never engage.
+upstream_max_concurrent = max(1, CFG.get('server_threads', 4) // 2)
+google_breaker = CircuitBreaker("Google geolocation",
+                                failure_threshold=CFG.get('google_breaker_failures', 5),
+                                latency_budget=CFG.get('google_latency_budget', 2.0),
+                                reset_timeout=CFG.get('google_breaker_reset', 30),
+                                max_concurrent=CFG.get('google_max_concurrent', upstream_max_concurrent),
+                                on_call=upstream_latency("google"))
+thingsboard_breaker = CircuitBreaker("ThingsBoard",
+                                     failure_threshold=CFG.get('thingsboard_breaker_failures', 5),
+                                     latency_budget=CFG.get('thingsboard_latency_budget', 2.0),
+                                     reset_timeout=CFG.get('thingsboard_breaker_reset', 30),
+                                     max_concurrent=CFG.get('thingsboard_max_concurrent', upstream_max_concurrent),
+                                     on_call=upstream_latency("thingsboard"))
+ota_admission = AdmissionController(max_total=CFG.get('ota_max_downloads', 20),
+                                    max_per_folder=CFG.get('ota_max_downloads_per_folder', 10),
+                                    max_wait=CFG.get('ota_admission_wait', 1.0),
+                                    max_waiting=CFG.get('ota_max_waiting', 20))
+
+
+def get_tbapi():
+    global tbapi
+    with clients_lock:
+        if tbapi is None:
+            from thingsboard_api_tools import TbApi # sudo pip install git+git://github.com/eykamp/thingsboard_api_tools.git --upgrade
+            tbapi = TbApi(CFG['motherShipUrl'], CFG['username'], CFG['password'])
+        return tbapi
+
+
+def post_fork():
+    """Called in each worker after it is forked from a preloaded master process.
+    Drops any upstream clients (and their open connections) inherited from the
+    parent, so that each worker creates its own on first use."""
+    global tbapi, gmaps_client, geolocation_cache, ap_database, location_workers, device_tokens
+    with clients_lock:
+        tbapi = None
+        gmaps_client = None
+        geolocation_cache = None
+        ap_database = None
+        location_workers = None     # its threads didn't survive the fork
+        device_tokens = None        # likewise its refresh thread
+    logs.after_fork()               # and the log writer thread
+    logs.start()                    # open this worker's log file now rather than in its first request
+    metrics.after_fork()
+    for hook in post_fork_hooks:
+        hook()
+
+
+def get_gmaps_client():
+    """Returns the process-wide Google Maps client. Its HTTP session keeps
+    connections to Google alive between requests, so only the first lookup
+    pays for the TLS handshake."""
+    global gmaps_client
+    with clients_lock:
+        if gmaps_client is None:
+            import googlemaps
+            import requests
+
+            session = requests.Session()
+            session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=CFG.get('google_pool_size', 10)))
+            # By default a lookup gives up once it has used the breaker's latency budget, rather than
+            # holding a thread for a call the breaker will count as slow anyway
+            budget = google_breaker.latency_budget
+            gmaps_client = googlemaps.Client(
+                key=CFG['google_geolocation_key'],
+                connect_timeout=CFG.get('google_connect_timeout', 3),
+                read_timeout=CFG.get('google_read_timeout', budget),
+                retry_timeout=CFG.get('google_retry_timeout', budget),     # total time allowed for retries
+                retry_over_query_limit=CFG.get('google_retry_over_query_limit', True),
+                requests_session=session,
+            )
+        return gmaps_client
+
+
+def get_geolocation_cache():
+    # Shared by all workers through the SQLite file; each process opens its own connection
+    global geolocation_cache
+    with clients_lock:
+        if geolocation_cache is None:
+            geolocation_cache = GeolocationCache(CFG.get('geolocation_cache_path') or build_cache_path('geolocation.sqlite'),
+                                                 ttl=CFG.get('geolocation_cache_ttl', 7 * 24 * 3600),
+                                                 max_entries=CFG.get('geolocation_cache_size', 100000))
+        return geolocation_cache
+
+
+def get_ap_database():
+    global ap_database
+    with clients_lock:
+        if ap_database is None:
+            ap_database = AccessPointDatabase(CFG.get('ap_database_path') or build_cache_path('access_points.sqlite'),
+                                              min_aps=CFG.get('ap_database_min_aps', 3))
+        return ap_database
 
 
 def get_geolocate():
     # helper function to assist with testability, so it can be mocked
-    return googlemaps.Client(key=CFG['google_geolocation_key']).geolocate
+    return get_gmaps_client().geolocate
 
 
-@app.route("/wifi_location", methods=["POST"])
-def wifi_location():
-    """Called by ThingsBoard server when a device sends a message containing
-    hotspot details. Sends a geolocation request to Google based on visible
-    Wi-Fi hotspots and signal strengths reported by device. Returns the
-    location, distance, and accuracy in JSON."""
+class LocationError(Exception):
+    """Raised when a hotspot report can't be turned into a location; the message is returned to the caller."""
 
-    if request.json is None:
-        return "did not provide any request data", 400
 
-    hotspots = request.json.get("visibleHotspots", [])
-    print("Geolocating for {} ".format(hotspots))
+# source is "cache", "local" (estimated from the access point database), "google", or "tracked" (reused
+# from the device's previous report)
+Location = namedtuple('Location', 'coord accuracy source')
+
+
+def geolocate_hotspots(hotspots):
+    """Returns the Location for a list of visible hotspots: from the cache when
+    we've seen this set of access points before, from the local access point
+    database when it knows enough of them, otherwise from Google."""
+    # A stationary device keeps seeing the same access points, so most reports can be answered from the cache
+    fingerprint = hotspot_fingerprint(hotspots)
+    cached = get_geolocation_cache().get(fingerprint) if fingerprint else None
+    if cached is not None:
+        return Location(cached[0], cached[1], "cache")
+
+    estimate = get_ap_database().estimate(hotspots)
+    if estimate is not None:
+        return Location(estimate[0], estimate[1], "local")
+
+    # Devices reporting the same access points at the same moment share one Google request
+    if fingerprint:
+        return geolocate_flights.do(fingerprint, google_location, hotspots, fingerprint)
+    return google_location(hotspots, fingerprint)
 
+
+def google_location(hotspots, fingerprint):
     geolocate = get_geolocate()
     try:
-        results = geolocate(wifi_access_points=hotspots)
+        results = google_breaker.call(geolocate, wifi_access_points=hotspots)
+    except UpstreamUnavailable:
+        raise
     except Exception as ex:
-        return "Exception while geolocating: {}".format(ex), 500
+        raise LocationError("Exception while geolocating: {}".format(ex))
 
     if "error" in results:
-        return "Received error from Google API!", 500
+        raise LocationError("Received error from Google API!")
 
     try:
         gmaps_coord = (results["location"]["lat"], results["location"]["lng"])
         gmaps_acc = results["accuracy"]
     except Exception:
-        return "Error parsing response from Google Location API!", 500
+        raise LocationError("Error parsing response from Google Location API!")
+
+    if fingerprint:
+        get_geolocation_cache().put(fingerprint, gmaps_coord, gmaps_acc)
+    return Location(gmaps_coord, gmaps_acc, "google")
+
+
+def learn_access_points(hotspots, known_coord, location, distance_m):
+    # Only teach the access point database from Google's answers that confirm the device is where we think it
+    # is; learning from our own estimates, or from a device that has moved, would reinforce mistakes
+    if location.source == "google" and known_coord != (0, 0) and distance_m <= CFG.get('ap_database_max_distance', 150):
+        get_ap_database().observe(hotspots, known_coord)
 
-    known_coord = (request.json.get("latitude", 0), request.json.get("longitude", 0))
-    print("Calculating distance between {} and {}...".format(known_coord, gmaps_coord))
+
+# A device's hotspot report on its way through locate_device().  `result` is set when the tracker already
+# knows the answer; `location` is set when only the distance needs computing.
+Report = namedtuple('Report', 'hotspots known_coord device location result')
+
+
+def known_coordinates(payload):
+    """Returns the (latitude, longitude) a report says the device is at, as
+    floats; (0, 0) if it doesn't say.  Raises LocationError if they aren't
+    finite numbers in range."""
+    coord = []
+    for name, limit in (("latitude", 90), ("longitude", 180)):
+        value = payload.get(name, 0)
+        if isinstance(value, bool) or not isinstance(value, (int, float, str)):
+            raise LocationError("{} must be a number".format(name))
+        try:
+            value = float(value)
+        except ValueError:
+            raise LocationError("{} must be a number".format(name))
+        if not math.isfinite(value) or abs(value) > limit:
+            raise LocationError("{} out of range".format(name))
+        coord.append(value)
+    return tuple(coord)
+
+
+def check_hotspots(payload):
+    """Raises LocationError unless the report's visibleHotspots is a list of
+    access points, each with a string macAddress and, if given, a numeric
+    signalStrength."""
+    hotspots = payload.get("visibleHotspots", [])
+    if not isinstance(hotspots, list):
+        raise LocationError("visibleHotspots must be a list")
+    for hotspot in hotspots:
+        if not isinstance(hotspot, dict) or not isinstance(hotspot.get("macAddress"), str):
+            raise LocationError("each hotspot needs a macAddress")
+        strength = hotspot.get("signalStrength", -100)
+        if isinstance(strength, bool) or not isinstance(strength, (int, float)) or not math.isfinite(strength):
+            raise LocationError("signalStrength must be a number")
+
+
+def start_report(payload):
+    hotspots = payload.get("visibleHotspots", [])
+    known_coord = known_coordinates(payload)
+    log.info("Geolocating for %d hotspots", len(hotspots), extra=sampled(hotspots=hotspots))
+
+    # If the device still sees (nearly) the same access points as last time, it hasn't moved; reuse that answer
+    device = payload.get("device_token") or payload.get("macAddress")
+    tracked = hotspot_tracker.lookup(device, hotspots) if device else None
+
+    if tracked is None:
+        return Report(hotspots, known_coord, device, None, None)
+    if tracked.known_coord == known_coord:
+        return Report(hotspots, known_coord, device, None, tracked.result)
+    return Report(hotspots, known_coord, device, Location(tracked.gmaps_coord, tracked.gmaps_acc, "tracked"), None)
+
+
+def finish_report(report, location, distance_m):
+    outgoing_data = {"wifiDistance": distance_m, "wifiDistanceAccuracy": location.accuracy}
+    learn_access_points(report.hotspots, report.known_coord, location, distance_m)
+    if report.device:
+        hotspot_tracker.remember(report.device, report.hotspots, report.known_coord, location.coord, location.accuracy, outgoing_data)
+    return outgoing_data
+
+
+def locate_device(payload):
+    """Works out how far the location Google sees for a device's hotspot report
+    is from where the device says it is. Returns the telemetry to send."""
+    report = start_report(payload)
+    if report.result is not None:
+        return report.result
+
+    location = report.location or geolocate_hotspots(report.hotspots)
+
+    log.info("Calculating distance between %s and %s", report.known_coord, location.coord, extra=sampled())
+    import geopy.distance
     try:
-        distance = geopy.distance.distance(known_coord, gmaps_coord)
+        distance = geopy.distance.distance(report.known_coord, location.coord)
     except Exception:
-        return "geopy.distance had an error", 500
+        raise LocationError("geopy.distance had an error")
+
+    return finish_report(report, location, distance.m)
+
 
-    outgoing_data = {"wifiDistance": distance.m, "wifiDistanceAccuracy": gmaps_acc}
+def locate_devices(payloads):
+    """locate_device() for many reports at once. Reports that need Google are
+    geolocated concurrently, and all distances are computed in one pass.
+    Returns one entry per payload: the telemetry, or the LocationError (or
+    UpstreamUnavailable) that stopped it."""
+    from concurrent.futures import ThreadPoolExecutor
+    from redlight_greenlight.geodesy import distances
 
-    if 'device_token' in request.json:
-        device_token = request.json["device_token"]
-        print("Sending ", outgoing_data)
+    reports = [None] * len(payloads)
+    results = [None] * len(payloads)
+    for i, payload in enumerate(payloads):
         try:
-            tbapi.send_telemetry(device_token, outgoing_data)
+            reports[i] = start_report(payload)
+            results[i] = reports[i].result
+        except LocationError as ex:
+            results[i] = ex
+    locations = [report and report.location for report in reports]
+
+    def try_geolocate(hotspots):
+        try:
+            return geolocate_hotspots(hotspots)
+        except (LocationError, UpstreamUnavailable) as ex:
+            return ex
+
+    pending = [i for i, report in enumerate(reports) if results[i] is None and report.location is None]
+    if pending:
+        with ThreadPoolExecutor(max_workers=min(len(pending), CFG.get('wifi_location_batch_concurrency', 8))) as executor:
+            for i, location in zip(pending, executor.map(try_geolocate, [reports[i].hotspots for i in pending])):
+                if isinstance(location, Exception):
+                    results[i] = location
+                else:
+                    locations[i] = location
+
+    todo = [i for i, result in enumerate(results) if result is None]
+    if todo:
+        try:
+            meters = distances([reports[i].known_coord for i in todo], [locations[i].coord for i in todo])
+        except Exception:
+            meters = [math.nan] * len(todo)     # e.g. a malformed coordinate from Google; fails every row below
+        # A bad row fails on its own, so the rest of the batch still gets its results
+        for i, distance_m in zip(todo, meters):
+            if math.isfinite(distance_m):
+                results[i] = finish_report(reports[i], locations[i], float(distance_m))
+            else:
+                results[i] = LocationError("Error calculating distance")
+    return results
+
+
+def process_location_report(payload):
+    # Runs on a location worker; any exception makes the pool retry the whole report.  Google's answer is
+    # cached by then, so a retry after a telemetry failure doesn't geolocate again.
+    outgoing_data = locate_device(payload)
+    log.info("Sending telemetry", extra=sampled(telemetry=outgoing_data))
+    thingsboard_breaker.call(get_tbapi().send_telemetry, payload["device_token"], outgoing_data)
+
+
+def get_location_workers():
+    global location_workers
+    with clients_lock:
+        if location_workers is None:
+            location_workers = WorkerPool(workers=CFG.get('wifi_location_workers', 4),
+                                          max_queued=CFG.get('wifi_location_max_queued', 1000),
+                                          retries=CFG.get('wifi_location_retries', 3),
+                                          retry_delay=CFG.get('wifi_location_retry_delay', 1.0),
+                                          name="wifi_location")
+        return location_workers
+
+
+@routes.route("/wifi_location", methods=["POST"])
+def wifi_location():
+    """Called by ThingsBoard server when a device sends a message containing
+    hotspot details. Sends a geolocation request to Google based on visible
+    Wi-Fi hotspots and signal strengths reported by device. Returns the
+    location, distance, and accuracy in JSON.
+
+    With wifi_location_async set, the report is only validated here and queued;
+    the reply is 202 and the result reaches the device as telemetry."""
+
+    payload = request.get_json(silent=True)
+    if payload is None:
+        return "did not provide any request data", 400
+
+    if not isinstance(payload, dict):
+        return "expected a hotspot report", 400
+    try:
+        known_coordinates(payload)
+        check_hotspots(payload)
+    except LocationError as ex:
+        return str(ex), 400
+
+    if CFG.get('wifi_location_async', False):
+        if 'device_token' not in payload:
+            return "device_token is required when locations are computed in the background", 400
+        if not get_location_workers().submit(process_location_report, payload):
+            return "Too many location reports queued; try again later", 503, {"Retry-After": str(CFG.get('wifi_location_retry_after', 30))}
+        return {"queued": True}, 202
+
+    try:
+        outgoing_data = locate_device(payload)
+    except UpstreamUnavailable as ex:
+        return upstream_unavailable(ex)
+    except LocationError as ex:
+        return str(ex), 500
+
+    if 'device_token' in payload:
+        device_token = payload["device_token"]
+        log.info("Sending telemetry", extra=sampled(telemetry=outgoing_data))
+        try:
+            thingsboard_breaker.call(get_tbapi().send_telemetry, device_token, outgoing_data)
+        except UpstreamUnavailable as ex:
+            return upstream_unavailable(ex)
         except Exception:
             return "Error sending location telemetry!", 500
 
     return outgoing_data
 
 
+@routes.route("/wifi_location/batch", methods=["POST"])
+def wifi_location_batch():
+    """Like /wifi_location, for a list of reports from many devices, as sent by
+    a periodic fleet sweep. Returns a list with the result, or an error, for
+    each report, in the same order."""
+
+    payloads = request.get_json(silent=True)
+    if not isinstance(payloads, list):
+        return "expected a list of hotspot reports", 400
+
+    results = [None] * len(payloads)
+    valid = []
+    for i, payload in enumerate(payloads):
+        try:
+            if not isinstance(payload, dict):
+                raise LocationError("not a hotspot report")
+            check_hotspots(payload)
+            valid.append(i)
+        except LocationError:
+            results[i] = {"error": "invalid report"}
+
+    for i, result in zip(valid, locate_devices([payloads[i] for i in valid])):
+        results[i] = {"error": str(result)} if isinstance(result, Exception) else result
+
+    # ThingsBoard takes telemetry per device token, so a device that appears more than once only gets its
+    # latest result; the sends are made concurrently
+    latest = {}
+    for i in valid:
+        if 'device_token' in payloads[i] and "error" not in results[i]:
+            latest[payloads[i]["device_token"]] = i
+    if latest:
+        send_telemetry_batch(latest, payloads, results)
+
+    return {"results": results}
+
+
+def send_telemetry_batch(latest, payloads, results):
+    from concurrent.futures import ThreadPoolExecutor
+
+    tbapi = get_tbapi()
+
+    def send(device_token):
+        try:
+            thingsboard_breaker.call(tbapi.send_telemetry, device_token, results[latest[device_token]])
+            return None
+        except UpstreamUnavailable as ex:
+            return str(ex)
+        except Exception:
+            return "Error sending location telemetry!"
+
+    with ThreadPoolExecutor(max_workers=min(len(latest), CFG.get('wifi_location_batch_concurrency', 8))) as executor:
+        for device_token, error in zip(latest, executor.map(send, list(latest))):
+            if error:
+                for i, payload in enumerate(payloads):
+                    if isinstance(payload, dict) and payload.get("device_token") == device_token and "error" not in results[i]:
+                        results[i] = dict(results[i], error=error)
+
+
 # Returns a copy of the latest version of the firmware
-@app.route("/firmware", methods=["GET"])
+@routes.route("/firmware", methods=["GET"])
 def firmware():
     """Called by provisioning scripts to grab the latest firmware for flashing
     a device. Returns firmware binary."""
     fw_path = get_path_of_latest_firmware(CFG['firmware_images_folder'])
     if fw_path is None:
         return "unable to find firmware", 404
-    fw = get_firmware(fw_path)
-    return Response(fw.data, mimetype="application/octet-stream", headers={"X-MD5": fw.md5})
+    return serve_firmware(fw_path)
+
+
+@routes.route("/firmware/<digest>", methods=["GET"])
+def firmware_by_hash(digest):
+    """Returns the image with this SHA-256 from the firmware store. The content
+    behind a hash URL never changes, so it may be cached forever."""
+    fw_path = get_firmware_store().path_for(digest)
+    if fw_path is None or not os.path.isfile(fw_path):
+        return "unable to find firmware", 404
+
+    resp = serve_firmware(fw_path)
+    if resp.status_code in (200, 206, 304):
+        resp.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return resp
+
+
+def get_firmware_index():
+    # The index is rebuilt from scratch if the configured images folder changes
+    global firmware_index
+    root = str(CFG['firmware_images_folder'])
+    if firmware_index is None or firmware_index.root != root:
+        firmware_index = FirmwareIndex(root, on_new_image=precompress_firmware)
+        already_latest_cache.clear()
+    return firmware_index
+
+
+def get_firmware_store():
+    # Images shared by several device folders live once in the store, <firmware_images_folder>/.store by default
+    global firmware_store
+    folder = CFG.get('firmware_store_folder') or os.path.join(str(CFG['firmware_images_folder']), ".store")
+    if firmware_store is None or firmware_store.folder != os.path.realpath(folder):
+        firmware_store = FirmwareStore(folder)
+    return firmware_store
 
 
 def get_path_of_latest_firmware(folder, current_major=0, current_minor=0):
-    newest_firmware = None
-    newest_major = current_major
-    newest_minor = current_minor
+    return get_firmware_index().latest(folder, current_major, current_minor)
 
-    for file in os.listdir(folder):
-        candidate = re.search(r"(\d+)\.(\d+).bin", file)
-        if candidate:
-            major = int(candidate.group(1))
-            minor = int(candidate.group(2))
 
-            if major > newest_major or (major == newest_major and minor > newest_minor):
-                newest_major = major
-                newest_minor = minor
-                newest_firmware = os.path.join(folder, file)
+def streaming_firmware():
+    # firmware_delivery = "stream" (default) sends images straight from disk; "memory" serves the cached bytes
+    return CFG.get('firmware_delivery', 'stream') != 'memory'
 
-    return newest_firmware
 
+def get_firmware(firmware_path, compressed=False):
+    # Served from the in-memory catalog; the file is only read and hashed again when it changes on disk
+    if compressed:
+        fw = firmware_catalog.compressed(firmware_path, with_data=not streaming_firmware())
+    else:
+        fw = firmware_catalog.get(firmware_path, with_data=not streaming_firmware())
+    log.info("Found firmware", extra=sampled(bytes=fw.size, md5=fw.md5))
+    return fw
 
-def get_firmware(firmware_path):
-    with open(firmware_path, 'rb') as f:
-        bin_image = f.read()
-    md5 = hashlib.md5(bin_image).hexdigest()
-    print("Found firmware bytes={} md5={}".format(len(bin_image), md5))
-    return namedtuple('Firmware', 'data md5')(bin_image, md5)
 
+def precompress_firmware(fw_path):
+    # Called by the index for each new image, so the .bin.gz sibling is ready before a device asks for it
+    if not CFG.get('firmware_gzip', True):
+        return
+    try:
+        firmware_catalog.compressed(fw_path, with_data=False)
+    except OSError as ex:
+        log.warning("Could not write compressed copy of %s: %s", fw_path, ex)
+
+
+def wants_compressed_firmware(folder):
+    # Newer ESP8266 cores apply gzip images directly; serve one when the client says it can take it or the
+    # device folder opts in with `gzip = true` in its firmware.toml, unless the client refuses it with gzip;q=0
+    if not CFG.get('firmware_gzip', True):
+        return False
+    if request.accept_encodings["gzip"] > 0:
+        return True
+    if any(encoding == "gzip" for encoding, _ in request.accept_encodings):
+        return False
+    return get_firmware_index().settings(folder).get('gzip', False)
+
+
+def serve_firmware(fw_path):
+    """Sends the image at fw_path if the admission controller has room for
+    another transfer; otherwise asks the device to retry later. The device
+    treats any non-200 answer as "no update" and keeps its current version."""
+    folder = os.path.dirname(fw_path)
+    if not ota_admission.acquire(folder):
+        log.warning("Too many firmware downloads in flight; asking client to retry later", extra=sampled(folder=folder))
+        return "busy, retry later", 503, {"Retry-After": str(CFG.get('ota_retry_after', 60))}
+
+    transfer = dict(bytes=0, released=False)
+
+    def release():
+        # The slot is held until the server has finished sending the body
+        if not transfer['released']:
+            transfer['released'] = True
+            ota_admission.release(folder, transfer['bytes'])
 
-def find_firmware_folder(current_version, mac_address):
-    v = re.search(r"(\d+)\.(\d+)", current_version)
-    current_major = int(v.group(1))
-    current_minor = int(v.group(2))
+    try:
+        compressed = wants_compressed_firmware(folder)
+        try:
+            fw = get_firmware(fw_path, compressed)
+        except OSError as ex:
+            if not compressed:
+                raise
+            log.warning("Serving uncompressed %s: %s", fw_path, ex)
+            compressed = False
+            fw = get_firmware(fw_path)
+        resp = send_firmware(fw, on_close=release)
+    except Exception:
+        release()
+        raise
 
-    device_specific_subfolder = None
+    if compressed:
+        resp.headers["Content-Encoding"] = "gzip"
 
-    # If there is a dedicated folder for this device, search there; if not, use the default firmware_images_folder
-    subdirs = get_immediate_subdirectories(CFG['firmware_images_folder'])
-
-    for subdir in subdirs:
-        print(subdir)
-        # Folders will have a name matching the pattern SOME_READABLE_PREFIX + underscore + MAC_ADDRESS
-        if re.match(".*_" + mac_address.upper(), subdir):
-            if device_specific_subfolder is not None:
-                print("Error: found multiple folders for mac address " + mac_address)
-                return None
-            device_specific_subfolder = subdir
-
-    if device_specific_subfolder is None:
-        folder = CFG['firmware_images_folder']
+    # Point caches at the shared, immutable URL for this image
+    digest = get_firmware_store().digest_of(fw_path)
+    if digest:
+        resp.headers["Content-Location"] = "/firmware/" + digest
+    if CFG.get('firmware_gzip', True):
+        resp.vary.add("Accept-Encoding")
+
+    if request.method == "HEAD" or resp.status_code not in (200, 206):
+        resp.close()    # no body will be sent
     else:
-        folder = os.path.join(CFG['firmware_images_folder'], device_specific_subfolder)
+        transfer['bytes'] = resp.content_length or 0
+    return resp
+
+
+def send_firmware(fw, on_close=None):
+    """Builds the response for a firmware image. The MD5 doubles as the ETag, so
+    HEAD and If-None-Match are answered from the catalog, and Range requests
+    let interrupted downloads resume. When streaming, the body is handed to the
+    server's file wrapper (sendfile where available) instead of being buffered.
+    on_close is called once the body has been sent or discarded."""
+    if streaming_firmware():
+        body = wrap_file(request.environ, FirmwareFile(fw.path, on_close or (lambda: None)))
+        resp = Response(body, mimetype="application/octet-stream", direct_passthrough=True)
+        resp.last_modified = fw.mtime / 1e9
+    else:
+        resp = Response(fw.data, mimetype="application/octet-stream")
+        if on_close:
+            resp.call_on_close(on_close)
+    resp.content_length = fw.size
+    resp.cache_control.no_cache = True
+    resp.set_etag(fw.md5)
+    resp.headers["X-MD5"] = fw.md5
+    return resp.make_conditional(request, accept_ranges=True, complete_length=fw.size)
+
+
+def find_firmware_folder(current_version, mac_address):
+    # current_version is the device's (major, minor), from parse_version
+    index = get_firmware_index()
 
-    print("Using firmware folder: {}".format(folder))
+    # If there is a dedicated folder for this device, search there; if not, use the default firmware_images_folder
+    device_specific_subfolders = index.device_folders(mac_address)
 
-    if not os.path.isdir(folder):
-        print("Error>>> " + folder + " is not a folder!")
+    if len(device_specific_subfolders) > 1:
+        log.error("Found multiple folders for mac address %s", mac_address)
         return None
 
-    return get_path_of_latest_firmware(folder, current_major, current_minor)
+    folder = device_specific_subfolders[0] if device_specific_subfolders else index.root
+
+    log.info("Using firmware folder %s", folder, extra=sampled())
+
+    if index.versions(folder) is None:
+        log.error("%s is not a folder", folder)
+        return None
 
+    return index.latest(folder, *current_version)
 
-@app.route("/update", methods=["GET"])
+
+def esp8266_header(name, required=True):
+    # ESPhttpUpdate sends e.g. "x-ESP8266-sketch-md5"; some proxies and our tests pass the CGI-style HTTP_X_ESP8266_SKETCH_MD5
+    value = request.headers.get("x-ESP8266-" + name)
+    if value is None:
+        cgi_name = "HTTP_X_ESP8266_" + name.upper().replace("-", "_")
+        value = request.headers[cgi_name] if required else request.headers.get(cgi_name)
+    return value
+
+
+def running_newest_firmware(fw):
+    # The device reports the MD5 and size of the sketch it is running; if they match, there is nothing to send
+    sketch_md5 = esp8266_header("sketch-md5", required=False)
+    sketch_size = esp8266_header("sketch-size", required=False)
+    if sketch_md5 is None or sketch_md5.lower() != fw.md5:
+        return False
+    return sketch_size is None or sketch_size == str(fw.size)
+
+
+@routes.route("/update", methods=["GET"])
 def update():
     # Returns the full file/path of the latest firmware, or None if we are
     # already running the latest
-    current_version = request.headers['HTTP_X_ESP8266_VERSION']
-    mac = request.headers['HTTP_X_ESP8266_STA_MAC']
-    print("Mac %s" % mac)
+    current_version = esp8266_header("version")
+    mac = esp8266_header("sta-mac")
+    log.info("Update check", extra=sampled(mac=mac, version=current_version))
+
+    # Devices poll often; remember which ones are up to date until the index sees a change or the entry expires
+    index = get_firmware_index()
+    latest_key = (mac.upper(), current_version)
+    already_latest = already_latest_cache.get(latest_key)
+    if already_latest is not None and already_latest[0] == index.generation:
+        return "", already_latest[1]
+
     # Other available headers
     # 'HTTP_CONNECTION': 'close',
     # 'HTTP_HOST': 'www.sensorbot.org:8989',
@@ -199,17 +754,48 @@ def update():
     # 'HTTP_X_ESP8266_STA_MAC': '2C:3A:E8:08:2C:38',
     # 'HTTP_X_ESP8266_VERSION': '0.120',
 
-    newest_firmware = find_firmware_folder(current_version, mac)
+    version = parse_version(current_version)
+    if version is None:
+        return "unrecognized version", 400
+
+    newest_firmware = find_firmware_folder(version, mac)
     if newest_firmware:
-        print("Upgrading birdhouse to " + newest_firmware)
-        fw = get_firmware(newest_firmware)
-        return Response(fw.data, mimetype="application/octet-stream", headers={"X-MD5": fw.md5})
+        # Only the cached digest is needed to decide; the image itself isn't touched unless we send it
+        if running_newest_firmware(firmware_catalog.get(newest_firmware, with_data=False)):
+            log.info("Birdhouse already running %s", newest_firmware, extra=sampled(mac=mac))
+            already_latest_cache.put(latest_key, (index.generation, 304))
+            return "", 304
+
+        log.info("Upgrading birdhouse to %s", newest_firmware, extra=dict(mac=mac))
+        return serve_firmware(newest_firmware)
     else:
-        print("Birdhouse already at most recent version (" + current_version + ")")
+        log.info("Birdhouse already at most recent version (%s)", current_version, extra=sampled(mac=mac))
+        already_latest_cache.put(latest_key, (index.generation, 302))
         return "", 302
 
 
-@app.route("/validate_token", methods=["GET"])
+def list_tb_devices(page, page_size):
+    # One page of the tenant's devices, from ThingsBoard's paginated device listing
+    tbapi = get_tbapi()
+    devices = thingsboard_breaker.call(tbapi.get, "/api/tenant/devices?pageSize={}&page={}".format(page_size, page), "Error listing devices")
+    return devices["data"], devices["hasNext"]
+
+
+def get_device_tokens():
+    global device_tokens
+    with clients_lock:
+        if device_tokens is None:
+            device_tokens = DeviceTokenIndex(list_tb_devices,
+                                             lambda name: thingsboard_breaker.call(get_tbapi().get_device_by_name, name),
+                                             lambda device: thingsboard_breaker.call(get_tbapi().get_device_token, device),
+                                             ttl=CFG.get('device_token_ttl', 300),
+                                             negative_ttl=CFG.get('device_token_negative_ttl', 60),
+                                             page_size=CFG.get('device_token_page_size', 100),
+                                             background=CFG.get('device_token_background_refresh', True))
+        return device_tokens
+
+
+@routes.route("/validate_token", methods=["GET"])
 def validate_token():
     # Pass two args: name and key.  Returns "true" if key is the correct secret key for named device, "false" otherwise.
     # Used to validate whether users have input correct secret key when configuring devices.
@@ -219,16 +805,215 @@ def validate_token():
     except KeyError:
         return "Please specify 'name' and 'token' parameters", 401
 
-    device = tbapi.get_device_by_name(name)
-    if device is None:
+    try:
+        return token_validity(get_device_tokens().validate(name, token))
+    except UpstreamUnavailable as ex:
+        return upstream_unavailable(ex)
+
+
+@routes.route("/validate_token", methods=["POST"])
+def validate_tokens():
+    """Checks many device tokens at once, e.g. a whole box of boards before a
+    build day. Takes a JSON list of {"name": ..., "token": ...} objects and
+    returns {"results": [...]}, with "true", "false" or "bad_device" for each,
+    in the same order."""
+    devices = request.get_json(silent=True)
+    if not isinstance(devices, list):
+        return "expected a list of {name, token} objects", 400
+    try:
+        pairs = [(str(device['name']), str(device['token'])) for device in devices]
+    except (KeyError, TypeError):
+        return "Please specify 'name' and 'token' for every device", 401
+
+    try:
+        results = get_device_tokens().validate_many(pairs, workers=CFG.get('device_token_batch_concurrency', 8))
+    except UpstreamUnavailable as ex:
+        return upstream_unavailable(ex)
+    return {"results": [token_validity(valid) for valid in results]}
+
+
+def upstream_unavailable(ex):
+    return str(ex), 503, {"Retry-After": str(ex.retry_after)}
+
+
+def token_validity(valid):
+    if valid is None:
         return "bad_device"
+    return "true" if valid else "false"
+
+
+@routes.route("/status", methods=["GET"])
+def status():
+    """Returns cache, OTA admission, background worker, upstream circuit breaker and logging statistics as JSON."""
+    return dict(
+        ota=ota_admission.stats(),
+        firmware_catalog=firmware_catalog.stats(),
+        update_latest_cache=already_latest_cache.stats(),
+        geolocation_cache=get_geolocation_cache().stats(),
+        hotspot_tracker=hotspot_tracker.stats(),
+        ap_database=get_ap_database().stats(),
+        wifi_location_workers=get_location_workers().stats(),
+        device_tokens=get_device_tokens().stats(),
+        circuit_breakers=dict(google=google_breaker.stats(), thingsboard=thingsboard_breaker.stats()),
+        profiler=request_profiler.stats() if request_profiler is not None else None,
+        single_flight=dict(geolocate=geolocate_flights.stats(), validate_token=get_device_tokens().flights.stats()),
+        logging=logs.stats(),
+    )
+
+
+def build_request_profiler():
+    # Opt-in: set profile_sample_rate (a fraction of requests) in the config, or RLGL_PROFILE in the environment
+    rate = float(os.environ.get('RLGL_PROFILE') or CFG.get('profile_sample_rate', 0))
+    route_rates = CFG.get('profile_route_rates', {})
+    if rate <= 0 and not route_rates:
+        return None
+    directory = os.environ.get('RLGL_PROFILE_DIR') or CFG.get('profile_dir') or build_cache_path('profiles')
+    return RequestProfiler(directory, rate, route_rates, max_files=CFG.get('profile_max_files', 200))
+
 
-    tb_token = tbapi.get_device_token(device)
-    return "true" if tb_token == token else "false"
+request_profiler = build_request_profiler()
+
+
+def request_route():
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+@routes.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    metrics.inc('rlgl_http_requests_in_flight')
+    if request_profiler is not None:
+        g.profile = request_profiler.start(request_route())
+
+
+@routes.after_app_request
+def record_request_time(response):
+    # Streamed firmware is timed until the response starts, not until the last byte is sent
+    labels = (("route", request_route()), ("method", request.method), ("status", response.status_code))
+    metrics.observe('rlgl_http_request_duration_seconds', labels, time.perf_counter() - g.request_started)
+
+    # The server sends a streamed body (e.g. firmware) after the request is torn down; stop profiling once it is sent
+    profile = g.pop('profile', None)
+    if profile is not None:
+        route, started = request_route(), g.request_started
+        on_response_closed(response, lambda: request_profiler.finish(profile, route, time.perf_counter() - started))
+    return response
+
+
+def on_response_closed(response, callback):
+    """Calls callback once the server has sent the response and closed it.
+    Werkzeug hands a direct_passthrough body (streamed firmware) to the server
+    as is, so the server closes the body rather than the response, and
+    call_on_close() callbacks would never run."""
+    body = response.response
+    if response.direct_passthrough and hasattr(body, 'close'):
+        close = body.close
+
+        def closed():
+            try:
+                close()
+            finally:
+                callback()
+        body.close = closed
+    else:
+        response.call_on_close(callback)
+
+
+@routes.teardown_app_request
+def finish_request(exc):
+    metrics.inc('rlgl_http_requests_in_flight', amount=-1)
+    if metrics.publish_due():
+        try:
+            metrics.publish(collect_metrics())
+        except OSError as ex:
+            log.warning("Could not publish metrics: %s", ex)
+    # Only still set if the request failed before record_request_time() could hand it to the response
+    profile = g.pop('profile', None)
+    if profile is not None:
+        request_profiler.finish(profile, request_route(), time.perf_counter() - g.request_started)
+
+
+def collect_metrics():
+    # Samples read from the components at scrape (or publish) time, as (name, labels, value)
+    ota = ota_admission.stats()
+    collected = [
+        ('rlgl_ota_in_flight', (), ota['in_flight']),
+        ('rlgl_ota_queue_depth', (), ota['queue_depth']),
+        ('rlgl_ota_rejected_total', (), ota['rejected']),
+        ('rlgl_firmware_bytes_sent_total', (), ota['bytes_sent']),
+        ('rlgl_wifi_location_queue_depth', (), get_location_workers().stats()['queue_depth']),
+        ('rlgl_log_records_dropped_total', (), logs.stats()['dropped']),
+    ]
+
+    tokens = get_device_tokens().stats()
+    caches = dict(firmware_catalog=firmware_catalog.stats(),
+                  update_latest=already_latest_cache.stats(),
+                  geolocation=get_geolocation_cache().stats(),
+                  device_tokens=dict(hits=tokens['hits'], misses=tokens['upstream_lookups']))
+    for name, stats in caches.items():
+        collected += [
+            ('rlgl_cache_hits_total', (("cache", name),), stats['hits']),
+            ('rlgl_cache_misses_total', (("cache", name),), stats['misses']),
+        ]
+
+    # With several workers, this counts the workers whose breaker is open
+    for name, breaker in (("google", google_breaker), ("thingsboard", thingsboard_breaker)):
+        collected.append(('rlgl_upstream_circuit_open', (("upstream", name),), int(breaker.state != "closed")))
+    return collected
+
+
+@routes.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Returns request, upstream, cache and OTA metrics in the Prometheus text
+    format; under gunicorn, summed over all the workers (see share_metrics)."""
+    return Response(metrics.render(collect_metrics()), mimetype="text/plain; version=0.0.4")
+
+
+def share_metrics():
+    """Called in the gunicorn master before the workers are forked. Workers
+    publish their metrics to a shared folder every few seconds, so /metrics
+    reports the totals for the whole server whichever worker answers."""
+    import tempfile
+
+    directory = CFG.get('metrics_dir') or tempfile.mkdtemp(prefix="rlgl-metrics-")
+    os.makedirs(directory, exist_ok=True)
+    for entry in os.scandir(directory):
+        if entry.name.endswith((".json", ".json.tmp")):     # left by a previous run
+            os.remove(entry.path)
+    metrics.directory = directory
+    metrics.publish_interval = CFG.get('metrics_publish_interval', 5)
+
+
+def create_app():
+    """Application factory. Building the app is cheap; upstream clients are only
+    created when a route first needs them."""
+    app = Flask(__name__)
+    app.register_blueprint(routes)
+    return app
+
+
+app = create_app()
 
 
 def main():
-    app.run(port=8080, debug=True)
+    parser = argparse.ArgumentParser(description="Support services for sensorbot devices and provisioning scripts.")
+    parser.add_argument('--production', action='store_true',
+                        help="serve with multiple gunicorn workers instead of the Flask development server")
+    args = parser.parse_args()
+
+    if args.production:
+        from redlight_greenlight.server import serve
+        def worker_started():
+            post_fork()
+            # Load the device token index now rather than on the first /validate_token
+            if CFG.get('device_token_background_refresh', True):
+                get_device_tokens().start()
+
+        share_metrics()
+        serve(app, CFG, post_fork=worker_started)
+    else:
+        logs.start()
+        app.run(host=CFG.get('server_host', '127.0.0.1'), port=CFG.get('server_port', 8080), debug=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,82 @@
+import itertools
+import os
+import random
+import re
+import threading
+import time
+
+
+class RequestProfiler:
+    """Profiles a random sample of requests with cProfile and writes each
+    profile to `directory` as a .pstats file named after the route and how long
+    the request took, e.g. 20240501T120000-000153ms-update-4711-1.pstats.
+
+    Each route is sampled at `sample_rate`, unless `route_rates` gives it its
+    own rate.  Only one request is profiled at a time, since cProfile profiles
+    a single thread and the interpreter allows only one active profiler; a
+    request sampled while another is being profiled is skipped.  Only the
+    newest `max_files` profiles are kept.  Inspect them with
+    `python -m pstats FILE`."""
+
+    def __init__(self, directory, sample_rate, route_rates=None, max_files=200):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.route_rates = route_rates or {}
+        self.max_files = max_files
+
+        self._busy = threading.Lock()
+        self._sequence = itertools.count(1)
+        self.profiled = 0
+        self.skipped = 0
+
+    def start(self, route):
+        """Returns a running profiler if this request was sampled, otherwise None."""
+        if random.random() >= self.route_rates.get(route, self.sample_rate):
+            return None
+        if not self._busy.acquire(blocking=False):
+            self.skipped += 1
+            return None
+
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:      # some other profiler or debugger is active
+            self._busy.release()
+            self.skipped += 1
+            return None
+        return profile
+
+    def finish(self, profile, route, seconds):
+        profile.disable()
+        self._busy.release()
+        self.profiled += 1
+
+        os.makedirs(self.directory, exist_ok=True)
+        name = "{}-{:06d}ms-{}-{}-{}.pstats".format(time.strftime("%Y%m%dT%H%M%S"), int(seconds * 1000),
+                                                    route_slug(route), os.getpid(), next(self._sequence))
+        profile.dump_stats(os.path.join(self.directory, name))
+        self._rotate()
+
+    def _rotate(self):
+        profiles = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pstats"):
+                try:
+                    profiles.append((entry.stat().st_mtime, entry.path))
+                except FileNotFoundError:   # removed by another worker's rotation
+                    pass
+        profiles.sort()
+        for _, path in profiles[:max(0, len(profiles) - self.max_files)]:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        return dict(directory=self.directory, profiled=self.profiled, skipped=self.skipped)
+
+
+def route_slug(route):
+    # "/firmware/<digest>" -> "firmware-digest"
+    return re.sub(r"[^A-Za-z0-9_]+", "-", route).strip("-") or "root"
@@ -0,0 +1,77 @@
+"""Production server for redlight_greenlight.
+
+Runs the Flask app under gunicorn with several worker processes, each with a
+pool of threads, and without the Werkzeug debugger or reloader. Settings come
+from the TOML config:
+
+    server_host = "127.0.0.1"
+    server_port = 8080
+    server_workers = 5            # default: 2 * cores + 1
+    server_threads = 4            # google_/thingsboard_max_concurrent default to half of this
+    server_keepalive = 5          # seconds an idle keep-alive connection stays open
+    server_timeout = 60           # workers silent for longer than this are restarted
+    server_graceful_timeout = 30  # time given to in-flight requests on reload/shutdown
+    server_max_requests = 0       # recycle workers after this many requests (0 = never)
+    server_access_log = "-"       # omit to disable access logging
+    server_preload = true         # import the app once in the master and fork workers from it
+
+Calls to Google and ThingsBoard are capped per worker by google_max_concurrent
+and thingsboard_max_concurrent.  They default to half of server_threads, so a
+hung upstream can't take every thread from /update; if you set them, keep them
+below server_threads, or the cap never engages.
+
+Send SIGHUP to the master process to restart the workers: new ones are forked
+and old ones finish their requests before exiting.  The new workers run the
+same app, with the config the master read at startup, so restart rlgl itself to
+pick up new code or config changes.
+"""
+
+import multiprocessing
+import sys
+
+
+def gunicorn_options(cfg):
+    threads = cfg.get('server_threads', 4)
+    max_requests = cfg.get('server_max_requests', 0)
+    return {
+        'bind': "{}:{}".format(cfg.get('server_host', '127.0.0.1'), cfg.get('server_port', 8080)),
+        'workers': cfg.get('server_workers', multiprocessing.cpu_count() * 2 + 1),
+        'threads': threads,
+        'worker_class': 'gthread' if threads > 1 else 'sync',
+        'keepalive': cfg.get('server_keepalive', 5),
+        'timeout': cfg.get('server_timeout', 60),
+        'graceful_timeout': cfg.get('server_graceful_timeout', 30),
+        'max_requests': max_requests,
+        'max_requests_jitter': max_requests // 10,
+        'accesslog': cfg.get('server_access_log'),
+        'preload_app': cfg.get('server_preload', True),
+        'proc_name': 'rlgl',
+    }
+
+
+def serve(app, cfg, post_fork=None):
+    try:
+        from gunicorn.app.base import BaseApplication
+    except ImportError:
+        print("Production mode needs gunicorn; install it with: pip install --editable .[production]")
+        sys.exit(1)
+
+    class ProductionServer(BaseApplication):
+        def __init__(self, application, options):
+            self.application = application
+            self.options = options
+            super().__init__()
+
+        def load_config(self):
+            for key, value in self.options.items():
+                if value is not None:
+                    self.cfg.set(key, value)
+
+        def load(self):
+            return self.application
+
+    options = gunicorn_options(cfg)
+    if post_fork is not None:
+        options['post_fork'] = lambda server, worker: post_fork()
+    print("Serving on {} with {} workers x {} threads".format(options['bind'], options['workers'], options['threads']))
+    ProductionServer(app, options).run()
@@ -0,0 +1,55 @@
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Collapses concurrent identical calls into one.
+
+    do(key, fn, *args) runs fn(*args) unless a call with the same key is
+    already in flight, in which case it waits for that call and returns its
+    result (or raises its exception).  Nothing is remembered once a call
+    finishes; this is not a cache."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0          # calls that actually ran
+        self.collapsed = 0      # calls that waited for someone else's
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.collapsed += 1
+                leader = False
+            else:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args)
+            return call.result
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        with self._lock:
+            return dict(calls=self.calls, collapsed=self.collapsed, in_flight=len(self._calls))
@@ -0,0 +1,118 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+
+log = logging.getLogger(__name__)
+
+LATENCY_SAMPLES = 1000  # most recent jobs kept for the latency percentiles
+
+
+class WorkerPool:
+    """Runs jobs on `workers` background threads, fed by a queue of at most
+    `max_queued` jobs.
+
+    A job that raises is retried up to `retries` times, waiting `retry_delay`
+    seconds before the first retry and twice as long before each one after.
+    Threads are started by the first submit(), so a pool created before a
+    fork doesn't leave the child with a queue nobody reads."""
+
+    def __init__(self, workers, max_queued, retries=0, retry_delay=1.0, name="worker"):
+        self.workers = workers
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.name = name
+
+        self._queue = queue.Queue(max_queued)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._in_flight = 0
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)    # seconds from submit() to the job finishing
+
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self.retried = 0
+
+    def submit(self, fn, *args):
+        """Queues fn(*args); returns False if the queue is full."""
+        self._start()
+        try:
+            self._queue.put_nowait((time.monotonic(), fn, args))
+        except queue.Full:
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def join(self):
+        """Blocks until every queued job has finished."""
+        self._queue.join()
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for n in range(self.workers):
+                thread = threading.Thread(target=self._run, name="{}-{}".format(self.name, n), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _run(self):
+        while True:
+            submitted, fn, args = self._queue.get()
+            with self._lock:
+                self._in_flight += 1
+            try:
+                ok = self._attempt(fn, args)
+            finally:
+                with self._lock:
+                    self._in_flight -= 1
+                    self._latencies.append(time.monotonic() - submitted)
+                    if ok:
+                        self.completed += 1
+                    else:
+                        self.failed += 1
+                self._queue.task_done()
+
+    def _attempt(self, fn, args):
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(delay)
+                delay *= 2
+                with self._lock:
+                    self.retried += 1
+            try:
+                fn(*args)
+                return True
+            except Exception as ex:
+                log.warning("%s job failed (attempt %d of %d): %s", self.name, attempt + 1, self.retries + 1, ex)
+        return False
+
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return dict(
+                queue_depth=self._queue.qsize(),
+                in_flight=self._in_flight,
+                submitted=self.submitted,
+                rejected=self.rejected,
+                completed=self.completed,
+                failed=self.failed,
+                retried=self.retried,
+                latency_p50=percentile(latencies, 0.50),
+                latency_p95=percentile(latencies, 0.95),
+                latency_max=latencies[-1] if latencies else None,
+            )
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
@@ -9,12 +9,16 @@ setup(
     install_requires=[
         'pytest',
         'pytest-flask',
-        'Flask',
+        'Flask>=2.0',
         'googlemaps',
         'geopy',
+        'numpy',
         'toml',
         'thingsboard_api_tools @ https://github.com/eykamp/thingsboard_api_tools/archive/master.zip',
     ],
+    extras_require={
+        'production': ['gunicorn'],
+    },
     entry_points='''
         [console_scripts]
         rlgl=redlight_greenlight.redlight_greenlight:main
@@ -0,0 +1,16 @@
+import sys
+
+import pytest
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "mac_folders: the test creates device folders named after MAC addresses")
+
+
+def pytest_collection_modifyitems(config, items):
+    # Device folders are named after MAC addresses, and Windows doesn't allow ':' in file names
+    if sys.platform == "win32":
+        skip = pytest.mark.skip(reason="device folder names contain ':'")
+        for item in items:
+            if "mac_folders" in item.keywords:
+                item.add_marker(skip)
@@ -0,0 +1,41 @@
+import threading
+import time
+
+from redlight_greenlight.admission import AdmissionController
+
+
+def test_caps():
+    admission = AdmissionController(max_total=2, max_per_folder=1)
+    assert admission.acquire('a')
+    assert not admission.acquire('a')
+    assert admission.acquire('b')
+    assert not admission.acquire('c')
+
+    admission.release('a', 100)
+    assert admission.acquire('c')
+
+    stats = admission.stats()
+    assert stats['in_flight'] == 2
+    assert stats['rejected'] == 2
+    assert stats['bytes_sent'] == 100
+
+
+def test_wait_queue():
+    admission = AdmissionController(max_total=1, max_per_folder=1, max_wait=5, max_waiting=1)
+    assert admission.acquire('a')
+
+    # a second caller waits for the slot rather than being turned away
+    result = []
+    waiter = threading.Thread(target=lambda: result.append(admission.acquire('a')))
+    waiter.start()
+    deadline = time.monotonic() + 5
+    while admission.stats()['queue_depth'] == 0:
+        assert time.monotonic() < deadline, "waiter never queued"
+        time.sleep(0.001)
+
+    # the queue is full, so a third caller is rejected immediately
+    assert not admission.acquire('a')
+
+    admission.release('a')
+    waiter.join()
+    assert result == [True]
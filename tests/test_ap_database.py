@@ -0,0 +1,32 @@
+from redlight_greenlight.ap_database import AccessPointDatabase
+
+
+def hotspots(*macs, signal=-60):
+    return [{"macAddress": mac, "signalStrength": signal} for mac in macs]
+
+
+def test_estimate(tmpdir):
+    db = AccessPointDatabase(str(tmpdir / "aps.sqlite"), min_aps=3)
+
+    # two devices 1 km apart, each seeing their own access points plus two shared ones
+    db.observe(hotspots("AP1", "AP2", "SHARED1", "SHARED2"), (45.50, -122.65))
+    db.observe(hotspots("AP3", "AP4", "SHARED1", "SHARED2"), (45.51, -122.65))
+
+    (lat, lng), accuracy = db.estimate(hotspots("AP1", "AP2", "AP3"))
+    assert abs(lng + 122.65) < 1e-9
+    assert 45.50 < lat < 45.51
+
+    # strong signals pull the estimate towards their access points
+    (lat, _), _ = db.estimate(hotspots("AP1", "AP2", signal=-40) + hotspots("AP3", signal=-90))
+    assert lat < 45.501
+
+    (lat, lng), accuracy = db.estimate(hotspots("AP1", "AP2", "SHARED1"))
+    assert accuracy >= 25
+
+
+def test_not_enough_known_aps(tmpdir):
+    db = AccessPointDatabase(str(tmpdir / "aps.sqlite"), min_aps=3)
+    db.observe(hotspots("AP1", "AP2"), (45.50, -122.65))
+    assert db.estimate(hotspots("AP1", "AP2", "UNKNOWN")) is None
+    assert db.estimate(hotspots("AP1")) is None
+    assert db.stats() == dict(access_points=2, estimates=0, unknown=2)
@@ -0,0 +1,49 @@
+import os
+import sys
+from unittest.mock import Mock
+
+import pytest
+import requests
+
+pytest.importorskip("serial", reason="the management scripts need pyserial")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "management"))
+import birdhouse_utils  # noqa: E402
+
+
+URL = "http://localhost:8989/validate_token"
+
+
+def response(status_code, results=None):
+    return Mock(status_code=status_code, json=Mock(return_value={"results": results}))
+
+
+def test_validate_device_tokens(monkeypatch):
+    post = Mock(return_value=response(200, ["true", "bad_device"]))
+    monkeypatch.setattr(birdhouse_utils.requests, 'post', post)
+
+    assert birdhouse_utils.validate_device_tokens(URL, [(7, "abc"), ("Birdhouse 999", "xyz")]) == ["true", "bad_device"]
+    post.assert_called_once_with(URL, json=[{"name": "Birdhouse 007", "token": "abc"}, {"name": "Birdhouse 999", "token": "xyz"}],
+                                 timeout=10)
+
+
+def test_validate_device_tokens_retries(monkeypatch):
+    post = Mock(side_effect=[requests.exceptions.ConnectTimeout("timed out"), response(503), response(200, ["false"])])
+    sleep = Mock()
+    monkeypatch.setattr(birdhouse_utils.requests, 'post', post)
+    monkeypatch.setattr(birdhouse_utils.time, 'sleep', sleep)
+
+    assert birdhouse_utils.validate_device_tokens(URL, [(7, "abc")]) == ["false"]
+    assert [call.args for call in sleep.call_args_list] == [(1,), (2,)]
+
+    # a request the server rejects isn't retried
+    post = Mock(return_value=response(401))
+    monkeypatch.setattr(birdhouse_utils.requests, 'post', post)
+    with pytest.raises(Exception, match="code 401"):
+        birdhouse_utils.validate_device_tokens(URL, [(7, "abc")])
+    assert post.call_count == 1
+
+    post = Mock(return_value=response(503))
+    monkeypatch.setattr(birdhouse_utils.requests, 'post', post)
+    with pytest.raises(Exception, match="code 503"):
+        birdhouse_utils.validate_device_tokens(URL, [(7, "abc")], tries=2)
+    assert post.call_count == 2
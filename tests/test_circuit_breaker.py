@@ -0,0 +1,58 @@
+import time
+from unittest.mock import Mock
+
+import pytest
+
+from redlight_greenlight.circuit_breaker import CircuitBreaker, UpstreamUnavailable
+
+
+def test_opens_after_failures():
+    breaker = CircuitBreaker("upstream", failure_threshold=2, reset_timeout=60)
+    failing = Mock(side_effect=IOError("timeout"))
+
+    for _ in range(2):
+        with pytest.raises(IOError):
+            breaker.call(failing)
+    assert breaker.state == "open"
+
+    # refused without calling the upstream
+    with pytest.raises(UpstreamUnavailable) as ex:
+        breaker.call(failing)
+    assert failing.call_count == 2
+    assert 0 < ex.value.retry_after <= 60
+    assert breaker.stats()['rejected'] == 1
+
+
+def test_slow_calls_count_as_failures():
+    breaker = CircuitBreaker("upstream", failure_threshold=1, latency_budget=0.01)
+    assert breaker.call(lambda: time.sleep(0.02) or "late") == "late"
+    assert breaker.state == "open"
+    assert breaker.stats()['slow'] == 1
+
+
+def test_half_open_probe():
+    breaker = CircuitBreaker("upstream", failure_threshold=1, reset_timeout=0)
+    with pytest.raises(IOError):
+        breaker.call(Mock(side_effect=IOError))
+    assert breaker.state == "open"
+
+    # a failed probe reopens the circuit, a successful one closes it
+    with pytest.raises(IOError):
+        breaker.call(Mock(side_effect=IOError))
+    assert breaker.state == "open"
+    assert breaker.call(lambda: "ok") == "ok"
+    assert breaker.state == "closed"
+    assert breaker.stats()['times_opened'] == 2
+
+
+def test_max_concurrent():
+    breaker = CircuitBreaker("upstream", max_concurrent=1)
+
+    def nested():
+        with pytest.raises(UpstreamUnavailable):
+            breaker.call(lambda: None)
+        return "ok"
+
+    assert breaker.call(nested) == "ok"
+    assert breaker.stats()['rejected'] == 1
+    assert breaker.state == "closed"
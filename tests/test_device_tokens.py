@@ -0,0 +1,66 @@
+from unittest.mock import Mock
+
+from redlight_greenlight.device_tokens import DeviceTokenIndex
+
+
+def make_index(devices, **kwargs):
+    def list_page(page, page_size):
+        return devices[page * page_size:(page + 1) * page_size], (page + 1) * page_size < len(devices)
+    list_devices = Mock(side_effect=list_page)
+    get_device = Mock(side_effect=lambda name: next((d for d in devices if d["name"] == name), None))
+    get_token = Mock(side_effect=lambda device: device["token"])
+    return DeviceTokenIndex(list_devices, get_device, get_token, page_size=2, background=False, **kwargs)
+
+
+def test_refresh():
+    devices = [dict(name="d{}".format(n), id=n, token="t{}".format(n)) for n in range(5)]
+    index = make_index(devices)
+    index.refresh()
+    assert index.list_devices.call_count == 3
+    assert index.stats()['devices'] == 5
+
+    assert index.validate("d3", "t3") is True
+    assert index.validate("d3", "t4") is False
+    assert index.get_device.call_count == 0
+
+    # a reload only fetches tokens for devices it hasn't seen
+    devices.append(dict(name="d5", id=5, token="t5"))
+    index.refresh()
+    assert index.get_token.call_count == 6
+    assert index.validate("d5", "t5") is True
+
+
+def test_unknown_names():
+    devices = [dict(name="d0", id=0, token="t0")]
+    index = make_index(devices, negative_ttl=60)
+    index.refresh()
+
+    # unknown names are looked up once, then remembered
+    assert index.validate("nope", "t0") is None
+    assert index.validate("nope", "t0") is None
+    assert index.get_device.call_count == 1
+
+    # a device provisioned since the last reload is found by name
+    devices.append(dict(name="new", id=1, token="t1"))
+    assert index.validate("new", "t1") is True
+
+
+def test_regenerated_token():
+    devices = [dict(name="d0", id=0, token="old")]
+    index = make_index(devices, negative_ttl=0)
+    index.refresh()
+
+    devices[0]["token"] = "new"
+    assert index.validate("d0", "new") is True
+    assert index.validate("d0", "old") is False
+
+
+def test_validate_many():
+    devices = [dict(name="d{}".format(n), id=n, token="t{}".format(n)) for n in range(3)]
+    index = make_index(devices)
+    index.refresh()
+    devices.append(dict(name="new", id=3, token="t3"))
+
+    results = index.validate_many([("d0", "t0"), ("d1", "t0"), ("new", "t3"), ("nope", "t0")])
+    assert results == [True, False, True, None]
+    assert index.get_device.call_count == 2
@@ -0,0 +1,97 @@
+import gzip
+import hashlib
+import os
+
+import pytest
+from redlight_greenlight.firmware_catalog import FirmwareCatalog
+
+
+def test_catalog_caches_image(tmpdir):
+    fw_file = tmpdir / "1.0.bin"
+    fw_contents = b"hello, world\x01\x02"
+    fw_file.write(fw_contents, mode='wb')
+
+    catalog = FirmwareCatalog()
+    fw = catalog.get(str(fw_file))
+    assert fw.data == fw_contents
+    assert fw.md5 == hashlib.md5(fw_contents).hexdigest()
+    assert (catalog.hits, catalog.misses) == (0, 1)
+
+    # second lookup is served from memory
+    assert catalog.get(str(fw_file)) is fw
+    assert (catalog.hits, catalog.misses) == (1, 1)
+
+
+def test_catalog_reloads_changed_image(tmpdir):
+    fw_file = tmpdir / "1.0.bin"
+    fw_file.write(b"old image", mode='wb')
+
+    catalog = FirmwareCatalog()
+    old = catalog.get(str(fw_file))
+
+    # replace the image; bump mtime explicitly so the change is visible even on coarse-grained filesystems
+    fw_file.write(b"new image!", mode='wb')
+    os.utime(str(fw_file), ns=(old.mtime + 10**9, old.mtime + 10**9))
+
+    new = catalog.get(str(fw_file))
+    assert new.data == b"new image!"
+    assert new.md5 == hashlib.md5(b"new image!").hexdigest()
+    assert catalog.misses == 2
+
+
+def test_catalog_forgets_deleted_image(tmpdir):
+    fw_file = tmpdir / "1.0.bin"
+    fw_file.write(b"image", mode='wb')
+
+    catalog = FirmwareCatalog()
+    catalog.get(str(fw_file))
+    assert catalog.stats()['entries'] == 1
+
+    fw_file.remove()
+    with pytest.raises(FileNotFoundError):
+        catalog.get(str(fw_file))
+    assert catalog.stats()['entries'] == 0
+
+
+def test_catalog_digest_only(tmpdir):
+    fw_file = tmpdir / "1.0.bin"
+    fw_file.write(b"image", mode='wb')
+
+    catalog = FirmwareCatalog()
+    fw = catalog.get(str(fw_file), with_data=False)
+    assert fw.data is None
+    assert fw.md5 == hashlib.md5(b"image").hexdigest()
+    assert catalog.get(str(fw_file), with_data=False) is fw
+
+    # asking for the bytes later loads them
+    assert catalog.get(str(fw_file)).data == b"image"
+
+
+def test_catalog_compressed(tmpdir):
+    fw_file = tmpdir / "1.0.bin"
+    fw_file.write(b"image" * 100, mode='wb')
+
+    catalog = FirmwareCatalog()
+    gz = catalog.compressed(str(fw_file))
+    assert gz.path == str(fw_file) + ".gz"
+    assert gzip.decompress(gz.data) == b"image" * 100
+    assert gz.md5 == hashlib.md5(gz.data).hexdigest()
+
+    # the sibling is reused while it matches the image
+    assert catalog.compressed(str(fw_file)) is gz
+
+
+def test_catalog_compressed_replaced_by_older_image(tmpdir):
+    fw_file = tmpdir / "1.0.bin"
+    fw_file.write(b"new image" * 100, mode='wb')
+
+    catalog = FirmwareCatalog()
+    catalog.compressed(str(fw_file))
+
+    # roll back to an image built earlier, e.g. copied in with its original mtime kept
+    fw_file.write(b"old image!" * 100, mode='wb')
+    old_mtime = os.stat(str(fw_file)).st_mtime_ns - 3600 * 10**9
+    os.utime(str(fw_file), ns=(old_mtime, old_mtime))
+
+    gz = catalog.compressed(str(fw_file))
+    assert gzip.decompress(gz.data) == b"old image!" * 100
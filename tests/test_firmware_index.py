@@ -0,0 +1,75 @@
+import pytest
+
+from redlight_greenlight.firmware_index import FirmwareIndex
+
+
+MAC = '2C:3A:E8:08:2C:38'
+
+@pytest.mark.mac_folders
+def test_device_folders(tmpdir):
+    device_dir = tmpdir.mkdir('Birdhouse_001_' + MAC)
+    tmpdir.mkdir('Birdhouse_002_2C:3A:E8:08:2C:39')
+
+    index = FirmwareIndex(tmpdir)
+    assert index.device_folders(MAC.lower()) == [str(device_dir)]
+    assert index.device_folders('AA:BB:CC:DD:EE:FF') == []
+
+
+def test_latest(tmpdir):
+    for name in ["firmware_0.9.bin", "firmware_0.147.bin", "firmware_0.21.bin", "notes.txt"]:
+        (tmpdir / name).write(b"x", mode='wb')
+
+    index = FirmwareIndex(tmpdir)
+    assert [v[:2] for v in index.versions(tmpdir)] == [(0, 9), (0, 21), (0, 147)]
+    assert index.latest(tmpdir) == str(tmpdir / "firmware_0.147.bin")
+    assert index.latest(tmpdir, 0, 146) == str(tmpdir / "firmware_0.147.bin")
+    assert index.latest(tmpdir, 0, 147) is None
+    assert index.versions(tmpdir / "missing") is None
+
+
+@pytest.mark.mac_folders
+def test_index_picks_up_changes(tmpdir):
+    index = FirmwareIndex(tmpdir)
+    assert index.latest(tmpdir) is None
+    generation = index.generation
+
+    # new images show up without rebuilding the index
+    (tmpdir / "firmware_1.0.bin").write(b"x", mode='wb')
+    assert index.latest(tmpdir) == str(tmpdir / "firmware_1.0.bin")
+    assert index.generation > generation
+
+    device_dir = tmpdir.mkdir('Birdhouse_001_' + MAC)
+    assert index.device_folders(MAC) == [str(device_dir)]
+
+
+def test_settings_and_new_images(tmpdir):
+    seen = []
+    index = FirmwareIndex(tmpdir, on_new_image=seen.append)
+    (tmpdir / "firmware_1.0.bin").write(b"x", mode='wb')
+    (tmpdir / "firmware_1.0.bin.gz").write(b"x", mode='wb')
+    (tmpdir / "firmware.toml").write("gzip = true\n")
+
+    assert index.settings(tmpdir) == {'gzip': True}
+    assert seen == [str(tmpdir / "firmware_1.0.bin")]
+
+    # rescanning doesn't report the same image twice
+    (tmpdir / "firmware_1.1.bin").write(b"x", mode='wb')
+    index.versions(tmpdir)
+    assert seen == [str(tmpdir / "firmware_1.0.bin"), str(tmpdir / "firmware_1.1.bin")]
+
+
+def test_release_settings(tmpdir):
+    for name in ["firmware_0.9.bin", "firmware_0.10.bin", "firmware_0.11.bin"]:
+        (tmpdir / name).write(b"x", mode='wb')
+    index = FirmwareIndex(tmpdir)
+    assert index.latest(tmpdir, 0, 9) == str(tmpdir / "firmware_0.11.bin")
+    generation = index.generation
+
+    (tmpdir / "firmware.toml").write('blocked = ["0.11"]\n')
+    assert index.latest(tmpdir, 0, 9) == str(tmpdir / "firmware_0.10.bin")
+    assert index.latest(tmpdir, 0, 11) == str(tmpdir / "firmware_0.10.bin")
+    assert index.generation > generation
+
+    (tmpdir / "firmware.toml").write('pinned = "0.9"\n')
+    assert index.latest(tmpdir, 0, 11) == str(tmpdir / "firmware_0.9.bin")
+    assert index.latest(tmpdir, 0, 9) is None
@@ -0,0 +1,41 @@
+import hashlib
+import os
+
+from redlight_greenlight.firmware_store import FirmwareStore, import_tree
+
+
+def test_add_and_link(tmpdir):
+    store = FirmwareStore(tmpdir / ".store")
+    src = tmpdir / "build.bin"
+    src.write(b"image", mode='wb')
+
+    digest = store.add(str(src))
+    assert digest == hashlib.sha256(b"image").hexdigest()
+    assert store.add(str(src)) == digest
+
+    device_dir = tmpdir.mkdir('Birdhouse_001')
+    link = str(device_dir / "firmware_1.0.bin")
+    store.link(digest, link)
+    assert os.path.islink(link)
+    assert open(link, 'rb').read() == b"image"
+    assert store.digest_of(link) == digest
+    assert store.digest_of(str(src)) is None
+
+
+def test_path_for_rejects_bad_digests(tmpdir):
+    store = FirmwareStore(tmpdir)
+    assert store.path_for("../etc/passwd") is None
+    assert store.path_for("a" * 64) == os.path.join(str(tmpdir), "a" * 64 + ".bin")
+
+
+def test_import_tree(tmpdir):
+    for n in range(3):
+        device_dir = tmpdir.mkdir('Birdhouse_00{}'.format(n))
+        (device_dir / "firmware_1.0.bin").write(b"same image", mode='wb')
+
+    store = FirmwareStore(tmpdir / ".store")
+    assert import_tree(str(tmpdir), store) == 3
+    assert os.listdir(store.folder) == [hashlib.sha256(b"same image").hexdigest() + ".bin"]
+
+    # already-linked images are skipped
+    assert import_tree(str(tmpdir), store) == 0
@@ -0,0 +1,58 @@
+from redlight_greenlight.firmware_versions import VersionIndex, format_version, parse_version
+
+
+def test_parse_version():
+    assert parse_version("0.120") == (0, 120)
+    assert parse_version("0.12") == (0, 12)
+    assert parse_version("0.012") == (0, 12)
+    assert parse_version("firmware_1.7") == (1, 7)
+    assert parse_version("beta") is None
+    assert parse_version(0.120) is None    # an unquoted TOML version has already lost its trailing zero
+    assert format_version((0, 120)) == "0.120"
+
+
+def images(*names):
+    return [parse_version(name) + ("/fw/{}.bin".format(name),) for name in names]
+
+
+def test_newest_after():
+    releases = VersionIndex(images("0.9", "0.120", "0.12", "1.0"))
+    assert releases.keys == [(0, 9), (0, 12), (0, 120), (1, 0)]
+    assert releases.newest_after((0, 0)) == "/fw/1.0.bin"
+    assert releases.newest_after((0, 120)) == "/fw/1.0.bin"
+    assert releases.newest_after((1, 0)) is None
+    assert releases.newest_after((2, 0)) is None
+    assert releases.path((0, 12)) == "/fw/0.12.bin"
+    assert releases.path((0, 13)) is None
+    assert VersionIndex([]).newest_after((0, 0)) is None
+
+
+def test_duplicate_versions():
+    releases = VersionIndex(images("0.12", "0.012"))
+    assert len(releases) == 1
+    assert releases.paths == ["/fw/0.012.bin"]
+
+
+def test_blocked():
+    releases = VersionIndex(images("0.9", "0.10", "0.11"), dict(blocked=["0.11"]))
+    assert releases.newest_after((0, 9)) == "/fw/0.10.bin"
+    assert releases.newest_after((0, 10)) is None
+    # devices already running a blocked version are rolled back
+    assert releases.newest_after((0, 11)) == "/fw/0.10.bin"
+
+
+def test_pinned():
+    releases = VersionIndex(images("0.9", "0.10", "0.11"), dict(pinned="0.10"))
+    assert releases.newest_after((0, 9)) == "/fw/0.10.bin"
+    assert releases.newest_after((0, 10)) is None
+    assert releases.newest_after((0, 11)) == "/fw/0.10.bin"
+
+    # pinned to a version without an image, or to a blocked one: hold everyone where they are
+    assert VersionIndex(images("0.9"), dict(pinned="0.10")).newest_after((0, 0)) is None
+    assert VersionIndex(images("0.9", "0.10"), dict(pinned="0.10", blocked="0.10")).newest_after((0, 9)) is None
+
+
+def test_unquoted_settings_ignored():
+    releases = VersionIndex(images("0.9", "0.12"), dict(pinned=0.9, blocked=[0.12]))
+    assert releases.pinned is None and releases.blocked == frozenset()
+    assert releases.newest_after((0, 9)) == "/fw/0.12.bin"
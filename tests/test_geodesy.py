@@ -0,0 +1,21 @@
+import geopy.distance
+import numpy as np
+
+from redlight_greenlight.geodesy import distances
+
+
+def test_matches_geopy():
+    rng = np.random.default_rng(1)
+    origins = rng.uniform([-80, -180], [80, 180], (500, 2))
+    destinations = origins + rng.normal(0, 1, (500, 2))
+
+    expected = [geopy.distance.distance(a, b).m for a, b in zip(origins, destinations)]
+    assert np.allclose(distances(origins, destinations), expected, rtol=0, atol=0.01)
+
+
+def test_edge_cases():
+    meters = distances([(45.5, -122.6), (0, 0), (0, 0)], [(45.5, -122.6), (0, 1), (0.5, 179.7)])
+    assert meters[0] == 0
+    assert abs(meters[1] - geopy.distance.distance((0, 0), (0, 1)).m) < 0.01
+    # nearly antipodal points don't converge; the spherical fallback is within a fraction of a percent
+    assert abs(meters[2] / geopy.distance.distance((0, 0), (0.5, 179.7)).m - 1) < 0.005
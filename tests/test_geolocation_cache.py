@@ -0,0 +1,37 @@
+from redlight_greenlight.geolocation_cache import GeolocationCache, hotspot_fingerprint
+
+
+def test_fingerprint():
+    hotspots = [{"macAddress": "aa:bb:cc:dd:ee:0{}".format(n), "signalStrength": -40 - n} for n in range(8)]
+    fingerprint = hotspot_fingerprint(hotspots)
+
+    # order, case and the weakest access points don't matter
+    assert hotspot_fingerprint(list(reversed(hotspots))) == fingerprint
+    assert hotspot_fingerprint([dict(h, macAddress=h["macAddress"].upper()) for h in hotspots[:6]]) == fingerprint
+    assert hotspot_fingerprint(hotspots[1:]) != fingerprint
+    assert hotspot_fingerprint([]) is None
+
+
+def test_cache(tmpdir):
+    path = str(tmpdir / "cache.sqlite")
+    cache = GeolocationCache(path)
+    assert cache.get("abc") is None
+    cache.put("abc", (45.5, -122.6), 30)
+    assert cache.get("abc") == ((45.5, -122.6), 30)
+    assert cache.stats()['hit_ratio'] == 0.5
+    cache.close()
+
+    # entries survive a restart
+    assert GeolocationCache(path).get("abc") == ((45.5, -122.6), 30)
+
+
+def test_cache_expiry_and_eviction(tmpdir):
+    cache = GeolocationCache(str(tmpdir / "cache.sqlite"), ttl=0)
+    cache.put("abc", (45.5, -122.6), 30)
+    assert cache.get("abc") is None
+
+    cache = GeolocationCache(str(tmpdir / "cache2.sqlite"), max_entries=2)
+    for n in range(3):
+        cache.put(str(n), (45.5, -122.6), n)
+    assert cache.get("0") is None
+    assert cache.get("2") == ((45.5, -122.6), 2)
@@ -0,0 +1,29 @@
+from redlight_greenlight.hotspot_tracker import HotspotTracker, signal_weights, similarity
+
+
+HOTSPOTS = [{"macAddress": "aa:bb:cc:dd:ee:0{}".format(n), "signalStrength": -40 - 10 * n} for n in range(5)]
+
+
+def score(before, after):
+    previous = signal_weights(before)
+    return similarity(previous, sum(previous.values()), signal_weights(after))
+
+
+def test_similarity():
+    assert score(HOTSPOTS, HOTSPOTS) == 1.0
+    assert score(HOTSPOTS, HOTSPOTS[:1]) < score(HOTSPOTS, HOTSPOTS[:4]) < 1.0
+    assert score(HOTSPOTS[:2], HOTSPOTS[2:]) == 0.0
+
+    # losing a weak access point matters less than losing a strong one
+    assert score(HOTSPOTS, HOTSPOTS[:-1]) > score(HOTSPOTS, HOTSPOTS[1:])
+
+
+def test_tracker():
+    tracker = HotspotTracker(threshold=0.8)
+    assert tracker.lookup("device", HOTSPOTS) is None
+
+    tracker.remember("device", HOTSPOTS, (45.5, -122.6), (45.5, -122.6), 30, {"wifiDistance": 8})
+    assert tracker.lookup("device", HOTSPOTS[:-1]).result == {"wifiDistance": 8}
+    assert tracker.lookup("device", HOTSPOTS[2:]) is None
+    assert tracker.lookup("other device", HOTSPOTS) is None
+    assert tracker.stats() == dict(devices=1, unchanged=1, changed=3)
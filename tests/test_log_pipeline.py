@@ -0,0 +1,126 @@
+import json
+import logging
+import threading
+
+from redlight_greenlight.log_pipeline import JsonFormatter, LogPipeline, RouteSampler, build_handlers, configure, sampled
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def make_logger(pipeline, name):
+    logger = logging.getLogger("test_log_pipeline." + name)
+    logger.handlers = [pipeline.handler]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    return logger
+
+
+def test_records_written_by_background_thread():
+    handler = ListHandler()
+    pipeline = LogPipeline(lambda: [handler])
+    log = make_logger(pipeline, "background")
+    log.info("hello %s", "world", extra=dict(mac="AA:BB"))
+    pipeline.stop()
+
+    [record] = handler.records
+    assert record.getMessage() == "hello world"
+    assert record.mac == "AA:BB"
+
+
+def test_sampling_per_route():
+    handler = ListHandler()
+    pipeline = LogPipeline(lambda: [handler], sampler=RouteSampler(1.0, {"/update": 0}))
+    log = make_logger(pipeline, "sampling")
+    log.info("chatty", extra=sampled(route="/update"))
+    log.info("not sampled", extra=dict(route="/update"))
+    log.info("other route", extra=sampled(route="/wifi_location"))
+    pipeline.stop()
+
+    assert [r.getMessage() for r in handler.records] == ["not sampled", "other route"]
+    assert pipeline.stats()['sampled_out'] == 1
+
+
+def test_full_queue_drops_rather_than_blocks():
+    writing, release = threading.Event(), threading.Event()
+
+    class SlowHandler(ListHandler):
+        def emit(self, record):
+            writing.set()
+            release.wait(5)
+            super().emit(record)
+
+    handler = SlowHandler()
+    pipeline = LogPipeline(lambda: [handler], max_queued=1)
+    log = make_logger(pipeline, "full")
+    log.info("first")
+    assert writing.wait(5)     # the writer thread is stuck on the first record
+    log.info("queued")
+    log.info("dropped")
+    assert pipeline.stats()['dropped'] == 1
+
+    release.set()
+    pipeline.stop()
+    assert [r.getMessage() for r in handler.records] == ["first", "queued"]
+
+
+def test_json_format():
+    record = logging.LogRecord("rlgl", logging.INFO, __file__, 1, "Upgrading to %s", ("1.2",), None)
+    record.mac = "AA:BB"
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry['message'] == "Upgrading to 1.2"
+    assert entry['level'] == "INFO"
+    assert entry['mac'] == "AA:BB"
+
+
+def test_file_per_process(tmpdir):
+    [handler] = build_handlers(dict(log_file=str(tmpdir / "logs" / "rlgl-{pid}.log"), log_max_bytes=100, log_backups=2))
+    assert isinstance(handler, logging.handlers.RotatingFileHandler)
+    assert str(tmpdir) in handler.baseFilename and "{pid}" not in handler.baseFilename
+    handler.close()
+
+
+def test_configure_replaces_pipeline(tmpdir, monkeypatch):
+    # leave the app's own pipeline in place for the other tests
+    root = logging.getLogger("redlight_greenlight")
+    monkeypatch.setattr(root, 'handlers', list(root.handlers))
+    monkeypatch.setattr(root, 'level', root.level)
+
+    log_file = tmpdir / "rlgl.log"
+    first = configure(dict(log_file=str(log_file), log_format="json"))
+    second = configure(dict(log_file=str(log_file), log_format="json"))
+    logger = logging.getLogger("redlight_greenlight.test")
+    assert second.handler in root.handlers and first.handler not in root.handlers
+
+    logger.info("written", extra=dict(mac="AA:BB"))
+    second.stop()
+    entry = json.loads(log_file.read().splitlines()[-1])
+    assert entry['message'] == "written" and entry['mac'] == "AA:BB"
+
+
+def test_formatted_by_background_thread():
+    formatted_on = []
+
+    class Arg:
+        def __str__(self):
+            formatted_on.append(threading.current_thread())
+            return "arg"
+
+    handler = ListHandler()
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    handler.emit = lambda record: handler.records.append(handler.format(record))
+    made = []
+    pipeline = LogPipeline(lambda: made.append(handler) or [handler])
+    pipeline.start()
+    assert made == [handler]    # handlers are open before the first record
+
+    make_logger(pipeline, "formatting").info("hello %s", Arg())
+    pipeline.stop()
+    assert handler.records == ["hello arg"]
+    assert formatted_on and threading.current_thread() not in formatted_on
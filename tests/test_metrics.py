@@ -0,0 +1,74 @@
+import json
+import os
+import threading
+
+from redlight_greenlight.metrics import Metrics
+
+
+def test_counters_from_many_threads():
+    metrics = Metrics()
+
+    def work():
+        for _ in range(1000):
+            metrics.inc('requests_total', (("route", "/update"),))
+
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    metrics.inc('requests_total', (("route", "/update"),))
+
+    # the shards of the finished threads are folded together
+    counters, _ = metrics.totals()
+    assert counters[('requests_total', (("route", "/update"),))] == 4001
+    counters, _ = metrics.totals()
+    assert counters[('requests_total', (("route", "/update"),))] == 4001
+
+
+def test_render():
+    metrics = Metrics(buckets=(0.1, 1))
+    metrics.describe('latency_seconds', 'histogram', "How long things take")
+    metrics.observe('latency_seconds', (("route", "/update"),), 0.05)
+    metrics.observe('latency_seconds', (("route", "/update"),), 0.5)
+    metrics.observe('latency_seconds', (("route", "/update"),), 5)
+    text = metrics.render([('queue_depth', (), 3), ('hit_ratio', (), None)])
+
+    assert "# HELP latency_seconds How long things take\n# TYPE latency_seconds histogram\n" in text
+    assert 'latency_seconds_bucket{route="/update",le="0.1"} 1\n' in text
+    assert 'latency_seconds_bucket{route="/update",le="1.0"} 2\n' in text
+    assert 'latency_seconds_bucket{route="/update",le="+Inf"} 3\n' in text
+    assert 'latency_seconds_count{route="/update"} 3\n' in text
+    assert 'latency_seconds_sum{route="/update"} 5.55\n' in text
+    assert "# TYPE queue_depth gauge\nqueue_depth 3\n" in text
+    assert "hit_ratio" not in text
+
+
+def test_hit_ratio():
+    metrics = Metrics()
+    metrics.ratio('hit_ratio', 'hits_total', 'misses_total', "Fraction of lookups answered by the cache")
+    text = metrics.render([('hits_total', (("cache", "a"),), 3), ('misses_total', (("cache", "a"),), 1),
+                           ('hits_total', (("cache", "b"),), 0), ('misses_total', (("cache", "b"),), 0)])
+    assert 'hit_ratio{cache="a"} 0.75\n' in text
+    assert 'hit_ratio{cache="b"}' not in text
+
+
+def test_shared_across_processes(tmpdir):
+    metrics = Metrics(directory=str(tmpdir))
+    metrics.describe('queue_depth', 'gauge', "Jobs waiting")
+    metrics.describe('in_flight', 'gauge', "Requests being handled")
+    metrics.inc('requests_total', (("route", "/update"),), 2)
+
+    # another worker that has since exited: its counters still count, its gauges don't
+    exited = dict(counters=[['requests_total', [["route", "/update"]], 5], ['in_flight', [], 1]],
+                  histograms=[],
+                  collected=[['queue_depth', [], 7], ['rejected_total', [], 4]])
+    tmpdir.join("999999999.json").write(json.dumps(exited))
+
+    text = metrics.render([('queue_depth', (), 1), ('rejected_total', (), 1)])
+    assert 'requests_total{route="/update"} 7\n' in text
+    assert 'queue_depth 1\n' in text
+    assert 'in_flight' not in text
+    assert 'rejected_total 5\n' in text
+    assert tmpdir.join("{}.json".format(os.getpid())).check()
+    assert metrics.publish_due() is False
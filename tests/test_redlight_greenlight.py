@@ -1,11 +1,41 @@
 import pytest
 from redlight_greenlight import redlight_greenlight
 import hashlib
+import gzip
+import logging
+import pstats
+import subprocess
+import sys
+import threading
+import time
 from unittest.mock import Mock
+from redlight_greenlight.admission import AdmissionController
+from redlight_greenlight.circuit_breaker import CircuitBreaker
+from redlight_greenlight.hotspot_tracker import HotspotTracker
+from redlight_greenlight.log_pipeline import LogPipeline, RouteSampler
+from redlight_greenlight.request_profiler import RequestProfiler
+
+
+def wait_until(condition, timeout=5):
+    # Fails the test rather than hanging the suite if the other threads never get there
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out waiting for other threads"
+        time.sleep(0.001)
 
 
 @pytest.fixture
-def app():
+def app(tmpdir, monkeypatch):
+    # keep the geolocation databases out of the user's cache folder
+    monkeypatch.setitem(redlight_greenlight.CFG, 'geolocation_cache_path', str(tmpdir / 'geolocation.sqlite'))
+    monkeypatch.setattr(redlight_greenlight, 'geolocation_cache', None)
+    monkeypatch.setitem(redlight_greenlight.CFG, 'ap_database_path', str(tmpdir / 'access_points.sqlite'))
+    monkeypatch.setattr(redlight_greenlight, 'ap_database', None)
+    monkeypatch.setattr(redlight_greenlight, 'location_workers', None)
+    monkeypatch.setattr(redlight_greenlight, 'device_tokens', None)
+    monkeypatch.setitem(redlight_greenlight.CFG, 'device_token_background_refresh', False)
+    monkeypatch.setattr(redlight_greenlight, 'google_breaker', CircuitBreaker("Google geolocation", failure_threshold=2))
+    monkeypatch.setattr(redlight_greenlight, 'thingsboard_breaker', CircuitBreaker("ThingsBoard", failure_threshold=2))
     app = redlight_greenlight.app
     return app
 
@@ -64,6 +94,40 @@ def test_validate_token(client):
     resp = client.get('/validate_token', query_string=dict(name='valid_name', token='valid_token'))
     assert resp.data == b"true"
 
+    # a device that doesn't exist
+    tbapi.get_device_by_name.return_value = None
+    resp = client.get('/validate_token', query_string=dict(name='missing_name', token='abcd'))
+    assert resp.data == b"bad_device"
+
+
+def test_validate_token_index(client, monkeypatch):
+    tbapi = Mock()
+    tbapi.get.side_effect = [
+        {"data": [{"name": "device-1", "id": 1}], "hasNext": True},
+        {"data": [{"name": "device-2", "id": 2}], "hasNext": False},
+    ]
+    tbapi.get_device_token.side_effect = lambda device: "token-{}".format(device["id"])
+    monkeypatch.setattr(redlight_greenlight, 'get_tbapi', Mock(return_value=tbapi))
+
+    redlight_greenlight.get_device_tokens().refresh()
+    assert tbapi.get_device_token.call_count == 2
+
+    # answered from the index, without asking ThingsBoard
+    resp = client.get('/validate_token', query_string=dict(name='device-2', token='token-2'))
+    assert resp.data == b"true"
+    resp = client.get('/validate_token', query_string=dict(name='device-1', token='token-2'))
+    assert resp.data == b"false"
+    assert not tbapi.get_device_by_name.called
+    assert tbapi.get_device_token.call_count == 2
+
+    # many at once
+    tbapi.get_device_by_name.return_value = None
+    resp = client.post('/validate_token', json=[dict(name='device-1', token='token-1'),
+                                                dict(name='device-2', token='wrong'),
+                                                dict(name='device-3', token='token-3')])
+    assert resp.json['results'] == ["true", "false", "bad_device"]
+    assert client.post('/validate_token', json=[dict(name='device-1')]).status_code == 401
+
 
 def test_update(client, tmpdir):
     fw_dir = tmpdir.mkdir('firmwares')
@@ -87,3 +151,520 @@ def test_update(client, tmpdir):
     resp = client.get('/update', headers=headers)
     assert resp.status_code == 200
     assert resp.data == fw_contents
+
+    # a version we can't parse is refused rather than guessed at
+    headers = dict(HTTP_X_ESP8266_VERSION='unknown', HTTP_X_ESP8266_STA_MAC='aa:bb:cc:dd:ee:ff')
+    assert client.get('/update', headers=headers).status_code == 400
+
+
+def test_update_pinned_version(client, tmpdir):
+    fw_dir = tmpdir.mkdir('firmwares')
+    redlight_greenlight.CFG['firmware_images_folder'] = str(fw_dir)
+    fw_dir.join('0.120.bin').write_binary(b'known good')
+    fw_dir.join('0.121.bin').write_binary(b'bad build')
+    fw_dir.join('firmware.toml').write('pinned = "0.120"\n')
+
+    # devices that took the bad build are rolled back; /firmware hands out the pinned version too
+    headers = dict(HTTP_X_ESP8266_VERSION='0.121', HTTP_X_ESP8266_STA_MAC='aa:bb:cc:dd:ee:ff')
+    resp = client.get('/update', headers=headers)
+    assert resp.status_code == 200 and resp.data == b'known good'
+    assert client.get('/firmware').data == b'known good'
+
+    headers = dict(HTTP_X_ESP8266_VERSION='0.120', HTTP_X_ESP8266_STA_MAC='aa:bb:cc:dd:ee:ff')
+    assert client.get('/update', headers=headers).status_code == 302
+
+
+@pytest.mark.mac_folders
+def test_update_device_folder(client, tmpdir):
+    fw_dir = tmpdir.mkdir('firmwares')
+    redlight_greenlight.CFG['firmware_images_folder'] = fw_dir
+    (fw_dir / "1.0.bin").write(b"generic firmware")
+
+    # a device with a dedicated folder only gets firmware from that folder
+    device_dir = fw_dir.mkdir('Birdhouse_001_AA:BB:CC:DD:EE:FF')
+    (device_dir / "1.1.bin").write(b"device firmware")
+
+    headers = dict(HTTP_X_ESP8266_VERSION='0.9', HTTP_X_ESP8266_STA_MAC='aa:bb:cc:dd:ee:ff')
+    resp = client.get('/update', headers=headers)
+    assert resp.status_code == 200
+    assert resp.data == b"device firmware"
+
+    headers = dict(HTTP_X_ESP8266_VERSION='0.9', HTTP_X_ESP8266_STA_MAC='11:22:33:44:55:66')
+    resp = client.get('/update', headers=headers)
+    assert resp.data == b"generic firmware"
+
+
+@pytest.mark.parametrize('delivery', ['stream', 'memory'])
+def test_firmware_conditional(client, tmpdir, monkeypatch, delivery):
+    fw_dir = tmpdir.mkdir('firmwares')
+    redlight_greenlight.CFG['firmware_images_folder'] = fw_dir
+    monkeypatch.setitem(redlight_greenlight.CFG, 'firmware_delivery', delivery)
+    fw_contents = b"hello, world\x01\x02"
+    (fw_dir / "1.0.bin").write(fw_contents)
+    md5 = hashlib.md5(fw_contents).hexdigest()
+
+    # HEAD returns the headers without a body
+    resp = client.head('/firmware')
+    assert resp.status_code == 200
+    assert resp.data == b""
+    assert resp.headers['ETag'] == '"{}"'.format(md5)
+    assert int(resp.headers['Content-Length']) == len(fw_contents)
+
+    # a device that already has this image gets a 304
+    resp = client.get('/firmware', headers={'If-None-Match': '"{}"'.format(md5)})
+    assert resp.status_code == 304
+
+    # interrupted downloads can resume with a Range request
+    resp = client.get('/firmware', headers={'Range': 'bytes=5-'})
+    assert resp.status_code == 206
+    assert resp.data == fw_contents[5:]
+    assert resp.headers['X-MD5'] == md5
+
+
+def test_update_sketch_md5(client, tmpdir):
+    fw_dir = tmpdir.mkdir('firmwares')
+    redlight_greenlight.CFG['firmware_images_folder'] = fw_dir
+    fw_contents = b"new firmware\x01\x02"
+    (fw_dir / "1.0.bin").write(fw_contents)
+
+    # device reports an old version string but is already running this exact image
+    headers = {'x-ESP8266-version': '0.9', 'x-ESP8266-sta-mac': 'aa:bb:cc:dd:ee:ff',
+               'x-ESP8266-sketch-md5': hashlib.md5(fw_contents).hexdigest(), 'x-ESP8266-sketch-size': str(len(fw_contents))}
+    resp = client.get('/update', headers=headers)
+    assert resp.status_code == 304
+
+    # a different sketch gets the image
+    headers['x-ESP8266-sketch-md5'] = hashlib.md5(b"old firmware").hexdigest()
+    headers['x-ESP8266-version'] = '0.8'
+    resp = client.get('/update', headers=headers)
+    assert resp.status_code == 200
+    assert resp.data == fw_contents
+
+
+def test_update_already_latest_cache(client, tmpdir):
+    fw_dir = tmpdir.mkdir('firmwares')
+    redlight_greenlight.CFG['firmware_images_folder'] = fw_dir
+    (fw_dir / "1.0.bin").write(b"firmware")
+
+    headers = dict(HTTP_X_ESP8266_VERSION='1.0', HTTP_X_ESP8266_STA_MAC='aa:bb:cc:dd:ee:ff')
+    assert client.get('/update', headers=headers).status_code == 302
+    hits = redlight_greenlight.already_latest_cache.hits
+    assert client.get('/update', headers=headers).status_code == 302
+    assert redlight_greenlight.already_latest_cache.hits == hits + 1
+
+    # once the index notices a new image, the cached answer no longer applies
+    (fw_dir / "1.1.bin").write(b"newer firmware")
+    redlight_greenlight.get_firmware_index().versions(fw_dir)
+    resp = client.get('/update', headers=headers)
+    assert resp.status_code == 200
+    assert resp.data == b"newer firmware"
+
+
+def test_firmware_admission(client, tmpdir, monkeypatch):
+    fw_dir = tmpdir.mkdir('firmwares')
+    redlight_greenlight.CFG['firmware_images_folder'] = fw_dir
+    (fw_dir / "1.0.bin").write(b"firmware")
+
+    admission = AdmissionController(max_total=10, max_per_folder=1)
+    monkeypatch.setattr(redlight_greenlight, 'ota_admission', admission)
+
+    # with the folder's only slot taken, the next download is turned away cheaply
+    assert admission.acquire(str(fw_dir))
+    resp = client.get('/firmware')
+    assert resp.status_code == 503
+    assert 'Retry-After' in resp.headers
+    assert client.get('/status').json['ota']['rejected'] == 1
+
+    # the slot is freed once the transfer finishes
+    admission.release(str(fw_dir))
+    resp = client.get('/firmware')
+    assert resp.status_code == 200
+    assert admission.stats()['in_flight'] == 1
+    resp.close()
+    assert admission.stats()['in_flight'] == 0
+    assert admission.stats()['bytes_sent'] == len(b"firmware")
+
+
+def test_firmware_gzip(client, tmpdir):
+    fw_dir = tmpdir.mkdir('firmwares')
+    redlight_greenlight.CFG['firmware_images_folder'] = fw_dir
+    fw_contents = b"hello, world\x01\x02" * 100
+    (fw_dir / "1.0.bin").write(fw_contents)
+
+    # older clients get the raw image
+    resp = client.get('/firmware')
+    assert resp.data == fw_contents
+    assert 'Content-Encoding' not in resp.headers
+
+    # the compressed sibling was written when the image was indexed
+    gz_contents = (fw_dir / "1.0.bin.gz").read_binary()
+    assert gzip.decompress(gz_contents) == fw_contents
+
+    resp = client.get('/firmware', headers={'Accept-Encoding': 'gzip'})
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    assert resp.data == gz_contents
+    assert resp.headers['X-MD5'] == hashlib.md5(gz_contents).hexdigest()
+
+    # an explicit refusal, or an encoding that merely contains "gzip", gets the raw image
+    for accept in ['gzip;q=0', 'x-gzip-foo', 'deflate, gzip;q=0']:
+        resp = client.get('/firmware', headers={'Accept-Encoding': accept})
+        assert 'Content-Encoding' not in resp.headers
+        assert resp.data == fw_contents
+
+    # a folder can opt in for devices that don't advertise support
+    (fw_dir / "1.1.bin").write(fw_contents)
+    (fw_dir / "firmware.toml").write("gzip = true\n")
+    headers = dict(HTTP_X_ESP8266_VERSION='1.0', HTTP_X_ESP8266_STA_MAC='aa:bb:cc:dd:ee:ff')
+    resp = client.get('/update', headers=headers)
+    assert resp.status_code == 200
+    assert gzip.decompress(resp.data) == fw_contents
+
+    # but not for a client that refuses gzip
+    resp = client.get('/update', headers=dict(headers, **{'Accept-Encoding': 'gzip;q=0'}))
+    assert resp.data == fw_contents
+
+
+def test_firmware_by_hash(client, tmpdir):
+    fw_dir = tmpdir.mkdir('firmwares')
+    redlight_greenlight.CFG['firmware_images_folder'] = fw_dir
+    fw_contents = b"shared firmware"
+    digest = hashlib.sha256(fw_contents).hexdigest()
+
+    store = redlight_greenlight.get_firmware_store()
+    (tmpdir / "build.bin").write(fw_contents)
+    store.link(store.add(str(tmpdir / "build.bin")), str(fw_dir / "1.0.bin"))
+
+    # the latest image points at its hash URL
+    resp = client.get('/firmware')
+    assert resp.data == fw_contents
+    assert resp.headers['Content-Location'] == '/firmware/' + digest
+
+    resp = client.get('/firmware/' + digest)
+    assert resp.status_code == 200
+    assert resp.data == fw_contents
+    assert 'immutable' in resp.headers['Cache-Control']
+
+    assert client.get('/firmware/' + 'a' * 64).status_code == 404
+    assert client.get('/firmware/not-a-hash').status_code == 404
+
+
+def test_import_is_lazy():
+    # importing the module must not log in to ThingsBoard or pull in the geolocation libraries
+    code = ("import sys; from redlight_greenlight import redlight_greenlight as r; "
+            "assert r.tbapi is None; "
+            "assert not {'googlemaps', 'geopy', 'thingsboard_api_tools'} & set(sys.modules)")
+    subprocess.run([sys.executable, "-c", code], check=True, stdout=subprocess.DEVNULL)
+
+
+def test_post_fork(monkeypatch):
+    monkeypatch.setattr(redlight_greenlight, 'tbapi', Mock())
+    hook = Mock()
+    monkeypatch.setattr(redlight_greenlight, 'post_fork_hooks', [hook])
+
+    redlight_greenlight.post_fork()
+    assert redlight_greenlight.tbapi is None
+    hook.assert_called_once_with()
+
+    # the factory builds independent apps with every route
+    app = redlight_greenlight.create_app()
+    assert app is not redlight_greenlight.app
+    assert {'/update', '/firmware', '/wifi_location', '/validate_token'} <= {rule.rule for rule in app.url_map.iter_rules()}
+
+
+def test_gmaps_client_is_reused(monkeypatch):
+    monkeypatch.setitem(redlight_greenlight.CFG, 'google_geolocation_key', 'AIza-not-a-real-key')
+    monkeypatch.setattr(redlight_greenlight, 'gmaps_client', None)
+
+    client = redlight_greenlight.get_gmaps_client()
+    assert redlight_greenlight.get_gmaps_client() is client
+    assert client.session.get_adapter("https://maps.googleapis.com")._pool_maxsize == 10
+    # a lookup gives up once it has used the breaker's latency budget
+    budget = redlight_greenlight.google_breaker.latency_budget
+    assert client.timeout[1] == budget and client.retry_timeout.total_seconds() == budget
+
+    # each worker builds its own after forking
+    redlight_greenlight.post_fork()
+    assert redlight_greenlight.get_gmaps_client() is not client
+
+
+def test_wifi_location_cache(client):
+    geolocate_mock = Mock(return_value={'location': {'lat': 45.5007334, 'lng': -122.6445077}, 'accuracy': 30})
+    redlight_greenlight.get_geolocate = Mock(return_value=geolocate_mock)
+
+    hotspots = [{"macAddress": "B0:B2:DC:D5:0F:1D", "signalStrength": -78}, {"macAddress": "2E:3A:E8:08:2C:38", "signalStrength": -69}]
+    request_data = dict(latitude=45.50080533, longitude=-122.64446517, visibleHotspots=hotspots)
+    first = client.post('/wifi_location', json=request_data)
+
+    # the same access points reported again (in a different order) are answered without calling Google
+    request_data['visibleHotspots'] = list(reversed(hotspots))
+    second = client.post('/wifi_location', json=request_data)
+    assert geolocate_mock.call_count == 1
+    assert second.json == first.json
+    assert client.get('/status').json['geolocation_cache']['hits'] == 1
+
+
+def test_wifi_location_unchanged_device(client, monkeypatch):
+    monkeypatch.setattr(redlight_greenlight, 'hotspot_tracker', HotspotTracker())
+    geolocate_mock = Mock(return_value={'location': {'lat': 45.5007334, 'lng': -122.6445077}, 'accuracy': 30})
+    redlight_greenlight.get_geolocate = Mock(return_value=geolocate_mock)
+    get_geolocation_cache = Mock(wraps=redlight_greenlight.get_geolocation_cache)
+    monkeypatch.setattr(redlight_greenlight, 'get_geolocation_cache', get_geolocation_cache)
+
+    hotspots = [{"macAddress": "B0:B2:DC:D5:0F:1D", "signalStrength": -78}, {"macAddress": "2E:3A:E8:08:2C:38", "signalStrength": -69}]
+    request_data = dict(latitude=45.50080533, longitude=-122.64446517, visibleHotspots=hotspots, macAddress="AA:BB:CC:DD:EE:FF")
+    first = client.post('/wifi_location', json=request_data)
+    lookups = get_geolocation_cache.call_count
+
+    # small signal changes: neither the cache nor Google is consulted again
+    request_data['visibleHotspots'] = [dict(hotspots[0], signalStrength=-80), hotspots[1]]
+    assert client.post('/wifi_location', json=request_data).json == first.json
+    assert get_geolocation_cache.call_count == lookups
+
+    # a different set of access points means the device may have moved
+    request_data['visibleHotspots'] = [{"macAddress": "B6:E6:2D:25:87:C5", "signalStrength": -31}]
+    client.post('/wifi_location', json=request_data)
+    assert geolocate_mock.call_count == 2
+
+
+def test_wifi_location_local_estimate(client):
+    geolocate_mock = Mock(return_value={'location': {'lat': 45.5007334, 'lng': -122.6445077}, 'accuracy': 30})
+    redlight_greenlight.get_geolocate = Mock(return_value=geolocate_mock)
+
+    # Google confirms where the device is, which teaches us where its access points are
+    hotspots = [{"macAddress": "AA:BB:CC:DD:EE:0{}".format(n), "signalStrength": -50 - n} for n in range(4)]
+    request_data = dict(latitude=45.50080533, longitude=-122.64446517, visibleHotspots=hotspots)
+    client.post('/wifi_location', json=request_data)
+    assert geolocate_mock.call_count == 1
+
+    # a different subset of the same access points is now located without Google
+    request_data['visibleHotspots'] = hotspots[1:]
+    resp = client.post('/wifi_location', json=request_data)
+    assert geolocate_mock.call_count == 1
+    assert resp.json['wifiDistance'] < 1
+
+
+def test_wifi_location_async(client, monkeypatch):
+    monkeypatch.setitem(redlight_greenlight.CFG, 'wifi_location_async', True)
+    monkeypatch.setitem(redlight_greenlight.CFG, 'wifi_location_retry_delay', 0)
+    geolocate_mock = Mock(return_value={'location': {'lat': 45.5007334, 'lng': -122.6445077}, 'accuracy': 30})
+    redlight_greenlight.get_geolocate = Mock(return_value=geolocate_mock)
+    tbapi = Mock()
+    tbapi.send_telemetry.side_effect = [Exception("ThingsBoard is down"), None]
+    monkeypatch.setattr(redlight_greenlight, 'get_tbapi', Mock(return_value=tbapi))
+
+    hotspots = [{"macAddress": "B0:B2:DC:D5:0F:1D", "signalStrength": -78}]
+    request_data = dict(latitude=45.50080533, longitude=-122.64446517, visibleHotspots=hotspots)
+
+    # nowhere to deliver the result without a device token
+    assert client.post('/wifi_location', json=request_data).status_code == 400
+
+    request_data['device_token'] = "TOKEN"
+    resp = client.post('/wifi_location', json=request_data)
+    assert resp.status_code == 202
+
+    # the worker retries the failed telemetry upload without asking Google again
+    redlight_greenlight.get_location_workers().join()
+    assert geolocate_mock.call_count == 1
+    assert tbapi.send_telemetry.call_count == 2
+    device_token, outgoing_data = tbapi.send_telemetry.call_args[0]
+    assert device_token == "TOKEN"
+    assert int(outgoing_data['wifiDistance']) == 8
+
+    stats = client.get('/status').json['wifi_location_workers']
+    assert stats['completed'] == 1
+    assert stats['retried'] == 1
+
+
+@pytest.mark.parametrize('async_mode', [False, True])
+def test_wifi_location_bad_hotspots(client, monkeypatch, async_mode):
+    monkeypatch.setitem(redlight_greenlight.CFG, 'wifi_location_async', async_mode)
+    geolocate_mock = Mock()
+    redlight_greenlight.get_geolocate = Mock(return_value=geolocate_mock)
+
+    for hotspots in ["abc", [1, 2], [{"macAddress": 5}], [{"macAddress": "B0:B2:DC:D5:0F:1D", "signalStrength": "loud"}]]:
+        request_data = dict(device_token="TOKEN", latitude=45.5, longitude=-122.6, visibleHotspots=hotspots)
+        assert client.post('/wifi_location', json=request_data).status_code == 400
+    assert geolocate_mock.call_count == 0
+    assert redlight_greenlight.get_location_workers().stats()['queue_depth'] == 0
+
+
+def test_wifi_location_batch(client, monkeypatch):
+    def geolocate(wifi_access_points):
+        if wifi_access_points[0]["macAddress"] == "00:00:00:00:00:00":
+            return {"error": "not found"}
+        return {'location': {'lat': 45.5007334, 'lng': -122.6445077}, 'accuracy': 30}
+    geolocate_mock = Mock(side_effect=geolocate)
+    redlight_greenlight.get_geolocate = Mock(return_value=geolocate_mock)
+    tbapi = Mock()
+    monkeypatch.setattr(redlight_greenlight, 'get_tbapi', Mock(return_value=tbapi))
+
+    assert client.post('/wifi_location/batch', json={}).status_code == 400
+
+    def report(token, mac):
+        return dict(device_token=token, latitude=45.50080533, longitude=-122.64446517,
+                    visibleHotspots=[{"macAddress": mac, "signalStrength": -60}])
+    reports = [report("A", "B0:B2:DC:D5:0F:1D"), "garbage", report("B", "00:00:00:00:00:00"), report("C", "2E:3A:E8:08:2C:38")]
+    resp = client.post('/wifi_location/batch', json=reports)
+    assert resp.status_code == 200
+
+    results = resp.json['results']
+    assert int(results[0]['wifiDistance']) == 8
+    assert results[0]['wifiDistanceAccuracy'] == 30
+    assert 'error' in results[1]
+    assert 'error' in results[2]
+    assert int(results[3]['wifiDistance']) == 8
+
+    # telemetry goes only to the devices that were located
+    assert sorted(call[0][0] for call in tbapi.send_telemetry.call_args_list) == ["A", "C"]
+
+
+def test_wifi_location_bad_coordinates(client, monkeypatch):
+    geolocate_mock = Mock(return_value={'location': {'lat': 45.5007334, 'lng': -122.6445077}, 'accuracy': 30})
+    redlight_greenlight.get_geolocate = Mock(return_value=geolocate_mock)
+    tbapi = Mock()
+    monkeypatch.setattr(redlight_greenlight, 'get_tbapi', Mock(return_value=tbapi))
+
+    def report(token, latitude):
+        return dict(device_token=token, latitude=latitude, longitude=-122.64446517,
+                    visibleHotspots=[{"macAddress": "B0:B2:DC:D5:0F:1D", "signalStrength": -60}])
+
+    # one bad report doesn't fail the rest of the batch, and no NaN reaches the reply or ThingsBoard
+    resp = client.post('/wifi_location/batch', json=[report("A", "abc"), report("B", None), report("C", "45.50080533"), report("D", 91)])
+    assert b"NaN" not in resp.data
+    results = resp.json['results']
+    assert results[0] == {"error": "latitude must be a number"}
+    assert results[1] == {"error": "latitude must be a number"}
+    assert int(results[2]['wifiDistance']) == 8
+    assert results[3] == {"error": "latitude out of range"}
+    assert [call[0][0] for call in tbapi.send_telemetry.call_args_list] == ["C"]
+
+    # nor does a report with malformed hotspots
+    bad_hotspots = [dict(visibleHotspots=[1, 2]),
+                    dict(device_token="F", visibleHotspots=[{"macAddress": "B0:B2:DC:D5:0F:1D", "signalStrength": "loud"}])]
+    resp = client.post('/wifi_location/batch', json=bad_hotspots + [report("G", 45.50080533)])
+    assert resp.status_code == 200
+    results = resp.json['results']
+    assert results[:2] == [{"error": "invalid report"}] * 2
+    assert int(results[2]['wifiDistance']) == 8
+
+    resp = client.post('/wifi_location', json=report("E", "abc"))
+    assert resp.status_code == 400
+    assert [call[0][0] for call in tbapi.send_telemetry.call_args_list] == ["C", "G"]
+
+
+def test_geolocate_single_flight(client):
+    release = threading.Event()
+
+    def geolocate(wifi_access_points):
+        release.wait(5)
+        return {'location': {'lat': 45.5007334, 'lng': -122.6445077}, 'accuracy': 30}
+    geolocate_mock = Mock(side_effect=geolocate)
+    redlight_greenlight.get_geolocate = Mock(return_value=geolocate_mock)
+    flights = redlight_greenlight.geolocate_flights
+    collapsed = flights.stats()['collapsed']
+
+    # a herd of devices reporting the same access points costs one Google request
+    hotspots = [{"macAddress": "B0:B2:DC:D5:0F:1D", "signalStrength": -78}]
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(redlight_greenlight.geolocate_hotspots(hotspots))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    wait_until(lambda: flights.stats()['collapsed'] == collapsed + 3)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert geolocate_mock.call_count == 1
+    assert [location.coord for location in results] == [(45.5007334, -122.6445077)] * 4
+
+
+def test_wifi_location_circuit_breaker(client):
+    geolocate_mock = Mock(return_value={'location': {'lat': 45.5007334, 'lng': -122.6445077}, 'accuracy': 30})
+    redlight_greenlight.get_geolocate = Mock(return_value=geolocate_mock)
+
+    def report(mac):
+        return dict(latitude=45.50080533, longitude=-122.64446517, visibleHotspots=[{"macAddress": mac, "signalStrength": -60}])
+    assert client.post('/wifi_location', json=report("B0:B2:DC:D5:0F:1D")).status_code == 200
+
+    # Google starts failing, and after two failures we stop asking
+    geolocate_mock.side_effect = IOError("read timeout")
+    assert client.post('/wifi_location', json=report("00:00:00:00:00:01")).status_code == 500
+    assert client.post('/wifi_location', json=report("00:00:00:00:00:02")).status_code == 500
+    resp = client.post('/wifi_location', json=report("00:00:00:00:00:03"))
+    assert resp.status_code == 503
+    assert int(resp.headers['Retry-After']) > 0
+    assert geolocate_mock.call_count == 3
+
+    # cached answers are still served
+    assert client.post('/wifi_location', json=report("B0:B2:DC:D5:0F:1D")).status_code == 200
+    assert client.get('/status').json['circuit_breakers']['google']['state'] == "open"
+
+
+def test_metrics(client, tmpdir):
+    fw_dir = tmpdir.mkdir('firmwares')
+    fw_dir.join('1.2.bin').write_binary(b'firmware image')
+    redlight_greenlight.CFG['firmware_images_folder'] = str(fw_dir)
+    assert client.get('/firmware').status_code == 200
+
+    text = client.get('/metrics').data.decode()
+    assert 'rlgl_http_request_duration_seconds_count{route="/firmware",method="GET",status="200"} ' in text
+    assert 'rlgl_firmware_bytes_sent_total ' in text
+    assert 'rlgl_ota_queue_depth 0\n' in text
+    assert 'rlgl_cache_hits_total{cache="firmware_catalog"} ' in text
+    assert 'rlgl_upstream_circuit_open{upstream="google"} 0\n' in text
+    assert 'rlgl_http_requests_in_flight ' in text
+
+
+def test_request_profiling(client, tmpdir, monkeypatch):
+    profiles = tmpdir.mkdir('profiles')
+    monkeypatch.setattr(redlight_greenlight, 'request_profiler', RequestProfiler(str(profiles), sample_rate=1.0))
+    fw_dir = tmpdir.mkdir('firmwares')
+    fw_dir.join('1.0.bin').write_binary(b'firmware image')
+    redlight_greenlight.CFG['firmware_images_folder'] = str(fw_dir)
+
+    headers = dict(HTTP_X_ESP8266_VERSION='1.0', HTTP_X_ESP8266_STA_MAC='aa:bb:cc:dd:ee:ff')
+    resp = client.get('/update', headers=headers)
+    assert resp.status_code == 302
+    resp.close()    # as the server does once the response is sent
+
+    [name] = profiles.listdir()
+    assert "ms-update-" in name.basename
+
+    # a streamed body is profiled until it has been sent
+    resp = client.get('/firmware')
+    assert len(profiles.listdir()) == 1
+    assert resp.data == b'firmware image'
+    resp.close()
+    [name] = [path for path in profiles.listdir() if "ms-firmware-" in path.basename]
+    streamed = [function for (filename, _, function) in pstats.Stats(str(name)).stats if filename.endswith("wsgi.py")]
+    assert "__next__" in streamed
+
+    # a HEAD request never sends the body, but still finishes its profile
+    client.head('/firmware').close()
+    assert len(profiles.listdir()) == 3
+
+    # off by default
+    monkeypatch.delenv('RLGL_PROFILE', raising=False)
+    monkeypatch.delitem(redlight_greenlight.CFG, 'profile_sample_rate', raising=False)
+    assert redlight_greenlight.build_request_profiler() is None
+
+
+def test_request_logging(client, tmpdir, monkeypatch):
+    records = []
+    handler = logging.Handler()
+    handler.emit = records.append
+    pipeline = LogPipeline(lambda: [handler], sampler=RouteSampler(1.0, {"/update": 0}))
+    monkeypatch.setattr(logging.getLogger("redlight_greenlight"), 'handlers', [pipeline.handler])
+    fw_dir = tmpdir.mkdir('firmwares')
+    fw_dir.join('1.1.bin').write_binary(b'firmware image')
+    redlight_greenlight.CFG['firmware_images_folder'] = str(fw_dir)
+
+    headers = dict(HTTP_X_ESP8266_VERSION='1.0', HTTP_X_ESP8266_STA_MAC='aa:bb:cc:dd:ee:ff')
+    assert client.get('/update', headers=headers).status_code == 200
+    pipeline.stop()
+
+    # the chatty messages are sampled out on /update; the upgrade itself is always logged
+    [record] = records
+    assert record.getMessage() == "Upgrading birdhouse to " + str(fw_dir.join('1.1.bin'))
+    assert record.route == "/update" and record.mac == "aa:bb:cc:dd:ee:ff"
+    assert pipeline.stats()['sampled_out'] >= 2
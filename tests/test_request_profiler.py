@@ -0,0 +1,40 @@
+import os
+import pstats
+
+from redlight_greenlight.request_profiler import RequestProfiler, route_slug
+
+
+def test_profile_written(tmpdir):
+    profiler = RequestProfiler(str(tmpdir), sample_rate=1.0)
+    profile = profiler.start("/firmware/<digest>")
+    sum(range(1000))
+    profiler.finish(profile, "/firmware/<digest>", 0.1234)
+
+    [name] = os.listdir(str(tmpdir))
+    assert "-000123ms-firmware-digest-" in name
+    assert name.endswith(".pstats")
+    pstats.Stats(str(tmpdir / name))    # loads
+
+
+def test_sampling(tmpdir):
+    profiler = RequestProfiler(str(tmpdir), sample_rate=0, route_rates={"/update": 1.0})
+    assert profiler.start("/wifi_location") is None
+
+    # one request at a time
+    profile = profiler.start("/update")
+    assert profile is not None
+    assert profiler.start("/update") is None
+    profiler.finish(profile, "/update", 0.01)
+    assert profiler.stats()['skipped'] == 1
+
+
+def test_rotation(tmpdir):
+    profiler = RequestProfiler(str(tmpdir), sample_rate=1.0, max_files=3)
+    for n in range(5):
+        profiler.finish(profiler.start("/update"), "/update", n / 1000)
+    assert len(os.listdir(str(tmpdir))) == 3
+
+
+def test_route_slug():
+    assert route_slug("/wifi_location/batch") == "wifi_location-batch"
+    assert route_slug("/") == "root"
@@ -0,0 +1,17 @@
+from redlight_greenlight.server import gunicorn_options
+
+
+def test_gunicorn_options():
+    options = gunicorn_options(dict(server_host='0.0.0.0', server_port=8989, server_workers=3, server_threads=8))
+    assert options['bind'] == '0.0.0.0:8989'
+    assert options['workers'] == 3
+    assert options['threads'] == 8
+    assert options['worker_class'] == 'gthread'
+    assert options['accesslog'] is None
+
+
+def test_gunicorn_options_defaults():
+    options = gunicorn_options({})
+    assert options['bind'] == '127.0.0.1:8080'
+    assert options['workers'] >= 3
+    assert options['keepalive'] == 5
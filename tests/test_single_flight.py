@@ -0,0 +1,75 @@
+import threading
+import time
+
+import pytest
+
+from redlight_greenlight.single_flight import SingleFlight
+
+
+def wait_until(condition, timeout=5):
+    # Fails the test rather than hanging the suite if the other threads never get there
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out waiting for other threads"
+        time.sleep(0.001)
+
+
+def test_collapses_concurrent_calls():
+    flights = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def slow(x):
+        calls.append(x)
+        release.wait(5)
+        return x * 2
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(flights.do("key", slow, 21))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    wait_until(lambda: flights.stats()['collapsed'] == 4)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert calls == [21]
+    assert results == [42] * 5
+    assert flights.stats() == dict(calls=1, collapsed=4, in_flight=0)
+
+    # once finished, the next call runs again
+    assert flights.do("key", slow, 1) == 2
+    assert calls == [21, 1]
+
+
+def test_shares_errors():
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+
+    def failing():
+        started.set()
+        release.wait(5)
+        raise ValueError("upstream down")
+
+    errors = []
+
+    def call():
+        try:
+            flights.do("key", failing)
+        except ValueError as ex:
+            errors.append(ex)
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    assert started.wait(5)
+    follower = threading.Thread(target=call)
+    follower.start()
+    wait_until(lambda: flights.stats()['collapsed'] == 1)
+    release.set()
+    leader.join()
+    follower.join()
+
+    assert len(errors) == 2
+    with pytest.raises(ValueError):
+        flights.do("key", failing)
@@ -0,0 +1,21 @@
+from redlight_greenlight.ttl_cache import TTLCache
+
+
+def test_expiry():
+    cache = TTLCache(ttl=60)
+    cache.put('a', 1)
+    cache.put('b', 2, ttl=0)
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_lru_eviction():
+    cache = TTLCache(ttl=60, max_entries=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
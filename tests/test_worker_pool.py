@@ -0,0 +1,53 @@
+import threading
+from unittest.mock import Mock
+
+from redlight_greenlight.worker_pool import WorkerPool
+
+
+def test_runs_jobs():
+    pool = WorkerPool(workers=2, max_queued=10)
+    results = []
+    for n in range(5):
+        assert pool.submit(results.append, n)
+    pool.join()
+
+    assert sorted(results) == [0, 1, 2, 3, 4]
+    stats = pool.stats()
+    assert stats['completed'] == 5
+    assert stats['queue_depth'] == 0
+    assert stats['latency_max'] >= stats['latency_p50'] >= 0
+
+
+def test_retries():
+    pool = WorkerPool(workers=1, max_queued=10, retries=2, retry_delay=0)
+    flaky = Mock(side_effect=[Exception("timeout"), None])
+    broken = Mock(side_effect=Exception("always fails"))
+    pool.submit(flaky)
+    pool.submit(broken)
+    pool.join()
+
+    assert flaky.call_count == 2
+    assert broken.call_count == 3
+    stats = pool.stats()
+    assert stats['completed'] == 1
+    assert stats['failed'] == 1
+    assert stats['retried'] == 3
+
+
+def test_full_queue():
+    pool = WorkerPool(workers=1, max_queued=1)
+    started = threading.Event()
+    release = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    assert pool.submit(block)
+    assert started.wait(5)
+    assert pool.submit(block)       # queued behind the running job
+    assert not pool.submit(block)   # no room left
+
+    release.set()
+    pool.join()
+    assert pool.stats()['rejected'] == 1